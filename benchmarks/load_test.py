@@ -0,0 +1,266 @@
+"""
+Load test of all five services in `base` mode, booted in this process and
+driven through their ASGI apps, so it runs offline and without Docker.
+
+A synthetic word2vec model and synthetic entity and cluster snapshots of the
+requested size are written to a fresh DATA_PATH first. The services then
+start from these files the same way they start from real data. Tokens are
+accepted by a stub instead of the authentication service. The
+authentication service itself is still booted and used for the login of
+every labeler. The services share one event loop and its default
+executor; their FileLockerMiddleware waits for the file locks on an executor
+of its own, so blocked lock waiters cannot starve the other services.
+
+Every labeler logs in once and then repeats the labeling loop of the UI:
+  1. GET the next mention with its suggested clusters
+  2. POST the entity to one of the suggested clusters
+  3. GET the list of clusters
+It stops at the end of `--duration` or once nothing is left to label.
+Throughput and p50/p95/p99 latencies are reported per endpoint.
+
+All other settings of the services are read from the environment as usual,
+e.g. RESPONSE_ENCODER=orjson or CLUSTER_INDEX_BACKEND=ivf.
+
+    python benchmarks/load_test.py --entities 20000 --clusters 500 --labelers 16 --duration 30
+"""
+from collections import Counter, defaultdict
+from service_loader import load_service
+from pathlib import Path
+import numpy as np
+import tempfile
+import argparse
+import asyncio
+import shutil
+import httpx
+import json
+import time
+import os
+
+
+# In startup order, the authentication service creates the admin user
+SERVICES = ("authentication_service", "user_service", "entity_service",
+            "cluster_service", "mention_clustering_service")
+TOKEN = "load-test"
+
+
+class StubAuthClient:
+    """
+    Replaces the AuthClient of a service, every token belongs to an admin.
+    """
+
+    async def verify(self, token: str) -> dict:
+        return {"user_id": "load-test", "username": "admin", "scopes": ["admin"]}
+
+    async def close(self):
+        pass
+
+
+class Recorder:
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.statuses: dict[str, Counter] = defaultdict(Counter)
+
+    async def request(self, client: httpx.AsyncClient, name: str, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies[name].append(time.perf_counter() - start)
+        self.statuses[name][response.status_code] += 1
+        return response
+
+    def report(self, elapsed: float) -> list[dict]:
+        rows = []
+        for name, latencies in self.latencies.items():
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+            rows.append({
+                "endpoint": name,
+                "requests": len(latencies),
+                "errors": sum(count for status, count in self.statuses[name].items() if status >= 400),
+                "statuses": dict(self.statuses[name]),
+                "throughput": len(latencies) / elapsed,
+                "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+            })
+        return rows
+
+
+def create_word2vec_model(model_file: Path, words: int, dim: int, rng: np.random.Generator) -> list[str]:
+    from gensim.models import KeyedVectors
+
+    vocabulary = [f"word{index}" for index in range(words)]
+    model = KeyedVectors(vector_size=dim)
+    model.add_vectors(vocabulary, rng.standard_normal((words, dim)).astype(np.float32))
+    model_file.parent.mkdir(parents=True, exist_ok=True)
+    # Separate .npy files, so the services memory-map the vectors like a real model
+    model.save(str(model_file), sep_limit=0)
+    return vocabulary
+
+
+def create_repositories(data_path: Path, model_file: Path, vocabulary: list[str], entities: int,
+                        clusters: int, labeled: float, rng: np.random.Generator):
+    """
+    Writes entity and cluster snapshots with `entities` entities of one to
+    three word mentions. Every cluster gets at least one member so it has a
+    vector, `labeled` of all entities are in a cluster.
+    """
+    from eec import BaseEntityRepository, BaseClusterRepository, EntityModel, ClusterModel
+    from snapshot_codec import get_codec, write_snapshot
+    from vector_store import VectorStore
+
+    entity_repository = BaseEntityRepository(
+        entities=[], last_id=0, keyed_vectors=VectorStore.get(model_file))
+    entity_repository.add_entities([
+        EntityModel(
+            entity_id=f"entity-{index}",
+            mention=" ".join(rng.choice(vocabulary, size=rng.integers(1, 4))),
+            entity_source=f"source-{index % 10}",
+            entity_source_id=str(index))
+        for index in range(entities)
+    ], suppress_exceptions=True)
+
+    cluster_repository = BaseClusterRepository(
+        entity_repository=entity_repository, clusters=[], last_cluster_id=0)
+    for index in range(clusters):
+        cluster_repository.add_cluster(ClusterModel(
+            cluster_id=f"cluster-{index}", cluster_name=f"Cluster {index}", entities=[]))
+    for index in range(min(entities, max(clusters, int(entities * labeled)))):
+        cluster_repository.add_entity_to_cluster(cluster_id=f"cluster-{index % clusters}", entity_id=f"entity-{index}")
+
+    codec = get_codec()
+    write_snapshot(data_path / "entity_repository.json", entity_repository.encode(), codec)
+    write_snapshot(data_path / "cluster_repository.json", cluster_repository.encode(), codec)
+
+
+def boot_services(data_path: Path, model_file: Path) -> dict:
+    os.environ.update({
+        "SYSTEM_TYPE": "base",
+        "DATA_PATH": str(data_path),
+        "LOGGER_PATH": str(data_path / "logs"),
+        "WORD2VEC_FILE": str(model_file),
+    })
+    os.environ.setdefault("SECRET_KEY", "load-test")
+    services = {name: load_service(name) for name in SERVICES}
+    for service in services.values():
+        # The authentication service verifies tokens on its own
+        if hasattr(service, "auth_client"):
+            service.auth_client = StubAuthClient()
+    return services
+
+
+async def labeler(clients: dict[str, httpx.AsyncClient], recorder: Recorder, args, deadline: float,
+                  rng: np.random.Generator) -> int:
+    await recorder.request(clients["authentication_service"], "POST /auth/login", "POST", "/login",
+                           data={"username": "admin", "password": "admin"})
+    await recorder.request(clients["user_service"], "GET /users/me", "GET", "/me")
+    list_params = {"fields": args.list_fields} if args.list_fields else {}
+    labeled = 0
+    while time.monotonic() < deadline:
+        response = await recorder.request(clients["mention_clustering_service"], "GET /mention/", "GET", "/")
+        if response.status_code == 404:
+            break
+        if response.status_code != 200:
+            continue
+        mention = response.json()
+        cluster_ids = mention["possible_cluster_ids"]
+        if cluster_ids and rng.random() < args.accept_rate:
+            cluster_id = cluster_ids[0]
+        else:
+            cluster_id = f"cluster-{rng.integers(args.clusters)}"
+        response = await recorder.request(
+            clients["cluster_service"], "POST /clusters/cluster/{id}/add-entity", "POST",
+            f"/cluster/{cluster_id}/add-entity", params={"entity_id": mention["entity_id"]})
+        # Two labelers can get the same mention, the second one gets a 409
+        if response.status_code == 200:
+            labeled += 1
+        await recorder.request(clients["cluster_service"], "GET /clusters/", "GET", "/", params=list_params)
+    return labeled
+
+
+async def run(args, data_path: Path, model_file: Path) -> dict:
+    services = boot_services(data_path, model_file)
+    for service in services.values():
+        await service.app.router.startup()
+    clients = {
+        name: httpx.AsyncClient(app=service.app, base_url=f"http://{name}", timeout=None,
+                                headers={"Authorization": f"Bearer {TOKEN}"})
+        for name, service in services.items()
+    }
+    try:
+        # Each service builds its middleware and syncs the snapshots on its
+        # first request, which is not part of the measurement.
+        for name in ("user_service", "entity_service", "cluster_service", "mention_clustering_service"):
+            await clients[name].get("/metrics")
+
+        recorder = Recorder()
+        start = time.monotonic()
+        labeled = await asyncio.gather(*[
+            labeler(clients, recorder, args, start + args.duration, np.random.default_rng(args.seed + index))
+            for index in range(args.labelers)
+        ])
+        elapsed = time.monotonic() - start
+    finally:
+        for client in clients.values():
+            await client.aclose()
+        for service in services.values():
+            await service.app.router.shutdown()
+
+    return {
+        "config": {key: str(value) if isinstance(value, Path) else value
+                   for key, value in vars(args).items() if key != "json"},
+        "elapsed": elapsed,
+        "labeled": sum(labeled),
+        "labeled_per_second": sum(labeled) / elapsed,
+        "endpoints": recorder.report(elapsed),
+    }
+
+
+def print_report(result: dict):
+    print(f"{result['labeled']} entities labeled in {result['elapsed']:.1f}s "
+          f"({result['labeled_per_second']:.1f}/s) by {result['config']['labelers']} labelers\n")
+    print(f"{'endpoint':<40} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for row in result["endpoints"]:
+        print(f"{row['endpoint']:<40} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>9.1f} "
+              f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entities", type=int, default=10000)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--labeled", type=float, default=0.2, help="Fraction of entities already in a cluster")
+    parser.add_argument("--words", type=int, default=5000, help="Vocabulary size of the synthetic model")
+    parser.add_argument("--dim", type=int, default=300, help="Vector size of the synthetic model")
+    parser.add_argument("--labelers", type=int, default=8, help="Concurrent labeling sessions")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run the workload")
+    parser.add_argument("--accept-rate", type=float, default=0.8,
+                        help="Share of mentions put into their first suggested cluster")
+    parser.add_argument("--list-fields", default="cluster_name,entity_count",
+                        help="`fields` of the cluster list requests, empty for whole clusters")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-path", type=Path,
+                        help="Directory for the model and snapshots, a temporary one is removed afterwards")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    data_path = args.data_path or Path(tempfile.mkdtemp(prefix="load_test_"))
+    data_path.mkdir(parents=True, exist_ok=True)
+    model_file = data_path / "word2vec" / "word2vec.model"
+    try:
+        rng = np.random.default_rng(args.seed)
+        started = time.perf_counter()
+        vocabulary = create_word2vec_model(model_file, args.words, args.dim, rng)
+        create_repositories(data_path, model_file, vocabulary, args.entities, args.clusters, args.labeled, rng)
+        print(f"Synthetic data written to {data_path} in {time.perf_counter() - started:.1f}s")
+
+        result = asyncio.run(run(args, data_path, model_file))
+    finally:
+        if args.data_path is None:
+            shutil.rmtree(data_path, ignore_errors=True)
+
+    print_report(result)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
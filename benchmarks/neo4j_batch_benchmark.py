@@ -0,0 +1,171 @@
+"""
+Synthetic comparison of UNWIND batch sizes: the same Neo4JBatchWriter
+statements are written once with batches of a single row (one transaction per
+row) and once with batches of --batch-size rows, for cluster assignments
+(ADD_ENTITIES_TO_CLUSTERS) and for entity creation (CREATE_ENTITIES, used by
+POST /create of the entity service).
+
+Without --uri the driver is replaced by a stub that only sleeps, a fixed round
+trip per transaction plus a small cost per row. With --uri a real Neo4J is
+used; the benchmark creates its own Entity/Cluster nodes with `benchmark-` ids
+and removes them afterwards. Given --word2vec as well, entity creation is also
+measured through the per-item `Neo4JEntityRepository.add_entities` of eec,
+which the entity service used before CREATE_ENTITIES.
+
+    python benchmarks/neo4j_batch_benchmark.py --rows 5000 --batch-size 1000
+    python benchmarks/neo4j_batch_benchmark.py --uri bolt://localhost:7687 --user neo4j --password test \\
+        --word2vec data/word2vec/model.model
+"""
+from neo4j_batch import (Neo4JBatchWriter, create_driver, ADD_ENTITIES_TO_CLUSTERS, CREATE_ENTITIES,
+                         REMOVE_ENTITIES_FROM_CLUSTERS)
+import argparse
+import time
+
+
+class StubTransaction:
+
+    def __init__(self, row_cost: float):
+        self.row_cost = row_cost
+
+    def run(self, query: str, rows: list):
+        time.sleep(self.row_cost * len(rows))
+        return []
+
+
+class StubSession:
+
+    def __init__(self, round_trip: float, row_cost: float):
+        self.round_trip = round_trip
+        self.row_cost = row_cost
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _execute(self, work, *args):
+        time.sleep(self.round_trip)
+        return work(StubTransaction(self.row_cost), *args)
+
+    execute_read = _execute
+    execute_write = _execute
+
+
+class StubDriver:
+
+    def __init__(self, round_trip: float, row_cost: float):
+        self.round_trip = round_trip
+        self.row_cost = row_cost
+
+    def session(self, **kwargs):
+        return StubSession(self.round_trip, self.row_cost)
+
+    def close(self):
+        pass
+
+
+def setup_graph(writer: Neo4JBatchWriter, rows: int):
+    writer.write("""
+        UNWIND $rows AS row
+        CREATE (:Entity:benchmark {entity_id: row.entity_id})
+        MERGE (:Cluster:benchmark {cluster_id: row.cluster_id})
+    """, assignments(rows))
+
+
+def teardown_graph(writer: Neo4JBatchWriter):
+    writer.write("MATCH (node:benchmark) DETACH DELETE node", [None])
+
+
+def delete_created_entities(writer: Neo4JBatchWriter):
+    writer.write("MATCH (entity:Entity) WHERE entity.entity_id STARTS WITH 'benchmark-new-' "
+                 "DETACH DELETE entity", [None])
+
+
+def assignments(rows: int) -> list[dict]:
+    return [{"entity_id": f"benchmark-entity-{i}", "cluster_id": f"benchmark-cluster-{i % 100}"}
+            for i in range(rows)]
+
+
+def new_entities(rows: int) -> list[dict]:
+    return [{"entity_id": f"benchmark-new-{i}", "mention": f"mention {i}",
+             "entity_source": "benchmark", "entity_source_id": str(i)}
+            for i in range(rows)]
+
+
+def measure_create(writer: Neo4JBatchWriter, rows: int, cleanup: bool) -> float:
+    start = time.perf_counter()
+    writer.write(CREATE_ENTITIES, new_entities(rows))
+    elapsed = time.perf_counter() - start
+    if cleanup:
+        delete_created_entities(writer)
+    return elapsed
+
+
+def measure_repository_create(args, writer: Neo4JBatchWriter, rows: int) -> float:
+    from eec import Neo4JEntityRepository, Neo4JHelper, EntityModel
+    from vector_store import VectorStore
+
+    Neo4JHelper(uri=args.uri, user=args.user, password=args.password)
+    repository = Neo4JEntityRepository(keyed_vectors=VectorStore.get(args.word2vec))
+    entities = [EntityModel(**row) for row in new_entities(rows)]
+    start = time.perf_counter()
+    repository.add_entities(entities, suppress_exceptions=True)
+    elapsed = time.perf_counter() - start
+    delete_created_entities(writer)
+    return elapsed
+
+
+def measure(writer: Neo4JBatchWriter, rows: int) -> float:
+    data = assignments(rows)
+    start = time.perf_counter()
+    writer.write(ADD_ENTITIES_TO_CLUSTERS, data)
+    elapsed = time.perf_counter() - start
+    writer.write(REMOVE_ENTITIES_FROM_CLUSTERS, [row["entity_id"] for row in data])
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--uri")
+    parser.add_argument("--user", default="neo4j")
+    parser.add_argument("--password", default="test")
+    parser.add_argument("--pool-size", type=int, default=100)
+    parser.add_argument("--word2vec", help="Model file, also measures Neo4JEntityRepository.add_entities")
+    parser.add_argument("--round-trip-ms", type=float, default=1.0, help="Stub round trip per transaction")
+    parser.add_argument("--row-cost-us", type=float, default=5.0, help="Stub cost per row")
+    args = parser.parse_args()
+
+    if args.uri:
+        driver = create_driver(args.uri, args.user, args.password, max_connection_pool_size=args.pool_size)
+    else:
+        driver = StubDriver(args.round_trip_ms / 1000, args.row_cost_us / 1e6)
+
+    single_rows = Neo4JBatchWriter(driver, batch_size=1)
+    batched = Neo4JBatchWriter(driver, batch_size=args.batch_size)
+    if args.uri:
+        setup_graph(batched, args.rows)
+    try:
+        print(f"UNWIND batch sizes against {'Neo4J at ' + args.uri if args.uri else 'a stub driver'} (synthetic)")
+        print("cluster assignments")
+        for name, writer in (("batch of 1", single_rows), (f"batch of {args.batch_size}", batched)):
+            elapsed = measure(writer, args.rows)
+            print(f"{name:>28}: {args.rows / elapsed:12.1f} rows/s ({elapsed:.3f}s)")
+        print("entity creation")
+        for name, writer in (("batch of 1", single_rows), (f"batch of {args.batch_size}", batched)):
+            elapsed = measure_create(writer, args.rows, cleanup=bool(args.uri))
+            print(f"{name:>28}: {args.rows / elapsed:12.1f} rows/s ({elapsed:.3f}s)")
+        if args.uri and args.word2vec:
+            elapsed = measure_repository_create(args, batched, args.rows)
+            print(f"{'repository add_entities':>28}: {args.rows / elapsed:12.1f} rows/s ({elapsed:.3f}s)")
+    finally:
+        if args.uri:
+            teardown_graph(batched)
+            delete_created_entities(batched)
+        driver.close()
+
+
+if __name__ == "__main__":
+    main()
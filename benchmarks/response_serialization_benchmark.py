@@ -0,0 +1,129 @@
+"""
+Compares the two response encoders of the entity and cluster services
+(RESPONSE_ENCODER=pydantic and RESPONSE_ENCODER=orjson) on synthetic
+entities and clusters, and checks that both produce the same JSON.
+
+The pydantic path is measured the way FastAPI runs it: building the
+EntityOut/ClusterOut models, validating them against the `response_model`
+and encoding the result with the stdlib. The orjson path is the service's own
+`_entities_response` / `_clusters_response`. The script exits with an error
+if any item differs between the two. Clusters are measured once with all
+fields and once projected to the fields of a list view
+(`fields=cluster_name,entity_count`).
+
+    python benchmarks/response_serialization_benchmark.py --items 10000 --dim 300
+"""
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from service_loader import load_service
+import numpy as np
+import tempfile
+import argparse
+import asyncio
+import json
+import time
+import sys
+import os
+
+
+class Entity:
+
+    def __init__(self, index: int, dim: int, cluster_id: str = None):
+        self.entity_id = f"entity-{index}"
+        self.mention = f"mention {index}"
+        self.entity_source = f"source-{index % 10}"
+        self.entity_source_id = str(index)
+        self.cluster_id = cluster_id
+        self.mention_vector = np.random.rand(dim).astype(np.float32)
+
+    @property
+    def has_cluster(self) -> bool:
+        return self.cluster_id is not None
+
+    @property
+    def has_mention_vector(self) -> bool:
+        return self.mention_vector is not None
+
+
+class Cluster:
+
+    def __init__(self, index: int, entities: list[Entity], dim: int):
+        self.cluster_id = f"cluster-{index}"
+        self.cluster_name = f"Cluster {index}"
+        self.entities = entities
+        self.cluster_vector = np.random.rand(dim).astype(np.float32).tolist()
+
+
+def synthetic_data(items: int, dim: int, cluster_size: int) -> tuple[list[Entity], list[Cluster]]:
+    entities = [Entity(index, dim, f"cluster-{index // cluster_size}" if index % 2 else None)
+                for index in range(items)]
+    clusters = [Cluster(index, entities[start:start + cluster_size], dim)
+                for index, start in enumerate(range(0, items, cluster_size))]
+    return entities, clusters
+
+
+def pydantic_body(field, models: list) -> bytes:
+    # The endpoints leave fields that were not asked for unset
+    content = asyncio.run(serialize_response(field=field, response_content=models, exclude_unset=True))
+    return JSONResponse(content).body
+
+
+def measure(encode, repeat: int) -> tuple[float, bytes]:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode()
+        best = min(best, time.perf_counter() - start)
+    return best, body
+
+
+def check_parity(name: str, before: bytes, after: bytes):
+    before, after = json.loads(before), json.loads(after)
+    if len(before) != len(after):
+        sys.exit(f"{name}: {len(before)} items with pydantic, {len(after)} with orjson")
+    for expected, actual in zip(before, after):
+        if expected != actual:
+            sys.exit(f"{name}: responses differ\n  pydantic: {expected}\n  orjson:   {actual}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=10000, help="Number of entities")
+    parser.add_argument("--cluster-size", type=int, default=10, help="Entities per cluster")
+    parser.add_argument("--dim", type=int, default=300, help="Size of the cluster vectors")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # The services create their journal and caches under DATA_PATH on import
+    os.environ["DATA_PATH"] = tempfile.mkdtemp(prefix="response_benchmark_")
+    entity_service = load_service("entity_service")
+    cluster_service = load_service("cluster_service")
+    entities, clusters = synthetic_data(args.items, args.dim, args.cluster_size)
+
+    entity_field = create_response_field(name="response", type_=list[entity_service.EntityOut])
+    cluster_field = create_response_field(name="response", type_=list[cluster_service.ClusterOut])
+    cases = [
+        ("entities", entities, entity_service, entity_field, entity_service.DEFAULT_ENTITY_FIELDS,
+         entity_service._entity_to_entityOut, entity_service._entities_response),
+        ("clusters", clusters, cluster_service, cluster_field, cluster_service.DEFAULT_CLUSTER_FIELDS,
+         cluster_service._base_cluster_to_clusterOut, cluster_service._clusters_response),
+        ("clusters (list view)", clusters, cluster_service, cluster_field,
+         frozenset(("cluster_name", "entity_count")),
+         cluster_service._base_cluster_to_clusterOut, cluster_service._clusters_response),
+    ]
+    for name, items, service, field, fields, to_model, fast_response in cases:
+        service.RESPONSE_ENCODER = "pydantic"
+        before, before_body = measure(
+            lambda: pydantic_body(field, [to_model(item, fields) for item in items]), args.repeat)
+        service.RESPONSE_ENCODER = "orjson"
+        after, after_body = measure(lambda: fast_response(items, fields).body, args.repeat)
+        check_parity(name, before_body, after_body)
+        print(f"{name:>20} ({len(items)} items, {len(after_body) / 1e6:.2f} MB): "
+              f"pydantic {before / len(items) * 1e6:8.2f} us/item, "
+              f"orjson {after / len(items) * 1e6:8.2f} us/item, "
+              f"{before / after:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
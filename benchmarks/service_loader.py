@@ -0,0 +1,27 @@
+from pathlib import Path
+import importlib.util
+import sys
+
+
+SERVICES_PATH = Path(__file__).resolve().parent.parent / "services"
+
+
+def load_service(name: str):
+    """
+    Imports `services/<name>/main.py` under its own module name. Every service
+    has a `main` and a `models` module, the ones of a service are removed from
+    `sys.modules` again so the next service gets its own. The service reads its
+    environment variables on import, they have to be set before.
+    """
+    path = SERVICES_PATH / name
+    sys.path.insert(0, str(path))
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name}.main", path / "main.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(path))
+        for module_name, loaded in list(sys.modules.items()):
+            if Path(getattr(loaded, "__file__", None) or "/").parent == path:
+                del sys.modules[module_name]
+    return module
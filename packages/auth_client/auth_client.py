@@ -0,0 +1,162 @@
+from fastapi import HTTPException
+from jose import JWTError, jwt
+from collections import OrderedDict
+import asyncio
+import httpx
+import logging
+import time
+
+
+class AuthClient:
+    """
+    Verifies bearer tokens against the authentication service through one
+    pooled, keep-alive httpx.AsyncClient. Successful verifications are cached
+    per token until the token expires or `cache_ttl` seconds pass, whichever
+    comes first; at most `cache_size` tokens are kept and the least recently
+    used one is evicted first.
+    """
+
+    def __init__(
+            self, auth_service_url: str, cache_size: int = 1024, cache_ttl: float = 60,
+            max_connections: int = 100, timeout: float = 10
+    ):
+        self.auth_service_url = auth_service_url
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.limits = httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = timeout
+        self.client: httpx.AsyncClient = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        # Created lazily so that it is bound to the running event loop
+        if self.client is None:
+            self.client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return self.client
+
+    async def verify(self, token: str) -> dict:
+        now = time.time()
+        cached = self.cache.get(token)
+        if cached is not None:
+            expires_at, user = cached
+            if expires_at > now:
+                self.cache.move_to_end(token)
+                return user
+            del self.cache[token]
+
+        response = await self.get_client().get(
+            f'{self.auth_service_url}/verify',
+            headers={'Authorization': f"Bearer {token}"}
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        user = response.json()
+        self.store(token, user, now)
+        return user
+
+    def store(self, token: str, user: dict, now: float):
+        expires_at = now + self.cache_ttl
+        try:
+            exp = jwt.get_unverified_claims(token).get("exp")
+            if exp is not None:
+                expires_at = min(expires_at, exp)
+        except JWTError:
+            pass
+
+        self.cache[token] = (expires_at, user)
+        self.cache.move_to_end(token)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+class LocalAuthClient(AuthClient):
+    """
+    Verifies tokens in-process with the SECRET_KEY shared with the
+    authentication service instead of calling /verify for every request.
+    Users are looked up in a snapshot of all existing usernames that is pulled
+    from the authentication service in bulk every `refresh_interval` seconds,
+    so tokens of deleted or renamed users are rejected at most that long after
+    the change. Unknown users trigger an early refresh, at most once every
+    `min_refresh_interval` seconds, so new users do not have to wait for it.
+    """
+
+    def __init__(
+            self, auth_service_url: str, secret_key: str, algorithm: str = "HS256",
+            refresh_interval: float = 30, min_refresh_interval: float = 1, timeout: float = 10
+    ):
+        super().__init__(auth_service_url, max_connections=1, timeout=timeout)
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.users: dict[str, str] = None
+        self.last_refresh: float = 0
+        self.refresh_lock = asyncio.Lock()
+
+    def service_token(self) -> str:
+        return jwt.encode(
+            {"sub": "service", "typ": "service", "exp": time.time() + 60},
+            self.secret_key, algorithm=self.algorithm)
+
+    async def refresh_users(self, max_age: float):
+        async with self.refresh_lock:
+            if time.time() - self.last_refresh < max_age:
+                return
+            # Failed refreshes are retried after the next interval, the
+            # previous snapshot stays in use meanwhile.
+            self.last_refresh = time.time()
+            try:
+                response = await self.get_client().get(
+                    f'{self.auth_service_url}/verify/users',
+                    headers={'Authorization': f"Bearer {self.service_token()}"}
+                )
+                response.raise_for_status()
+                self.users = response.json()["users"]
+            except httpx.HTTPError as e:
+                logging.warning(f"Could not refresh users from the authentication service: {e}")
+
+    async def verify(self, token: str) -> dict:
+        if time.time() - self.last_refresh >= self.refresh_interval:
+            await self.refresh_users(self.refresh_interval)
+        if self.users is None:
+            raise HTTPException(status_code=503, detail="Authentication service unavailable")
+
+        try:
+            payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        username: str = payload.get("sub")
+        exp: float = payload.get("exp")
+        if exp is None or exp < time.time() or payload.get("typ") == "service":
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        user_id = self.users.get(username)
+        if user_id is None:
+            await self.refresh_users(self.min_refresh_interval)
+            user_id = self.users.get(username)
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        return {"user_id": user_id, "username": username, "scopes": payload.get("scopes") or []}
+
+
+def check_scopes(user: dict, required_scopes: list[str]):
+    """
+    Raises 401 unless the verified user holds every required scope. Admins
+    pass every check.
+    """
+    scopes = user["scopes"] or []
+    if 'admin' in scopes:
+        return
+
+    for scope in required_scopes:
+        if scope not in scopes:
+            raise HTTPException(status_code=401, detail="Unauthorized")
@@ -0,0 +1,276 @@
+from typing import Callable, Iterable
+import numpy as np
+import threading
+
+
+class CentroidTracker:
+    """
+    Keeps the sum and count of the member mention vectors of every cluster,
+    so a centroid follows an added or removed entity in O(dim) instead of
+    being recomputed over all members.
+
+    Sums are kept in float64, but repeated additions and removals still drift
+    slightly; a cluster is marked for a full recompute after `recompute_after`
+    incremental updates. Clusters can also be invalidated when the change to a
+    member is not known (e.g. its mention was updated). Callers recompute
+    marked clusters with `set` before reading their centroid, or read it
+    through `current`.
+
+    Centroids are read from pool threads while changes are applied on the
+    event loop, so every method holds the tracker's lock.
+    """
+
+    def __init__(self, dim: int, recompute_after: int = 1000):
+        self.dim = dim
+        self.recompute_after = recompute_after
+        self.sums: dict[str, np.ndarray] = {}
+        self.counts: dict[str, int] = {}
+        self.updates: dict[str, int] = {}
+        self.stale: set[str] = set()
+        self.lock = threading.RLock()
+
+    def __contains__(self, cluster_id: str) -> bool:
+        return cluster_id in self.sums
+
+    def _usable(self, vector) -> np.ndarray:
+        if vector is None:
+            return None
+        vector = np.asarray(vector, dtype=np.float64)
+        if vector.shape != (self.dim,) or not np.all(np.isfinite(vector)):
+            return None
+        return vector
+
+    def set(self, cluster_id: str, vectors: Iterable):
+        """
+        Recomputes a cluster from all of its member vectors.
+        """
+        total = np.zeros(self.dim, dtype=np.float64)
+        count = 0
+        for vector in vectors:
+            vector = self._usable(vector)
+            if vector is not None:
+                total += vector
+                count += 1
+        with self.lock:
+            self.sums[cluster_id] = total
+            self.counts[cluster_id] = count
+            self.updates[cluster_id] = 0
+            self.stale.discard(cluster_id)
+
+    def current(self, cluster_id: str, vectors: Callable[[], Iterable], store: bool = True) -> np.ndarray:
+        """
+        Centroid of a cluster, recomputed from `vectors()` first if it is
+        marked. Without `store` a recompute is returned but not kept, for
+        callers that read the members outside the repository locks, where the
+        members may already contain a change the tracker has not seen yet.
+        """
+        with self.lock:
+            if not self.needs_recompute(cluster_id):
+                return self.centroid(cluster_id)
+            if store:
+                self.set(cluster_id, vectors())
+                return self.centroid(cluster_id)
+        recomputed = CentroidTracker(self.dim)
+        recomputed.set(cluster_id, vectors())
+        return recomputed.centroid(cluster_id)
+
+    def build(self, clusters: Iterable[tuple[str, Iterable]]):
+        with self.lock:
+            self.clear()
+            for cluster_id, vectors in clusters:
+                self.set(cluster_id, vectors)
+
+    def add(self, cluster_id: str, vector):
+        self._update(cluster_id, vector, 1)
+
+    def remove(self, cluster_id: str, vector):
+        self._update(cluster_id, vector, -1)
+
+    def update(self, cluster_id: str, added: Iterable = (), removed: Iterable = ()):
+        """
+        Applies several added and removed members of a cluster as a single
+        change of its sum.
+        """
+        delta = np.zeros(self.dim, dtype=np.float64)
+        count = 0
+        for vectors, sign in ((added, 1), (removed, -1)):
+            for vector in vectors:
+                vector = self._usable(vector)
+                if vector is not None:
+                    delta += sign * vector
+                    count += sign
+        with self.lock:
+            if cluster_id not in self.sums:
+                self.stale.add(cluster_id)
+                return
+            self.sums[cluster_id] += delta
+            self.counts[cluster_id] += count
+            self.updates[cluster_id] += 1
+            if self.counts[cluster_id] < 0:
+                self.stale.add(cluster_id)
+
+    def _update(self, cluster_id: str, vector, sign: int):
+        vector = self._usable(vector)
+        with self.lock:
+            if cluster_id not in self.sums:
+                self.stale.add(cluster_id)
+                return
+            if vector is None:
+                return
+            self.sums[cluster_id] += sign * vector
+            self.counts[cluster_id] += sign
+            self.updates[cluster_id] += 1
+            if self.counts[cluster_id] < 0:
+                self.stale.add(cluster_id)
+
+    def invalidate(self, cluster_id: str):
+        with self.lock:
+            self.stale.add(cluster_id)
+
+    def drop(self, cluster_id: str):
+        with self.lock:
+            self.sums.pop(cluster_id, None)
+            self.counts.pop(cluster_id, None)
+            self.updates.pop(cluster_id, None)
+            self.stale.discard(cluster_id)
+
+    def clear(self):
+        with self.lock:
+            self.sums.clear()
+            self.counts.clear()
+            self.updates.clear()
+            self.stale.clear()
+
+    def needs_recompute(self, cluster_id: str) -> bool:
+        with self.lock:
+            return cluster_id not in self.sums or cluster_id in self.stale \
+                or self.updates[cluster_id] >= self.recompute_after
+
+    def centroid(self, cluster_id: str) -> np.ndarray:
+        """
+        Mean of the member vectors, a zero vector for clusters without any.
+        """
+        with self.lock:
+            count = self.counts[cluster_id]
+            if count <= 0:
+                return np.zeros(self.dim, dtype=np.float32)
+            return (self.sums[cluster_id] / count).astype(np.float32)
+
+    def verify(self, clusters: Iterable[tuple[str, Iterable]], tolerance: float = 1e-4,
+               fix: bool = False) -> dict:
+        """
+        Compares the tracked centroids with a full recompute from the member
+        vectors. Returns the largest absolute difference and the clusters
+        exceeding `tolerance`, which are recomputed when `fix` is set.
+        """
+        checked = 0
+        untracked = 0
+        max_error = 0.0
+        drifted = []
+        with self.lock:
+            for cluster_id, vectors in clusters:
+                # Clusters that were never read yet are computed lazily
+                if cluster_id not in self.sums:
+                    untracked += 1
+                    continue
+                vectors = list(vectors)
+                expected = CentroidTracker(self.dim)
+                expected.set(cluster_id, vectors)
+                checked += 1
+                error = float(np.max(np.abs(
+                    self.centroid(cluster_id) - expected.centroid(cluster_id)), initial=0))
+                max_error = max(max_error, error)
+                if error > tolerance or self.counts[cluster_id] != expected.counts[cluster_id]:
+                    drifted.append(cluster_id)
+                    if fix:
+                        self.set(cluster_id, vectors)
+            stale = len(self.stale)
+        return {
+            "checked": checked,
+            "untracked": untracked,
+            "max_error": max_error,
+            "drifted": drifted,
+            "stale": stale,
+            "fixed": fix,
+        }
+
+
+class TrackedClusterRepository:
+    """
+    Wraps an in-memory cluster repository so that adding an entity to or
+    removing it from a cluster only changes the membership and moves the
+    running sum of the CentroidTracker, instead of having the repository
+    recompute the cluster vector over all members on every change. Failing
+    calls (unknown ids, entities already in or not in a cluster) are passed
+    to the wrapped repository, which raises its own exceptions. Everything
+    else is passed through.
+
+    The cluster models' own `cluster_vector` is not maintained on these
+    paths; centroids are read from the tracker, which still recomputes a
+    cluster fully when it drifted or was invalidated.
+    """
+
+    def __init__(self, repository, entity_repository, tracker: CentroidTracker):
+        self.repository = repository
+        self.entity_repository = entity_repository
+        self.tracker = tracker
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+    @staticmethod
+    def _vector(entity):
+        return entity.mention_vector if entity.has_mention_vector else None
+
+    def add_entity_to_cluster(self, cluster_id: str, entity_id: str):
+        cluster = self.repository.get_cluster_by_id(cluster_id)
+        entity = self.entity_repository.get_entity_by_id(entity_id)
+        if entity.has_cluster:
+            return self.repository.add_entity_to_cluster(cluster_id=cluster_id, entity_id=entity_id)
+        entity.cluster_id = cluster_id
+        cluster.entities.append(entity)
+        self.tracker.add(cluster_id, self._vector(entity))
+
+    def remove_entity_from_cluster(self, entity_id: str):
+        entity = self.entity_repository.get_entity_by_id(entity_id)
+        if not entity.has_cluster:
+            return self.repository.remove_entity_from_cluster(entity_id=entity_id)
+        cluster_id = entity.cluster_id
+        cluster = self.repository.get_cluster_by_id(cluster_id)
+        for position, member in enumerate(cluster.entities):
+            if member.entity_id == entity_id:
+                del cluster.entities[position]
+                break
+        entity.cluster_id = None
+        self.tracker.remove(cluster_id, self._vector(entity))
+
+    def assign(self, moves: list):
+        """
+        Moves already validated entities, given as (entity, cluster_id)
+        pairs, to `cluster_id` or out of their cluster when it is None. The
+        changes are grouped by cluster: every touched cluster's members are
+        rewritten once and its sum is updated once.
+        """
+        added: dict[str, list] = {}
+        removed: dict[str, list] = {}
+        for entity, cluster_id in moves:
+            if entity.has_cluster:
+                removed.setdefault(entity.cluster_id, []).append(entity)
+            if cluster_id is not None:
+                added.setdefault(cluster_id, []).append(entity)
+        for cluster_id, entities in removed.items():
+            cluster = self.repository.get_cluster_by_id(cluster_id)
+            entity_ids = {entity.entity_id for entity in entities}
+            cluster.entities[:] = [member for member in cluster.entities if member.entity_id not in entity_ids]
+            for entity in entities:
+                entity.cluster_id = None
+        for cluster_id, entities in added.items():
+            cluster = self.repository.get_cluster_by_id(cluster_id)
+            cluster.entities.extend(entities)
+            for entity in entities:
+                entity.cluster_id = cluster_id
+        for cluster_id in added.keys() | removed.keys():
+            self.tracker.update(
+                cluster_id,
+                added=[self._vector(entity) for entity in added.get(cluster_id, [])],
+                removed=[self._vector(entity) for entity in removed.get(cluster_id, [])])
@@ -0,0 +1,144 @@
+from typing import Iterable, Iterator
+import pyarrow as pa
+import pyarrow.parquet as pq
+import numpy as np
+import itertools
+import json
+import csv
+import io
+import zlib
+
+
+ARROW_TYPES = {
+    "string": pa.string(),
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "string_list": pa.list_(pa.string()),
+}
+
+
+def arrow_schema(columns: dict[str, str], vector_size: int) -> pa.Schema:
+    """
+    Builds the Arrow schema of an export from column names mapped to one of
+    the `ARROW_TYPES` names or "vector", which is stored as a fixed size
+    float32 list of `vector_size` items (NaN filled when missing).
+    """
+    return pa.schema([
+        (name, pa.list_(pa.float32(), vector_size) if kind == "vector" else ARROW_TYPES[kind])
+        for name, kind in columns.items()
+    ])
+
+
+def chunked(rows: Iterable[dict], chunk_size: int) -> Iterator[list[dict]]:
+    iterator = iter(rows)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, np.ndarray):
+        return json.dumps(value.tolist())
+    if isinstance(value, list):
+        return json.dumps(value)
+    return value
+
+
+def stream_csv(rows: Iterable[dict], columns: list[str], chunk_size: int = 1000) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in chunked(rows, chunk_size):
+        for row in chunk:
+            writer.writerow([_csv_value(row[column]) for column in columns])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink:
+    """
+    Write-only file object collecting what pyarrow writes, drained after every
+    chunk so that only one encoded chunk is held in memory.
+    """
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _table(chunk: list[dict], schema: pa.Schema) -> pa.Table:
+    # The Parquet writer cannot store null fixed size lists, missing vectors
+    # are written as NaN filled vectors instead.
+    for field in schema:
+        if isinstance(field.type, pa.FixedSizeListType):
+            missing = np.full(field.type.list_size, np.nan, dtype=np.float32)
+            for row in chunk:
+                if row[field.name] is None:
+                    row[field.name] = missing
+    return pa.Table.from_pylist(chunk, schema=schema)
+
+
+def stream_parquet(rows: Iterable[dict], schema: pa.Schema, chunk_size: int = 10000) -> Iterator[bytes]:
+    """
+    Encodes every chunk of rows as one Parquet row group.
+    """
+    sink = _ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema) as writer:
+        for chunk in chunked(rows, chunk_size):
+            writer.write_table(_table(chunk, schema))
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+
+def stream_arrow(rows: Iterable[dict], schema: pa.Schema, chunk_size: int = 10000) -> Iterator[bytes]:
+    """
+    Encodes the rows in the Arrow IPC streaming format, one record batch per
+    chunk.
+    """
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema) as writer:
+        for chunk in chunked(rows, chunk_size):
+            writer.write_table(_table(chunk, schema))
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
@@ -1,51 +1,149 @@
 from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi import Request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Callable
-import filelock
+from fnmatch import fnmatch
+import threading
 import asyncio
+import fcntl
+import os
+
+
+class ReadWriteFileLock:
+    """
+    Shared/exclusive lock on a lock file based on flock. Every acquisition
+    opens its own descriptor, so shared holders do not block each other, even
+    inside the same process, while an exclusive holder blocks everyone.
+    """
+
+    def __init__(self, lock_file: str):
+        self.lock_file = lock_file
+
+    def acquire(self, shared: bool) -> int:
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def release(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
 
 
 class FileLockerMiddleware(BaseHTTPMiddleware):
 
     all_locks = []
+    # Number of `after` hook runs that were performed or skipped because the
+    # request did not change anything.
+    write_stats = {"performed": 0, "skipped": 0}
 
     def __init__(
             self, app, files_to_lock: list[Path],
-            before: Callable = None, after: Callable = None
+            before: Callable = None, after: Callable = None,
+            is_dirty: Callable = None, pool=None,
+            shared_methods: list[str] = ["GET", "HEAD", "OPTIONS"],
+            shared_paths: list[str] = [], exclusive_paths: list[str] = []
     ):
+        """
+        Requests with one of `shared_methods` or a path matching one of
+        `shared_paths` take the locks in shared mode and run concurrently with
+        each other; everything else, and paths matching `exclusive_paths`,
+        takes them exclusively. Paths are matched with fnmatch patterns against
+        the path inside the app, e.g. `/entity/*`. The `after` hook only runs
+        for exclusive requests.
+
+        With a `pool` (a WorkerPool) the hooks run on it instead of the event
+        loop. They still run before and after the request with the locks held,
+        and one at a time: concurrent shared requests of this process would
+        otherwise run the same sync in several threads at once.
+
+        Waiting for a lock blocks a thread, so the locks are taken on an
+        executor of their own: waiters cannot use up the default executor
+        that the request handlers and the lock holders may need, e.g. when
+        several services run in one process.
+        """
         super().__init__(app)
-        self.lock_files = [filelock.FileLock(f'{file}.lock')
+        self.lock_files = [ReadWriteFileLock(f'{file}.lock')
                            for file in files_to_lock if file.exists()]
         self.before = before
         self.after = after
+        self.is_dirty = is_dirty
+        self.pool = pool
+        self.hook_lock = threading.Lock()
+        self.lock_executor = ThreadPoolExecutor(thread_name_prefix="file-lock")
+        self.shared_methods = set(shared_methods)
+        self.shared_paths = shared_paths
+        self.exclusive_paths = exclusive_paths
+
+    def is_shared(self, request: Request) -> bool:
+        path = request.scope["path"]
+        if any(fnmatch(path, pattern) for pattern in self.exclusive_paths):
+            return False
+        if any(fnmatch(path, pattern) for pattern in self.shared_paths):
+            return True
+        return request.method in self.shared_methods
 
     async def dispatch(self, request: Request, call_next):
-        for file in self.lock_files:
-            await asyncio.to_thread(self.lock_file, file)
-        if self.before is not None:
-            self.before()
+        shared = self.is_shared(request)
+        held_locks = []
+        # The thread records every lock in held_locks as soon as it has it, a
+        # request cancelled while waiting for a lock releases whatever the
+        # thread acquired once it is done.
+        acquiring = asyncio.get_running_loop().run_in_executor(
+            self.lock_executor, self.lock_files_into, held_locks, shared)
         try:
+            await asyncio.shield(acquiring)
+            if self.before is not None:
+                await self.run_hook(self.before)
             response = await call_next(request)
-        except Exception as e:
-            for file in self.lock_files:
-                await asyncio.to_thread(self.unlock_file, file)
-            raise e
-        if self.after is not None:
-            self.after()
+            if self.after is not None:
+                if not shared and (self.is_dirty is None or self.is_dirty()):
+                    await self.run_hook(self.after)
+                    FileLockerMiddleware.write_stats["performed"] += 1
+                else:
+                    FileLockerMiddleware.write_stats["skipped"] += 1
+            return response
+        finally:
+            if acquiring.done():
+                self.unlock_files(held_locks)
+            else:
+                acquiring.add_done_callback(lambda _: self.unlock_files(held_locks))
+
+    async def run_hook(self, hook: Callable):
+        if self.pool is None:
+            hook()
+        else:
+            await self.pool.run_unbounded(self.run_locked, hook)
+
+    def run_locked(self, hook: Callable):
+        with self.hook_lock:
+            hook()
+
+    def lock_file(self, lock_file: ReadWriteFileLock, shared: bool) -> int:
+        fd = lock_file.acquire(shared)
+        FileLockerMiddleware.all_locks.append(fd)
+        return fd
+
+    def lock_files_into(self, held_locks: list[int], shared: bool):
         for file in self.lock_files:
-            await asyncio.to_thread(self.unlock_file, file)
-        return response
+            held_locks.append(self.lock_file(file, shared))
 
-    def lock_file(self, lock_file: filelock.FileLock):
-        lock_file.acquire()
-        FileLockerMiddleware.all_locks.append(lock_file)
+    def unlock_file(self, fd: int):
+        ReadWriteFileLock.release(fd)
+        FileLockerMiddleware.all_locks.remove(fd)
 
-    def unlock_file(self, lock_file: filelock.FileLock):
-        lock_file.release()
-        FileLockerMiddleware.all_locks.remove(lock_file)
+    def unlock_files(self, held_locks: list[int]):
+        # Releasing never blocks, so it needs no thread and cannot be
+        # interrupted by a cancellation halfway.
+        while held_locks:
+            self.unlock_file(held_locks.pop())
 
     @staticmethod
     def unlock_all():
         while len(FileLockerMiddleware.all_locks) > 0:
-            FileLockerMiddleware.all_locks.pop().release()
+            ReadWriteFileLock.release(FileLockerMiddleware.all_locks.pop())
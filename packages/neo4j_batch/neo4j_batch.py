@@ -0,0 +1,131 @@
+from neo4j import GraphDatabase, Driver, READ_ACCESS, WRITE_ACCESS
+from typing import Iterable, Iterator
+
+
+# Batched statements over the graph written by the eec Neo4J repositories:
+# (:Entity {entity_id})-[:BELONGS_TO]->(:Cluster {cluster_id}). Every
+# statement receives one batch as `$rows`.
+ENTITY_MEMBERSHIPS = """
+UNWIND $rows AS entity_id
+MATCH (entity:Entity {entity_id: entity_id})
+OPTIONAL MATCH (entity)-[:BELONGS_TO]->(cluster:Cluster)
+RETURN entity_id, cluster.cluster_id AS cluster_id
+"""
+
+EXISTING_CLUSTERS = """
+UNWIND $rows AS cluster_id
+MATCH (cluster:Cluster {cluster_id: cluster_id})
+RETURN cluster_id
+"""
+
+ADD_ENTITIES_TO_CLUSTERS = """
+UNWIND $rows AS row
+MATCH (entity:Entity {entity_id: row.entity_id})
+MATCH (cluster:Cluster {cluster_id: row.cluster_id})
+WHERE NOT (entity)-[:BELONGS_TO]->(:Cluster)
+CREATE (entity)-[:BELONGS_TO]->(cluster)
+RETURN entity.entity_id AS entity_id
+"""
+
+REMOVE_ENTITIES_FROM_CLUSTERS = """
+UNWIND $rows AS entity_id
+MATCH (entity:Entity {entity_id: entity_id})-[membership:BELONGS_TO]->(:Cluster)
+DELETE membership
+RETURN entity_id
+"""
+
+CREATE_ENTITIES = """
+UNWIND $rows AS row
+OPTIONAL MATCH (existing:Entity {entity_id: row.entity_id})
+WITH row WHERE existing IS NULL
+CREATE (entity:Entity)
+SET entity = row
+RETURN entity.entity_id AS entity_id
+"""
+
+DELETE_UNLABELED_ENTITIES = """
+UNWIND $rows AS entity_id
+MATCH (entity:Entity {entity_id: entity_id})
+WHERE NOT (entity)-[:BELONGS_TO]->(:Cluster)
+DETACH DELETE entity
+"""
+
+ENTITIES_BY_SOURCE_IDS = """
+UNWIND $rows AS row
+MATCH (entity:Entity {entity_source: row.entity_source, entity_source_id: row.entity_source_id})
+RETURN row.entity_source AS entity_source, row.entity_source_id AS entity_source_id,
+       entity.entity_id AS entity_id
+"""
+
+DELETE_CLUSTERS = """
+UNWIND $rows AS cluster_id
+MATCH (cluster:Cluster {cluster_id: cluster_id})
+DETACH DELETE cluster
+"""
+
+
+# Indexes behind the source lookups of the entity service. Plain indexes
+# instead of uniqueness constraints, existing graphs may hold duplicates.
+ENTITY_INDEXES = [
+    "CREATE INDEX entity_entity_source IF NOT EXISTS FOR (entity:Entity) ON (entity.entity_source)",
+    "CREATE INDEX entity_source_key IF NOT EXISTS "
+    "FOR (entity:Entity) ON (entity.entity_source, entity.entity_source_id)",
+]
+
+
+def create_driver(
+        uri: str, user: str, password: str, max_connection_pool_size: int = 100,
+        connection_acquisition_timeout: float = 60) -> Driver:
+    return GraphDatabase.driver(
+        uri, auth=(user, password),
+        max_connection_pool_size=max_connection_pool_size,
+        connection_acquisition_timeout=connection_acquisition_timeout)
+
+
+def create_indexes(driver: Driver, statements: Iterable[str], database: str = None):
+    """
+    Runs `IF NOT EXISTS` schema statements, so every start can call it.
+    """
+    with driver.session(database=database, default_access_mode=WRITE_ACCESS) as session:
+        for statement in statements:
+            session.run(statement).consume()
+
+
+def _batches(rows: list, batch_size: int) -> Iterator[list]:
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+class Neo4JBatchWriter:
+    """
+    Runs `UNWIND $rows` statements in batches of `batch_size` rows, one
+    managed transaction per batch instead of one per item. Writes go through
+    write transactions and reads through read transactions, so a cluster can
+    route reads to its followers.
+    """
+
+    def __init__(self, driver: Driver, batch_size: int = 1000, database: str = None):
+        self.driver = driver
+        self.batch_size = batch_size
+        self.database = database
+
+    @staticmethod
+    def _run(tx, query: str, rows: list) -> list[dict]:
+        return [record.data() for record in tx.run(query, rows=rows)]
+
+    def write(self, query: str, rows: Iterable) -> list[dict]:
+        records = []
+        with self.driver.session(database=self.database, default_access_mode=WRITE_ACCESS) as session:
+            for batch in _batches(list(rows), self.batch_size):
+                records.extend(session.execute_write(self._run, query, batch))
+        return records
+
+    def read(self, query: str, rows: Iterable) -> list[dict]:
+        records = []
+        with self.driver.session(database=self.database, default_access_mode=READ_ACCESS) as session:
+            for batch in _batches(list(rows), self.batch_size):
+                records.extend(session.execute_read(self._run, query, batch))
+        return records
+
+    def close(self):
+        self.driver.close()
@@ -0,0 +1,125 @@
+from pathlib import Path
+from typing import Callable
+import json
+import os
+import uuid
+
+
+class RepositoryJournal:
+    """
+    Append-only, sequence numbered log of repository mutations that lives next
+    to the JSON snapshots. The first line is a header holding the generation of
+    the snapshots and the last sequence number they already contain, every
+    following line is one mutation.
+
+    Every service keeps track of how far it has read, so after another service
+    wrote, only the new entries have to be replayed instead of decoding the
+    whole snapshot again. Compaction writes fresh snapshots and starts a new
+    generation, which tells the other services to reload them once. `ops`
+    holds the operations recorded in the current generation, so a service can
+    tell whether it is able to compact on its own, `dirty` whether this
+    process appended anything since its last read.
+
+    All methods expect the caller to hold the repository file locks.
+    """
+
+    def __init__(self, journal_file: Path, compact_after: int = 1000):
+        self.journal_file = journal_file
+        self.compact_after = compact_after
+        self.generation: str = None
+        self.last_seq: int = 0
+        self.offset: int = 0
+        self.entry_count: int = 0
+        self.ops: set[str] = set()
+        self.dirty: bool = False
+        try:
+            with open(self.journal_file, "x") as f:
+                f.write(self._header_line(uuid.uuid4().hex, 0))
+        except FileExistsError:
+            pass
+
+    @staticmethod
+    def _header_line(generation: str, base_seq: int) -> str:
+        return json.dumps({"generation": generation, "base_seq": base_seq}) + "\n"
+
+    def read(self) -> tuple[bool, list[dict]]:
+        """
+        Returns the entries this process has not seen yet. The first value is
+        True when the snapshots were compacted since the last read (or nothing
+        was read yet); the snapshots must be reloaded before applying the
+        entries in that case.
+        """
+        self.dirty = False
+        with open(self.journal_file, "rb") as f:
+            header_line = f.readline()
+            header = json.loads(header_line)
+            reset = header["generation"] != self.generation
+            if reset:
+                self.generation = header["generation"]
+                self.last_seq = header["base_seq"]
+                self.offset = len(header_line)
+                self.entry_count = 0
+                self.ops = set()
+            f.seek(self.offset)
+            data = f.read()
+
+        # Only complete lines are consumed, a partially written entry is
+        # picked up on the next read.
+        complete = data[:data.rfind(b"\n") + 1]
+        entries = []
+        for line in complete.splitlines():
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry["seq"] <= self.last_seq:
+                continue
+            entries.append(entry)
+            self.ops.add(entry["op"])
+            self.last_seq = entry["seq"]
+        self.offset += len(complete)
+        self.entry_count += len(entries)
+        return reset, entries
+
+    def append(self, op: str, **data):
+        self.append_many([(op, data)])
+
+    def append_many(self, changes: list[tuple[str, dict]]):
+        """
+        Appends several (op, data) entries with a single write and fsync.
+        """
+        if not changes:
+            return
+        lines = []
+        for op, data in changes:
+            self.last_seq += 1
+            lines.append(json.dumps({"seq": self.last_seq, "op": op, "data": data}).encode() + b"\n")
+            self.ops.add(op)
+        data = b"".join(lines)
+        with open(self.journal_file, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.offset += len(data)
+        self.entry_count += len(lines)
+        self.dirty = True
+
+    def should_compact(self) -> bool:
+        return self.entry_count >= self.compact_after
+
+    def compact(self, write_snapshots: Callable):
+        """
+        Writes the snapshots through `write_snapshots` and starts a new, empty
+        generation based on them. The in-memory repositories must already
+        contain every entry of the journal.
+        """
+        write_snapshots()
+        generation = uuid.uuid4().hex
+        header = self._header_line(generation, self.last_seq)
+        temp_path = self.journal_file.parent / (self.journal_file.name + ".tmp")
+        with open(temp_path, "w") as f:
+            f.write(header)
+        os.replace(temp_path, self.journal_file)
+        self.generation = generation
+        self.offset = len(header.encode())
+        self.entry_count = 0
+        self.ops = set()
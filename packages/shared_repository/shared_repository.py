@@ -0,0 +1,150 @@
+from pathlib import Path
+import pyarrow as pa
+import numpy as np
+import asyncio
+import fcntl
+import json
+import time
+import uuid
+import os
+
+
+class SharedTable:
+    """
+    Read-only copy of a repository that one loader process publishes for all
+    workers of a service. Metadata columns are written as an Arrow IPC file
+    and vectors as one float32 .npy matrix into `directory`, which should be
+    on tmpfs (e.g. /dev/shm); readers memory-map both, so N workers share a
+    single copy instead of holding N repositories.
+
+    Every publish writes new files and then replaces `manifest.json`, so a
+    reader always sees one consistent version. Files of the previous version
+    are kept until the next publish for readers that are just switching.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.manifest_file = self.directory / "manifest.json"
+        self.manifest: dict = None
+        self.table: pa.Table = None
+        self.vectors: np.ndarray = None
+        self._manifest_inode: int = None
+
+    @property
+    def meta(self) -> dict:
+        return self.manifest["meta"] if self.manifest is not None else None
+
+    def publish(self, columns: dict[str, list], vectors: np.ndarray = None,
+                schema: pa.Schema = None, **meta):
+        """
+        `meta` is stored in the manifest, e.g. the journal sequence number the
+        published copy includes.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = uuid.uuid4().hex
+        table = pa.table(columns, schema=schema)
+        with pa.OSFile(str(self.directory / f"{name}.arrow"), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=max(len(table), 1))
+        vectors_file = None
+        if vectors is not None:
+            vectors_file = f"{name}.npy"
+            np.save(self.directory / vectors_file, np.asarray(vectors, dtype=np.float32))
+
+        previous = self._read_manifest()
+        manifest = {"table": f"{name}.arrow", "vectors": vectors_file,
+                    "published": time.time(), "meta": meta}
+        temp_path = self.directory / "manifest.json.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self.manifest_file)
+
+        keep = {manifest["table"], manifest["vectors"]}
+        if previous is not None:
+            keep |= {previous["table"], previous["vectors"]}
+        for path in self.directory.glob("*"):
+            if path.suffix in (".arrow", ".npy") and path.name not in keep:
+                path.unlink(missing_ok=True)
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def refresh(self) -> bool:
+        """
+        Maps the latest published version if it changed since the last call.
+        Costs a single stat otherwise. Returns whether a version is available.
+        """
+        for _ in range(3):
+            try:
+                inode = os.stat(self.manifest_file).st_ino
+            except FileNotFoundError:
+                return self.manifest is not None
+            if inode == self._manifest_inode:
+                return True
+            try:
+                manifest = self._read_manifest()
+                # The buffers of the table point into the map, it stays open
+                source = pa.memory_map(str(self.directory / manifest["table"]), "r")
+                table = pa.ipc.open_file(source).read_all()
+                vectors = None
+                if manifest["vectors"] is not None:
+                    vectors = np.load(self.directory / manifest["vectors"], mmap_mode="r")
+            # A publish in between may already have removed the files
+            except (FileNotFoundError, TypeError):
+                continue
+            self.manifest, self.table, self.vectors = manifest, table, vectors
+            self._manifest_inode = inode
+            return True
+        return self.manifest is not None
+
+    async def wait(self, key: str, value, timeout: float, interval: float = 0.01) -> bool:
+        """
+        Waits until a published version has `meta[key] >= value`, e.g. until
+        the loader applied a journal entry this worker appended.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.refresh() and self.meta.get(key) is not None and self.meta[key] >= value:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+
+
+class LoaderLock:
+    """
+    Non-blocking flock that elects the loader among the workers of a service.
+    The lock is held until the process exits, another worker takes over on
+    its next attempt.
+    """
+
+    def __init__(self, lock_file: Path):
+        self.lock_file = Path(lock_file)
+        self.fd: int = None
+
+    @property
+    def held(self) -> bool:
+        return self.fd is not None
+
+    def try_acquire(self) -> bool:
+        if self.fd is not None:
+            return True
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,181 @@
+from pathlib import Path
+import numpy as np
+import argparse
+import json
+import uuid
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Version 1 files are the bare `encode()` output of a repository, version 2
+# wraps it in {"format_version", "codec", "data"}, version 3 adds the columnar
+# layout whose vectors live in a separate .npy file.
+FORMAT_VERSION = 3
+LAYOUTS = ("json", "columnar")
+VECTOR_REF = "__vector__"
+# Fields of the repositories' `encode()` output moved out by the columnar layout
+VECTOR_FIELDS = ("mention_vector", "cluster_vector")
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    name = "json"
+
+    def dumps(self, data) -> bytes:
+        return json.dumps(data, default=_default).encode()
+
+    def loads(self, raw: bytes):
+        return json.loads(raw)
+
+
+class OrjsonCodec:
+    """
+    Serializes NumPy arrays (mention and cluster vectors) natively instead of
+    going through Python float lists.
+    """
+    name = "orjson"
+
+    def dumps(self, data) -> bytes:
+        return orjson.dumps(
+            data, default=_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, raw: bytes):
+        return orjson.loads(raw)
+
+
+CODECS = {"json": JsonCodec}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec
+
+
+def get_codec(name: str = "auto"):
+    """
+    `auto` picks orjson when it is installed and falls back to the stdlib.
+    """
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name not in CODECS:
+        raise ValueError(f"Unknown or unavailable snapshot codec: {name}")
+    return CODECS[name]()
+
+
+def _vector_size(value) -> int:
+    if isinstance(value, np.ndarray):
+        if value.ndim == 1 and len(value) > 0 and np.issubdtype(value.dtype, np.floating):
+            return len(value)
+    elif isinstance(value, list) and len(value) > 0 and all(type(item) is float for item in value):
+        return len(value)
+    return 0
+
+
+def _extract_vectors(data, vectors: list):
+    # Only the VECTOR_FIELDS are moved, all of the first vector's size; other
+    # values of these fields (None, empty or differently sized) stay inline.
+    if isinstance(data, dict):
+        extracted = {}
+        for key, value in data.items():
+            size = _vector_size(value) if key in VECTOR_FIELDS else 0
+            if size and (not vectors or size == len(vectors[0])):
+                vectors.append(value)
+                extracted[key] = {VECTOR_REF: len(vectors) - 1}
+            else:
+                extracted[key] = _extract_vectors(value, vectors)
+        return extracted
+    if isinstance(data, list):
+        return [_extract_vectors(value, vectors) for value in data]
+    return data
+
+
+def _restore_vectors(data, vectors: list):
+    if isinstance(data, dict):
+        if len(data) == 1 and VECTOR_REF in data:
+            return vectors[data[VECTOR_REF]]
+        return {key: _restore_vectors(value, vectors) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_restore_vectors(value, vectors) for value in data]
+    return data
+
+
+def write_snapshot(path: Path, data, codec=None, layout: str = "json"):
+    """
+    Atomically replaces `path` with `data` wrapped in a versioned envelope.
+
+    With the `columnar` layout the values of the VECTOR_FIELDS (the mention
+    and cluster vectors) are stored as one float32 matrix in a .npy file next
+    to `path` and replaced by references, so `path` only holds the metadata.
+    Snapshots without vectors are always written as JSON.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown snapshot layout: {layout}")
+    codec = codec or get_codec()
+    envelope = {"format_version": 2, "codec": codec.name}
+    vectors_name = None
+    vectors = []
+    if layout == "columnar":
+        data = _extract_vectors(data, vectors)
+    if vectors:
+        # A new name for every write, readers may still hold the previous file
+        vectors_name = f"{path.name}.{uuid.uuid4().hex}.npy"
+        np.save(path.parent / vectors_name, np.stack(vectors).astype(np.float32))
+        envelope = {"format_version": 3, "codec": codec.name, "layout": "columnar", "vectors": vectors_name}
+    envelope["data"] = data
+
+    temp_path = path.parent / (path.name + ".tmp")
+    with open(temp_path, "wb") as f:
+        f.write(codec.dumps(envelope))
+    os.replace(temp_path, path)
+    for old_vectors in path.parent.glob(f"{path.name}.*.npy"):
+        if old_vectors.name != vectors_name:
+            old_vectors.unlink(missing_ok=True)
+
+
+def read_snapshot(path: Path, codec=None):
+    """
+    Returns the repository data of a snapshot of any known format version and
+    layout. Both codecs write JSON, so any of them reads files written by the
+    other. Vectors of the columnar layout are returned as float lists, the
+    same as the JSON layout would give the repositories' `decode`.
+    """
+    codec = codec or get_codec()
+    with open(path, "rb") as f:
+        document = codec.loads(f.read())
+    if isinstance(document, dict) and "format_version" in document:
+        if document["format_version"] > FORMAT_VERSION:
+            raise ValueError(
+                f"{path} has snapshot format version {document['format_version']}, "
+                f"only versions up to {FORMAT_VERSION} are supported")
+        if document.get("layout") == "columnar":
+            vectors = np.load(path.parent / document["vectors"]).tolist()
+            return _restore_vectors(document["data"], vectors)
+        return document["data"]
+    return document
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts repository snapshots between layouts")
+    parser.add_argument("files", nargs="+", type=Path, help="Snapshot files, e.g. data/entity_repository.json")
+    parser.add_argument("--layout", choices=LAYOUTS, required=True)
+    parser.add_argument("--codec", default="auto")
+    args = parser.parse_args()
+
+    codec = get_codec(args.codec)
+    for path in args.files:
+        data = read_snapshot(path, codec)
+        write_snapshot(path, data, codec, layout=args.layout)
+        print(f"{path}: converted to {args.layout}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+from typing import Iterable
+import random
+
+
+class UnlabeledIndex:
+    """
+    Ids of the entities that are not in a cluster yet, kept in a list plus a
+    map of their positions. Removing an id moves the last one into its slot,
+    so adding and removing are O(1) and sampling k ids is O(k) no matter how
+    far labeling has progressed.
+    """
+
+    def __init__(self, entity_ids: Iterable[str] = ()):
+        self.ids: list[str] = []
+        self.positions: dict[str, int] = {}
+        self.build(entity_ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self.positions
+
+    def build(self, entity_ids: Iterable[str]):
+        self.ids = list(dict.fromkeys(entity_ids))
+        self.positions = {entity_id: position for position, entity_id in enumerate(self.ids)}
+
+    def add(self, entity_id: str):
+        if entity_id not in self.positions:
+            self.positions[entity_id] = len(self.ids)
+            self.ids.append(entity_id)
+
+    def discard(self, entity_id: str):
+        position = self.positions.pop(entity_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if last != entity_id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def set(self, entity_id: str, unlabeled: bool):
+        if unlabeled:
+            self.add(entity_id)
+        else:
+            self.discard(entity_id)
+
+    def sample(self, k: int) -> list[str]:
+        """
+        Up to `k` distinct ids, fewer if not as many entities are unlabeled.
+        """
+        return random.sample(self.ids, min(k, len(self.ids)))
+
+
+def changed_entity_ids(op: str, data: dict) -> list[str]:
+    """
+    Entities whose labeled state a journal operation may have changed.
+    """
+    if op == "add_entities":
+        return [entity["entity_id"] for entity in data["entities"]]
+    if op == "delete_entities":
+        return data["entity_ids"]
+    if op in ("add_entity_to_cluster", "remove_entity_from_cluster"):
+        return [data["entity_id"]]
+    if op == "delete_clusters":
+        return data["entity_ids"]
+    return []
@@ -0,0 +1,209 @@
+from gensim.models import KeyedVectors
+from pathlib import Path
+import numpy as np
+import threading
+import hashlib
+import fcntl
+import json
+import os
+
+
+class VectorStore:
+    """
+    Keeps one memory-mapped KeyedVectors instance per model file for the
+    whole process. Vector arrays saved next to the model (`*.vectors.npy`)
+    are opened read-only with mmap, so every worker and container reading
+    the same file shares the OS page cache instead of holding its own copy.
+    """
+
+    models: dict[str, KeyedVectors] = {}
+    fingerprints: dict[str, str] = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(model_file: Path) -> KeyedVectors:
+        key = str(Path(model_file).resolve())
+        with VectorStore.lock:
+            model = VectorStore.models.get(key)
+            if model is None:
+                model = KeyedVectors.load(key, mmap='r')
+                VectorStore.models[key] = model
+        return model
+
+    @staticmethod
+    def fingerprint(model_file: Path) -> str:
+        """
+        Short hash identifying the vectors of a model: its shape, vocabulary
+        and a sample of its rows. Cheap enough to compute on every start.
+        """
+        key = str(Path(model_file).resolve())
+        with VectorStore.lock:
+            fingerprint = VectorStore.fingerprints.get(key)
+        if fingerprint is not None:
+            return fingerprint
+        model = VectorStore.get(model_file)
+        digest = hashlib.sha1()
+        digest.update(f"{model.vectors.shape}".encode())
+        digest.update("\n".join(model.index_to_key).encode())
+        for row in np.linspace(0, len(model.vectors) - 1, num=min(64, len(model.vectors)), dtype=int):
+            digest.update(np.asarray(model.vectors[row], dtype=np.float32).tobytes())
+        fingerprint = digest.hexdigest()[:16]
+        with VectorStore.lock:
+            VectorStore.fingerprints[key] = fingerprint
+        return fingerprint
+
+    @staticmethod
+    def prepare(model_file: Path, output_file: Path):
+        """
+        Re-saves a model so that all of its arrays are stored as separate
+        `.npy` files, which is required for them to be memory-mapped.
+        """
+        model = KeyedVectors.load(str(model_file))
+        model.save(str(output_file), sep_limit=0)
+
+    @staticmethod
+    def clear():
+        with VectorStore.lock:
+            VectorStore.models.clear()
+            VectorStore.fingerprints.clear()
+
+
+class MentionVectorCache:
+    """
+    Persistent mention -> mention vector cache for one model fingerprint,
+    stored append-only in `cache_dir` as `<fingerprint>.f32` (raw float32
+    rows of `dim` values, memory-mapped) and `<fingerprint>.jsonl` (one JSON
+    encoded mention per row). New vectors stay in memory until `save`, which
+    appends only them to both files; concurrent saves are serialized with a
+    lock file. A row counts once its mention line is written, rows without one
+    are left over from an interrupted save and overwritten by the next.
+    """
+
+    def __init__(self, cache_dir: Path, fingerprint: str, dim: int):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.dim = dim
+        self.keys: dict[str, int] = {}
+        self.rows: int = 0
+        # Bytes of the mentions file read so far
+        self.keys_offset: int = 0
+        self.matrix: np.ndarray = None
+        self.pending: dict[str, np.ndarray] = {}
+        self.load()
+
+    @property
+    def matrix_file(self) -> Path:
+        return self.cache_dir / f"{self.fingerprint}.f32"
+
+    @property
+    def keys_file(self) -> Path:
+        return self.cache_dir / f"{self.fingerprint}.jsonl"
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float32).itemsize
+
+    def load(self):
+        """
+        Reads the mentions appended since the last call and maps the rows.
+        Runs without the lock file, so only mentions whose rows are already
+        complete in the matrix file are taken; the rest are read next time.
+        """
+        if not self.keys_file.exists() or not self.matrix_file.exists():
+            return
+        with open(self.keys_file, "rb") as f:
+            f.seek(self.keys_offset)
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if not complete:
+            return
+        lines = complete.splitlines(keepends=True)
+        available = self.matrix_file.stat().st_size // self.row_bytes
+        lines = lines[:max(available - self.rows, 0)]
+        if not lines:
+            return
+        for line in lines:
+            self.keys.setdefault(json.loads(line), self.rows)
+            self.rows += 1
+            self.keys_offset += len(line)
+        self.matrix = np.memmap(self.matrix_file, dtype=np.float32, mode="r", shape=(self.rows, self.dim))
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.pending)
+
+    def get(self, mention: str) -> np.ndarray:
+        vector = self.pending.get(mention)
+        if vector is not None:
+            return vector
+        row = self.keys.get(mention)
+        if row is None:
+            return None
+        return self.matrix[row]
+
+    def put(self, mention: str, vector):
+        if mention not in self.keys:
+            self.pending[mention] = np.asarray(vector, dtype=np.float32)
+
+    def save(self):
+        if not self.pending:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / f"{self.fingerprint}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.load()
+            pending, self.pending = self.pending, {}
+            pending = {
+                mention: vector for mention, vector in pending.items()
+                if mention not in self.keys and vector.shape == (self.dim,)
+            }
+            if not pending:
+                return
+            with open(self.matrix_file, "ab") as f:
+                # Drops the rows of an interrupted save
+                f.truncate(self.rows * self.row_bytes)
+                f.write(np.stack(list(pending.values())).astype(np.float32, copy=False).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.keys_file, "ab") as f:
+                f.write("".join(json.dumps(mention) + "\n" for mention in pending).encode())
+                f.flush()
+                os.fsync(f.fileno())
+            self.load()
+
+
+class CachedKeyedVectors:
+    """
+    Wraps KeyedVectors so that mean vectors of whole mentions, which the
+    repositories derive for every entity they add or decode, are looked up in
+    a MentionVectorCache instead of being averaged again. Everything else is
+    passed through to the wrapped model.
+    """
+
+    def __init__(self, keyed_vectors: KeyedVectors, cache: MentionVectorCache):
+        self.keyed_vectors = keyed_vectors
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.keyed_vectors, name)
+
+    def __getitem__(self, key):
+        return self.keyed_vectors[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.keyed_vectors
+
+    def __len__(self) -> int:
+        return len(self.keyed_vectors)
+
+    def get_mean_vector(self, keys, *args, **kwargs):
+        if isinstance(keys, str) or args or kwargs:
+            return self.keyed_vectors.get_mean_vector(keys, *args, **kwargs)
+        keys = list(keys)
+        if not all(isinstance(key, str) for key in keys):
+            return self.keyed_vectors.get_mean_vector(keys, *args, **kwargs)
+        mention = " ".join(keys)
+        vector = self.cache.get(mention)
+        if vector is None:
+            vector = self.keyed_vectors.get_mean_vector(keys)
+            self.cache.put(mention, vector)
+        return vector
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import functools
+import asyncio
+
+
+class PoolFullException(Exception):
+
+    def __init__(self, name: str):
+        super().__init__(f"Worker pool {name} is full")
+        self.name = name
+
+
+class WorkerPool:
+    """
+    Bounded thread pool for the blocking and CPU heavy parts of async
+    endpoints (repository scans, snapshot encoding, bcrypt, vector math), so
+    they overlap with other requests instead of stalling the event loop.
+
+    At most `max_workers` calls run at once, further calls wait in the queue.
+    With `max_queue` set, calls that would exceed it are rejected with a
+    PoolFullException instead of piling up. Counters are only touched from the
+    event loop; every pool registers itself under its name for `/metrics`.
+    """
+
+    pools: dict[str, "WorkerPool"] = {}
+
+    def __init__(self, name: str, max_workers: int, max_queue: int = 0):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.pending = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.rejected = 0
+        WorkerPool.pools[name] = self
+
+    @property
+    def active(self) -> int:
+        return min(self.pending, self.max_workers)
+
+    @property
+    def queued(self) -> int:
+        return self.pending - self.active
+
+    async def run(self, func: Callable, *args, **kwargs):
+        if self.max_queue > 0 and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise PoolFullException(self.name)
+        return await self.run_unbounded(func, *args, **kwargs)
+
+    async def run_unbounded(self, func: Callable, *args, **kwargs):
+        """
+        Queues the call even when the queue is full, for work that must not
+        be rejected halfway through a request (e.g. the file lock hooks).
+        """
+        self.pending += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "active": self.active,
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        WorkerPool.pools.pop(self.name, None)
+
+    @staticmethod
+    def all_stats() -> dict:
+        return {name: pool.stats() for name, pool in WorkerPool.pools.items()}
@@ -1,17 +1,19 @@
-from models import Token, AuthenticatedUser
+from models import Token, AuthenticatedUser, ActiveUsers
 
 from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, SecurityScopes
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from file_locker_middleware import FileLockerMiddleware
+from worker_pool import WorkerPool, PoolFullException
+from snapshot_codec import get_codec, read_snapshot, write_snapshot
 from eec.core.abstract.user_repository import IUserRepository
 from eec import BaseUserRepository, Neo4JHelper, Neo4JUserRepository, UserModel, NotFoundException
 from dotenv import load_dotenv
 from pathlib import Path
 import os
-import json
 import logging
 
 load_dotenv()
@@ -19,13 +21,21 @@ load_dotenv()
 DATA_PATH = Path(os.getenv("DATA_PATH") or "data")
 LOGGER_PATH = Path(os.getenv("LOGGER_PATH") or "logs")
 SYSTEM_TYPE = os.getenv("SYSTEM_TYPE") or "base"
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC") or "auto"
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REPOSITORY_POOL_SIZE = int(os.getenv("REPOSITORY_POOL_SIZE") or 8)
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE") or os.cpu_count() or 4)
+POOL_QUEUE_SIZE = int(os.getenv("POOL_QUEUE_SIZE") or 256)
 user_repository: IUserRepository = None
 last_user_repository_update: float = None
 
+snapshot_codec = get_codec(SNAPSHOT_CODEC)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt releases the GIL, so logins verified on the cpu pool run in parallel
+repository_pool = WorkerPool("repository", REPOSITORY_POOL_SIZE, POOL_QUEUE_SIZE)
+cpu_pool = WorkerPool("cpu", CPU_POOL_SIZE, POOL_QUEUE_SIZE)
 
 o_auth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/api/v1/auth/login",
@@ -57,8 +67,7 @@ def read_base_user_repository():
             print("User repository not found. Creating new one.")
             user_repository = BaseUserRepository()
             return
-        with open(USER_DATA_PATH, "r") as f:
-            user_repository = BaseUserRepository.decode(json.load(f))
+        user_repository = BaseUserRepository.decode(read_snapshot(USER_DATA_PATH, snapshot_codec))
         last_user_repository_update = USER_DATA_PATH.stat().st_mtime
 
 
@@ -66,10 +75,7 @@ def write_base_user_repository():
     global user_repository, last_user_repository_update, DATA_PATH
     USER_DATA_PATH = DATA_PATH / "user_repository.json"
 
-    temp_path = USER_DATA_PATH.parent / (USER_DATA_PATH.name + ".tmp")
-    with open(temp_path, "w") as f:
-        json.dump(user_repository.encode(), f)
-    os.replace(temp_path, USER_DATA_PATH)
+    write_snapshot(USER_DATA_PATH, user_repository.encode(), snapshot_codec)
     last_user_repository_update = USER_DATA_PATH.stat().st_mtime
 
 
@@ -81,7 +87,12 @@ app = FastAPI(
 if SYSTEM_TYPE == "base":
     app.add_middleware(FileLockerMiddleware,
                        files_to_lock=[],
-                       before=read_base_user_repository)
+                       before=read_base_user_repository, pool=repository_pool)
+
+
+@app.exception_handler(PoolFullException)
+async def pool_full_handler(request: Request, exc: PoolFullException):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
 
 @app.on_event("startup")
@@ -108,6 +119,12 @@ async def startup_event():
             write_base_user_repository()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    repository_pool.shutdown()
+    cpu_pool.shutdown()
+
+
 # To test the connecton between the service and the database
 @app.get("/")
 def handshake():
@@ -134,7 +151,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    if not pwd_context.verify(form_data.password, user.hashed_password):
+    if not await cpu_pool.run(pwd_context.verify, form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -157,7 +174,7 @@ async def verify(request: Request, token: str = Depends(o_auth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        scopes: list[str] = payload.get("scopes")
+        scopes: list[str] = payload.get("scopes") or []
         exp: float = payload.get("exp")
         if exp is None or exp < datetime.utcnow().timestamp():
             raise HTTPException(
@@ -166,6 +183,14 @@ async def verify(request: Request, token: str = Depends(o_auth2_scheme)):
                 headers={"WWW-Authenticate": "Bearer"},
             )
 
+        # Service tokens are only good for /verify/users, not as a user
+        if payload.get("typ") == "service":
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="User token required",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
         if not user_repository.username_exists(username):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -184,6 +209,48 @@ async def verify(request: Request, token: str = Depends(o_auth2_scheme)):
     return AuthenticatedUser(user_id=user_id, username=username, scopes=scopes)
 
 
+# Bulk user lookup for services verifying tokens locally (AUTH_MODE=local),
+# only accepts service tokens signed with SECRET_KEY.
+@app.get("/verify/users", response_model=ActiveUsers, tags=["auth"])
+async def verify_users(token: str = Depends(o_auth2_scheme)):
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if payload.get("typ") != "service":
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Service token required",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    users = await repository_pool.run(user_repository.get_all_users)
+    return ActiveUsers(users={user.username: user.user_id for user in users})
+
+
+@app.get("/metrics")
+async def get_metrics(token: str = Depends(o_auth2_scheme)):
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if "admin" not in (payload.get("scopes") or []):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return {
+        "repository_writes": FileLockerMiddleware.write_stats,
+        "pools": WorkerPool.all_stats()
+    }
+
+
 if __name__ == "__main__":
     print("only debug")
     logging.basicConfig(level=logging.DEBUG)
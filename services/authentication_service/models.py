@@ -10,3 +10,7 @@ class AuthenticatedUser(BaseModel):
     user_id: str
     username: str
     scopes: list[str]
+
+
+class ActiveUsers(BaseModel):
+    users: dict[str, str]
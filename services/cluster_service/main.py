@@ -1,12 +1,21 @@
 from models import ClusterAddEntityIn, ClusterIn, \
-    ClusterOut, DeleteClustersIn
+    ClusterOut, DeleteClustersIn, AssignmentsIn, AssignmentResult, AssignmentsOut
 
 from fastapi import FastAPI, Depends, HTTPException,\
-    status, Request, Security
+    status, Request, Security, Query
 from fastapi.security import OAuth2PasswordBearer,\
     OAuth2PasswordRequestForm, SecurityScopes
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from file_locker_middleware import FileLockerMiddleware
+from worker_pool import WorkerPool, PoolFullException
+from auth_client import AuthClient, LocalAuthClient, check_scopes
+from vector_store import VectorStore, MentionVectorCache, CachedKeyedVectors
+from snapshot_codec import get_codec, read_snapshot, write_snapshot
+from repository_journal import RepositoryJournal
+from export_stream import arrow_schema, gzipped, stream_arrow, stream_csv, stream_parquet
+from centroid_tracker import CentroidTracker, TrackedClusterRepository
+from neo4j_batch import Neo4JBatchWriter, create_driver, ENTITY_MEMBERSHIPS, EXISTING_CLUSTERS,\
+    ADD_ENTITIES_TO_CLUSTERS, REMOVE_ENTITIES_FROM_CLUSTERS, DELETE_CLUSTERS
 from eec.core.abstract.entity_repository import IEntityRepository
 from eec.core.abstract.cluster_repository import IClusterRepository
 from eec import BaseEntityRepository, Neo4JEntityRepository,\
@@ -14,39 +23,83 @@ from eec import BaseEntityRepository, Neo4JEntityRepository,\
     EntityModel, ClusterModel, NotFoundException, AlreadyExistsException, AlreadyInClusterException
 from dotenv import load_dotenv
 from pathlib import Path
+from typing import Optional
+import numpy as np
 import os
-import json
 import logging
-from gensim.models import KeyedVectors
-import pandas as pd
-import httpx
 
 load_dotenv()
 
 DATA_PATH = Path(os.getenv("DATA_PATH") or "data")
 LOGGER_PATH = Path(os.getenv("LOGGER_PATH") or "logs")
 SYSTEM_TYPE = os.getenv("SYSTEM_TYPE") or "base"
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC") or "auto"
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT") or "json"
 WORD2VEC_FILE = Path(os.getenv("WORD2VEC_FILE") or "/data/word2vec.model")
+MENTION_VECTOR_CACHE_PATH = Path(os.getenv("MENTION_VECTOR_CACHE_PATH") or DATA_PATH / "mention_vector_cache")
 
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL") or "http://eec.localhost/api/v1/auth"
-
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE") or 1024)
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL") or 60)
+AUTH_MODE = os.getenv("AUTH_MODE") or "remote"
+AUTH_USERS_REFRESH = float(os.getenv("AUTH_USERS_REFRESH") or 30)
+SECRET_KEY = os.getenv("SECRET_KEY")
+JOURNAL_COMPACT_AFTER = int(os.getenv("JOURNAL_COMPACT_AFTER") or 1000)
+CENTROID_RECOMPUTE_AFTER = int(os.getenv("CENTROID_RECOMPUTE_AFTER") or 1000)
+NEO4J_BATCH_SIZE = int(os.getenv("NEO4J_BATCH_SIZE") or 0)
+NEO4J_POOL_SIZE = int(os.getenv("NEO4J_POOL_SIZE") or 100)
+NEO4J_ACQUIRE_TIMEOUT = float(os.getenv("NEO4J_ACQUIRE_TIMEOUT") or 60)
+REPOSITORY_POOL_SIZE = int(os.getenv("REPOSITORY_POOL_SIZE") or 8)
+POOL_QUEUE_SIZE = int(os.getenv("POOL_QUEUE_SIZE") or 256)
+RESPONSE_ENCODER = os.getenv("RESPONSE_ENCODER") or "pydantic"
+
+# Fields a ClusterOut can be projected to, all but the member count by default
+CLUSTER_FIELDS = ("cluster_name", "entity_ids", "entity_count", "cluster_vector")
+DEFAULT_CLUSTER_FIELDS = frozenset(("cluster_name", "entity_ids", "cluster_vector"))
+
+CLUSTER_EXPORT_COLUMNS = {
+    'cluster_id': 'string',
+    'cluster_name': 'string',
+    'entity_ids': 'string_list',
+    'cluster_vector': 'vector'
+}
 
 entity_repository: IEntityRepository = None
 cluster_repository: IClusterRepository = None
-last_entity_repository_update: float = None
-last_cluster_repository_update: float = None
+repository_journal: RepositoryJournal = None
+mention_vector_cache: MentionVectorCache = None
+centroid_tracker: CentroidTracker = None
+neo4j_batch_writer: Neo4JBatchWriter = None
+snapshot_codec = get_codec(SNAPSHOT_CODEC)
+# Scans over all clusters, bulk assignments and the file lock hooks run here
+# instead of on the event loop, lookups of single clusters stay on the loop.
+repository_pool = WorkerPool("repository", REPOSITORY_POOL_SIZE, POOL_QUEUE_SIZE)
 o_auth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/api/v1/auth/login",
     scopes={"admin": "Admin access", "editor": "Editor access", "export": "Export access"})
 
+if AUTH_MODE == "local":
+    auth_client = LocalAuthClient(AUTH_SERVICE_URL, secret_key=SECRET_KEY,
+                                  refresh_interval=AUTH_USERS_REFRESH)
+else:
+    auth_client = AuthClient(AUTH_SERVICE_URL, cache_size=AUTH_CACHE_SIZE, cache_ttl=AUTH_CACHE_TTL)
+
 
 def get_word2vec_model():
     global WORD2VEC_FILE
-    return KeyedVectors.load(str(WORD2VEC_FILE))
+    return VectorStore.get(WORD2VEC_FILE)
+
+
+def get_mention_vectors() -> CachedKeyedVectors:
+    global mention_vector_cache
+    if mention_vector_cache is None:
+        mention_vector_cache = MentionVectorCache(
+            MENTION_VECTOR_CACHE_PATH, VectorStore.fingerprint(WORD2VEC_FILE), get_word2vec_model().vector_size)
+    return CachedKeyedVectors(get_word2vec_model(), mention_vector_cache)
 
 
 def neo4j_repositories():
-    global entity_repository, cluster_repository
+    global entity_repository, cluster_repository, neo4j_batch_writer
 
     NEO4J_URI = os.getenv("NEO4J_URI")
     NEO4J_USER = os.getenv("NEO4J_USER")
@@ -64,68 +117,60 @@ def neo4j_repositories():
     cluster_repository = Neo4JClusterRepository(
         entity_repository=entity_repository
     )
+    if NEO4J_BATCH_SIZE > 0:
+        neo4j_batch_writer = Neo4JBatchWriter(
+            create_driver(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD,
+                          max_connection_pool_size=NEO4J_POOL_SIZE,
+                          connection_acquisition_timeout=NEO4J_ACQUIRE_TIMEOUT),
+            batch_size=NEO4J_BATCH_SIZE)
 
 
 def read_base_entity_repository():
-    global entity_repository, last_entity_repository_update, DATA_PATH
+    global entity_repository, DATA_PATH
     ENTITY_DATA_PATH = DATA_PATH / "entity_repository.json"
 
-    if entity_repository is None or last_entity_repository_update is None or last_entity_repository_update < ENTITY_DATA_PATH.stat().st_mtime:
-        if not ENTITY_DATA_PATH.exists():
-            print("Entity repository not found. Creating new one.")
-            entity_repository = BaseEntityRepository(
-                entities=[],
-                last_id=0,
-                keyed_vectors=get_word2vec_model()
-            )
-            return
-        with open(ENTITY_DATA_PATH, "r") as f:
-            entity_repository = BaseEntityRepository.decode(
-                json.load(f), keyed_vectors=get_word2vec_model())
-        last_entity_repository_update = ENTITY_DATA_PATH.stat().st_mtime
+    if not ENTITY_DATA_PATH.exists():
+        print("Entity repository not found. Creating new one.")
+        entity_repository = BaseEntityRepository(
+            entities=[],
+            last_id=0,
+            keyed_vectors=get_mention_vectors()
+        )
+        return
+    entity_repository = BaseEntityRepository.decode(
+        read_snapshot(ENTITY_DATA_PATH, snapshot_codec), keyed_vectors=get_mention_vectors())
 
 
 def write_base_entity_repository():
-    global entity_repository, last_entity_repository_update, DATA_PATH
+    global entity_repository, DATA_PATH
     ENTITY_DATA_PATH = DATA_PATH / "entity_repository.json"
 
-    temp_path = ENTITY_DATA_PATH.parent / (ENTITY_DATA_PATH.name + ".tmp")
-    with open(temp_path, "w") as f:
-        json.dump(entity_repository.encode(), f)
-    os.replace(temp_path, ENTITY_DATA_PATH)
-    last_entity_repository_update = ENTITY_DATA_PATH.stat().st_mtime
+    write_snapshot(ENTITY_DATA_PATH, entity_repository.encode(), snapshot_codec, layout=SNAPSHOT_FORMAT)
 
 
 def read_base_cluster_repository():
-    global cluster_repository, entity_repository, last_cluster_repository_update, DATA_PATH
+    global cluster_repository, entity_repository, DATA_PATH
     CLUSTER_DATA_PATH = DATA_PATH / "cluster_repository.json"
 
-    if cluster_repository is None or last_cluster_repository_update is None or last_cluster_repository_update < CLUSTER_DATA_PATH.stat().st_mtime:
-        if not CLUSTER_DATA_PATH.exists():
-            print("Cluster repository not found. Creating new one.")
-            cluster_repository = BaseClusterRepository(
-                entity_repository=entity_repository,
-                clusters=[],
-                last_cluster_id=0
-            )
-            return
-        with open(CLUSTER_DATA_PATH, "r") as f:
-            cluster_repository = BaseClusterRepository.decode(
-                entity_repository=entity_repository,
-                cluster_repository_dict=json.load(f)
-            )
-        last_cluster_repository_update = CLUSTER_DATA_PATH.stat().st_mtime
+    if not CLUSTER_DATA_PATH.exists():
+        print("Cluster repository not found. Creating new one.")
+        cluster_repository = BaseClusterRepository(
+            entity_repository=entity_repository,
+            clusters=[],
+            last_cluster_id=0
+        )
+        return
+    cluster_repository = BaseClusterRepository.decode(
+        entity_repository=entity_repository,
+        cluster_repository_dict=read_snapshot(CLUSTER_DATA_PATH, snapshot_codec)
+    )
 
 
 def write_base_cluster_repository():
-    global cluster_repository, last_cluster_repository_update, DATA_PATH
+    global cluster_repository, DATA_PATH
     CLUSTER_DATA_PATH = DATA_PATH / "cluster_repository.json"
 
-    temp_path = CLUSTER_DATA_PATH.parent / (CLUSTER_DATA_PATH.name + ".tmp")
-    with open(temp_path, "w") as f:
-        json.dump(cluster_repository.encode(), f)
-    os.replace(temp_path, CLUSTER_DATA_PATH)
-    last_cluster_repository_update = CLUSTER_DATA_PATH.stat().st_mtime
+    write_snapshot(CLUSTER_DATA_PATH, cluster_repository.encode(), snapshot_codec, layout=SNAPSHOT_FORMAT)
 
 
 def read_base_repositories():
@@ -138,6 +183,126 @@ def write_base_repositories():
     write_base_cluster_repository()
 
 
+def sync_base_repositories():
+    global cluster_repository, centroid_tracker
+    reset, entries = repository_journal.read()
+    if reset:
+        read_base_repositories()
+        centroid_tracker = CentroidTracker(
+            dim=get_word2vec_model().vector_size, recompute_after=CENTROID_RECOMPUTE_AFTER)
+        cluster_repository = TrackedClusterRepository(cluster_repository, entity_repository, centroid_tracker)
+    for entry in entries:
+        apply_journal_entry(entry)
+    mention_vector_cache.save()
+
+
+def compact_base_repositories():
+    if repository_journal.should_compact():
+        repository_journal.compact(write_base_repositories)
+
+
+def base_repositories_dirty() -> bool:
+    return repository_journal.dirty
+
+
+def journal_change(op: str, **data):
+    if repository_journal is not None:
+        repository_journal.append(op, **data)
+        track_centroid_change(op, data)
+
+
+def journal_changes(changes: list[tuple[str, dict]]):
+    if repository_journal is not None:
+        repository_journal.append_many(changes)
+        for op, data in changes:
+            track_centroid_change(op, data)
+
+
+def track_centroid_change(op: str, data: dict):
+    # Called after the change was applied to the repositories. Members are
+    # added and removed through the TrackedClusterRepository, which already
+    # moved the running sums.
+    if op == "add_cluster":
+        centroid_tracker.set(data["cluster_id"], [])
+    elif op == "delete_clusters":
+        for cluster_id in data["cluster_ids"]:
+            centroid_tracker.drop(cluster_id)
+
+
+def invalidate_entity_centroids(entity_ids: list[str]):
+    # Updated or deleted members change their cluster in an unknown way, the
+    # cluster is recomputed on its next read.
+    for entity_id in entity_ids:
+        try:
+            entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+        except NotFoundException:
+            continue
+        if entity.has_cluster:
+            centroid_tracker.invalidate(entity.cluster_id)
+
+
+def get_cluster_vector(cluster: ClusterModel, store: bool = True) -> list[float]:
+    if centroid_tracker is None:
+        return cluster.cluster_vector
+    return get_cluster_vector_array(cluster, store).tolist()
+
+
+def get_cluster_vector_array(cluster: ClusterModel, store: bool = True) -> np.ndarray:
+    # float64, orjson then writes the same digits as the float list would
+    if centroid_tracker is None:
+        return np.asarray(cluster.cluster_vector, dtype=np.float64)
+    centroid = centroid_tracker.current(cluster.cluster_id, lambda: _member_vectors(cluster), store=store)
+    return np.asarray(centroid, dtype=np.float64)
+
+
+def _member_vectors(cluster: ClusterModel) -> list:
+    return [entity.mention_vector for entity in cluster.entities if entity.has_mention_vector]
+
+
+def apply_journal_entry(entry: dict):
+    op, data = entry["op"], entry["data"]
+    if op == "update_entity":
+        invalidate_entity_centroids([data["entity"]["entity_id"]])
+    elif op == "delete_entities":
+        invalidate_entity_centroids(data["entity_ids"])
+    try:
+        if op == "add_entities":
+            entity_repository.add_entities(
+                [_dict_to_entity(entity) for entity in data["entities"]],
+                suppress_exceptions=True)
+        elif op == "update_entity":
+            entity_repository.update_entity(_dict_to_entity(data["entity"]))
+        elif op == "delete_entities":
+            entity_repository.delete_entities(data["entity_ids"], suppress_exceptions=True)
+        elif op == "add_cluster":
+            cluster_repository.add_cluster(ClusterModel(
+                cluster_id=data["cluster_id"],
+                cluster_name=data["cluster_name"],
+                entities=[]
+            ))
+        elif op == "delete_clusters":
+            cluster_repository.delete_clusters(data["cluster_ids"])
+        elif op == "add_entity_to_cluster":
+            cluster_repository.add_entity_to_cluster(
+                cluster_id=data["cluster_id"], entity_id=data["entity_id"])
+        elif op == "remove_entity_from_cluster":
+            cluster_repository.remove_entity_from_cluster(entity_id=data["entity_id"])
+        track_centroid_change(op, data)
+    # Entries may already be part of the snapshots if a compaction was
+    # interrupted, those are skipped.
+    except (NotFoundException, AlreadyExistsException, AlreadyInClusterException) as e:
+        logging.warning(f"Skipping journal entry {entry['seq']} ({op}): {e}")
+
+
+def _dict_to_entity(entity_dict: dict) -> EntityModel:
+    return EntityModel(
+        entity_id=entity_dict["entity_id"],
+        mention=entity_dict["mention"],
+        entity_source=entity_dict["entity_source"],
+        entity_source_id=entity_dict["entity_source_id"]
+    )
+
+
 app = FastAPI(
     title="Cluster Repository",
     description="A service for managing clusters.",
@@ -147,10 +312,19 @@ app = FastAPI(
 )
 
 if SYSTEM_TYPE == "base":
+    repository_journal = RepositoryJournal(
+        DATA_PATH / "repository_journal.jsonl", compact_after=JOURNAL_COMPACT_AFTER)
     app.add_middleware(
         FileLockerMiddleware,
-        files_to_lock=[DATA_PATH / "entity_repository.json", DATA_PATH / "cluster_repository.json"],
-        before=read_base_repositories, after=write_base_repositories)
+        files_to_lock=[DATA_PATH / "entity_repository.json", DATA_PATH / "cluster_repository.json",
+                       DATA_PATH / "repository_journal.jsonl"],
+        before=sync_base_repositories, after=compact_base_repositories,
+        is_dirty=base_repositories_dirty, pool=repository_pool)
+
+
+@app.exception_handler(PoolFullException)
+async def pool_full_handler(request: Request, exc: PoolFullException):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
 
 @app.on_event("startup")
@@ -159,62 +333,120 @@ async def startup_event():
         neo4j_repositories()
 
     elif SYSTEM_TYPE == "base":
-        read_base_repositories()
+        sync_base_repositories()
 
 
-async def auth_required(security_scopes: SecurityScopes, token: dict = Depends(o_auth2_scheme)):
-    response = httpx.get(
-        f'{AUTH_SERVICE_URL}/verify',
-        headers={'Authorization': f"Bearer {token}"}
-    )
-    if response.status_code != 200:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    if 'admin' in response.json()["scopes"]:
-        return response.json()
-
-    if 'admin' in security_scopes.scopes:
-        if 'admin' not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
-
-    for scope in security_scopes.scopes:
-        if scope != "admin" and scope not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
-
-    return response.json()
-
-
-def _base_cluster_to_clusterOut(cluster: ClusterModel) -> ClusterOut:
-    return ClusterOut(
-        cluster_id=cluster.cluster_id,
-        cluster_name=cluster.cluster_name,
-        entity_ids=[entity.entity_id for entity in cluster.entities],
-        cluster_vector=cluster.cluster_vector
-    )
-
+@app.on_event("shutdown")
+async def shutdown_event():
+    if neo4j_batch_writer is not None:
+        neo4j_batch_writer.close()
+    repository_pool.shutdown()
+    await auth_client.close()
 
-@app.get("/", response_model=list[ClusterOut])
-async def get_all_clusters(user: dict = Security(auth_required, scopes=[])):
-    _all_clusters: list[ClusterModel] = cluster_repository.get_all_clusters()
-    return [
-        _base_cluster_to_clusterOut(cluster)
-        for cluster in _all_clusters
-    ]
 
-
-@app.get("/cluster/{cluster_id}", response_model=ClusterOut)
-async def get_cluster_by_id(cluster_id: str, user: dict = Security(auth_required, scopes=[])):
+async def auth_required(security_scopes: SecurityScopes, token: dict = Depends(o_auth2_scheme)):
+    user = await auth_client.verify(token)
+    check_scopes(user, security_scopes.scopes)
+    return user
+
+
+def cluster_fields(
+    fields: Optional[str] = Query(
+        default=None, description="Comma separated ClusterOut fields, cluster_id is always returned"),
+    include_vector: bool = True
+) -> frozenset[str]:
+    """
+    Fields of the returned clusters. List views can ask for
+    `fields=cluster_name,entity_count` instead of the vector and all member
+    ids.
+    """
+    if fields is None:
+        projection = DEFAULT_CLUSTER_FIELDS
+    else:
+        projection = frozenset(field.strip() for field in fields.split(",") if field.strip())
+        unknown = projection - set(CLUSTER_FIELDS) - {"cluster_id"}
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown fields {sorted(unknown)}, expected any of {list(CLUSTER_FIELDS)}")
+    if not include_vector:
+        projection -= {"cluster_vector"}
+    return projection
+
+
+def _cluster_values(cluster: ClusterModel, fields: frozenset[str], vector) -> dict:
+    values = {"cluster_id": cluster.cluster_id}
+    if "cluster_name" in fields:
+        values["cluster_name"] = cluster.cluster_name
+    if "entity_ids" in fields:
+        values["entity_ids"] = [entity.entity_id for entity in cluster.entities]
+    if "entity_count" in fields:
+        values["entity_count"] = len(cluster.entities)
+    # Skipped vectors are not computed at all
+    if "cluster_vector" in fields:
+        values["cluster_vector"] = vector(cluster)
+    return values
+
+
+def _base_cluster_to_clusterOut(cluster: ClusterModel, fields: frozenset[str] = None) -> ClusterOut:
+    return ClusterOut(**_cluster_values(cluster, fields or DEFAULT_CLUSTER_FIELDS, get_cluster_vector))
+
+
+@app.get("/metrics")
+async def get_metrics(user: dict = Security(auth_required, scopes=["admin"])):
+    return {
+        "repository_writes": FileLockerMiddleware.write_stats,
+        "pools": WorkerPool.all_stats()
+    }
+
+
+def _list_clusters() -> list[ClusterModel]:
+    return list(cluster_repository.get_all_clusters())
+
+
+def _base_cluster_to_clusterOut_dict(cluster: ClusterModel, fields: frozenset[str] = None) -> dict:
+    return _cluster_values(cluster, fields or DEFAULT_CLUSTER_FIELDS, get_cluster_vector_array)
+
+
+def _clusters_response(clusters: list[ClusterModel], fields: frozenset[str] = None):
+    # The orjson encoder writes the dicts and vectors straight to the response
+    # body, the pydantic one builds ClusterOut models that FastAPI validates
+    # again.
+    if RESPONSE_ENCODER == "orjson":
+        return ORJSONResponse([_base_cluster_to_clusterOut_dict(cluster, fields) for cluster in clusters])
+    return [_base_cluster_to_clusterOut(cluster, fields) for cluster in clusters]
+
+
+def _all_clusters_out(fields: frozenset[str] = None):
+    return _clusters_response(cluster_repository.get_all_clusters(), fields)
+
+
+# ClusterOut fields that were not asked for are left unset and not returned
+@app.get("/", response_model=list[ClusterOut], response_model_exclude_unset=True)
+async def get_all_clusters(
+    fields: frozenset[str] = Depends(cluster_fields),
+    user: dict = Security(auth_required, scopes=[])
+):
+    return await repository_pool.run(_all_clusters_out, fields)
+
+
+@app.get("/cluster/{cluster_id}", response_model=ClusterOut, response_model_exclude_unset=True)
+async def get_cluster_by_id(
+    cluster_id: str,
+    fields: frozenset[str] = Depends(cluster_fields),
+    user: dict = Security(auth_required, scopes=[])
+):
     try:
         cluster: ClusterModel = cluster_repository.get_cluster_by_id(cluster_id)
     except NotFoundException:
         raise HTTPException(status_code=404, detail="Cluster not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return _base_cluster_to_clusterOut(cluster)
+    return _base_cluster_to_clusterOut(cluster, fields)
 
 
-@app.post("/cluster/create", response_model=ClusterOut)
-async def create_cluster(cluster_in: ClusterIn, user: dict = Security(auth_required, scopes=[
+@app.post("/cluster/create", response_model=ClusterOut, response_model_exclude_unset=True)
+async def create_cluster(cluster_in: ClusterIn, fields: frozenset[str] = Depends(cluster_fields), user: dict = Security(auth_required, scopes=[
     'editor'
 ])):
     cluster = ClusterModel(
@@ -231,40 +463,66 @@ async def create_cluster(cluster_in: ClusterIn, user: dict = Security(auth_requi
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    return _base_cluster_to_clusterOut(cluster)
+    journal_change("add_cluster", cluster_id=cluster.cluster_id, cluster_name=cluster.cluster_name)
+    return _base_cluster_to_clusterOut(cluster, fields)
 
 
 @app.delete("/cluster/{cluster_id}/delete", status_code=204)
 async def delete_cluster(cluster_id: str, user: dict = Security(auth_required, scopes=["editor"])):
     try:
+        cluster: ClusterModel = cluster_repository.get_cluster_by_id(cluster_id)
         cluster_repository.delete_cluster(cluster_id)
     except NotFoundException as e:
         raise HTTPException(status_code=404, detail=e.message)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("delete_clusters", cluster_ids=[cluster_id],
+                   entity_ids=[entity.entity_id for entity in cluster.entities])
     return
 
 
 @app.delete("/delete", status_code=204)
 async def delete_clusters(clusters_in: DeleteClustersIn, user: dict = Security(auth_required, scopes=["editor"])):
+    if neo4j_batch_writer is not None:
+        try:
+            await repository_pool.run(neo4j_batch_writer.write, DELETE_CLUSTERS, clusters_in.cluster_ids)
+        except PoolFullException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return
+
+    clusters: list[ClusterModel] = []
+    for cluster_id in clusters_in.cluster_ids:
+        try:
+            clusters.append(cluster_repository.get_cluster_by_id(cluster_id))
+        except NotFoundException:
+            pass
     try:
-        cluster_repository.delete_clusters(clusters_in.cluster_ids)
+        await repository_pool.run(cluster_repository.delete_clusters, clusters_in.cluster_ids)
+    except PoolFullException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("delete_clusters", cluster_ids=[cluster.cluster_id for cluster in clusters],
+                   entity_ids=[entity.entity_id for cluster in clusters for entity in cluster.entities])
     return
 
 
 @app.delete("/delete/all", status_code=204)
 async def delete_all_clusters(user: dict = Security(auth_required, scopes=["editor"])):
+    clusters: list[ClusterModel] = await repository_pool.run(_list_clusters)
     try:
         cluster_repository.delete_all_clusters()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("delete_clusters", cluster_ids=[cluster.cluster_id for cluster in clusters],
+                   entity_ids=[entity.entity_id for cluster in clusters for entity in cluster.entities])
     return
 
 
-@app.post("/cluster/{cluster_id}/add-entity", response_model=ClusterOut)
-async def add_entity_to_cluster(cluster_id: str, entity_id: str, user: dict = Security(auth_required, scopes=[])):
+@app.post("/cluster/{cluster_id}/add-entity", response_model=ClusterOut, response_model_exclude_unset=True)
+async def add_entity_to_cluster(cluster_id: str, entity_id: str, fields: frozenset[str] = Depends(cluster_fields), user: dict = Security(auth_required, scopes=[])):
     try:
         cluster_repository.add_entity_to_cluster(cluster_id=cluster_id, entity_id=entity_id)
     except AlreadyExistsException as e:
@@ -273,52 +531,229 @@ async def add_entity_to_cluster(cluster_id: str, entity_id: str, user: dict = Se
         raise HTTPException(status_code=409, detail=e.message)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("add_entity_to_cluster", cluster_id=cluster_id, entity_id=entity_id)
     cluster = cluster_repository.get_cluster_by_id(cluster_id)
-    return _base_cluster_to_clusterOut(cluster)
+    return _base_cluster_to_clusterOut(cluster, fields)
+
+
+def assign_entities(assignments: list[tuple[str, str]], move: bool = True) -> list[AssignmentResult]:
+    """
+    Applies (entity_id, cluster_id) assignments and records every change in a
+    single journal write. A cluster_id of None removes the entity from its
+    cluster; entities that are already in another cluster are moved unless
+    `move` is False. Failing items do not stop the others. The assignments are
+    validated first and then applied grouped by cluster, so every touched
+    cluster is rewritten and its centroid updated once.
+    """
+    if neo4j_batch_writer is not None:
+        return assign_entities_batched(assignments, move)
+
+    results = []
+    moves = []
+    changes = []
+    assigned = set()
+    for entity_id, cluster_id in assignments:
+        try:
+            entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+            current_cluster_id = entity.cluster_id if entity.has_cluster else None
+            if cluster_id is not None:
+                cluster_repository.get_cluster_by_id(cluster_id)
+        except NotFoundException as e:
+            results.append(AssignmentResult(
+                entity_id=entity_id, cluster_id=cluster_id, status="not_found", detail=e.message))
+            continue
+        status, detail = "ok", None
+        if entity_id in assigned:
+            status, detail = "conflict", f"Entity {entity_id} is assigned more than once"
+        elif current_cluster_id == cluster_id:
+            status = "unchanged"
+        elif current_cluster_id is not None and cluster_id is not None and not move:
+            status, detail = "conflict", f"Entity {entity_id} is already in cluster {current_cluster_id}"
+        else:
+            assigned.add(entity_id)
+            moves.append((entity, cluster_id))
+            if current_cluster_id is not None:
+                changes.append(("remove_entity_from_cluster",
+                                {"cluster_id": current_cluster_id, "entity_id": entity_id}))
+            if cluster_id is not None:
+                changes.append(("add_entity_to_cluster", {"cluster_id": cluster_id, "entity_id": entity_id}))
+        results.append(AssignmentResult(entity_id=entity_id, cluster_id=cluster_id, status=status, detail=detail))
 
+    try:
+        cluster_repository.assign(moves)
+    except Exception as e:
+        for result in results:
+            if result.status == "ok":
+                result.status, result.detail = "error", str(e)
+        return results
+    journal_changes(changes)
+    return results
+
+
+def assign_entities_batched(assignments: list[tuple[str, str]], move: bool = True) -> list[AssignmentResult]:
+    """
+    Neo4J version of `assign_entities`: current memberships are read and the
+    changes are written with batched statements instead of one transaction
+    per entity.
+    """
+    memberships = {
+        record["entity_id"]: record["cluster_id"]
+        for record in neo4j_batch_writer.read(ENTITY_MEMBERSHIPS, {entity_id for entity_id, _ in assignments})
+    }
+    existing_clusters = {
+        record["cluster_id"]
+        for record in neo4j_batch_writer.read(
+            EXISTING_CLUSTERS, {cluster_id for _, cluster_id in assignments if cluster_id is not None})
+    }
+    results = []
+    removals = []
+    additions = []
+    assigned = set()
+    for entity_id, cluster_id in assignments:
+        status, detail = "ok", None
+        if entity_id not in memberships:
+            status, detail = "not_found", f"Entity {entity_id} not found"
+        elif cluster_id is not None and cluster_id not in existing_clusters:
+            status, detail = "not_found", f"Cluster {cluster_id} not found"
+        elif entity_id in assigned:
+            status, detail = "conflict", f"Entity {entity_id} is assigned more than once"
+        elif memberships[entity_id] == cluster_id:
+            status = "unchanged"
+        elif memberships[entity_id] is not None and cluster_id is not None and not move:
+            status, detail = "conflict", f"Entity {entity_id} is already in cluster {memberships[entity_id]}"
+        else:
+            assigned.add(entity_id)
+            if memberships[entity_id] is not None:
+                removals.append(entity_id)
+            if cluster_id is not None:
+                additions.append({"entity_id": entity_id, "cluster_id": cluster_id})
+        results.append(AssignmentResult(entity_id=entity_id, cluster_id=cluster_id, status=status, detail=detail))
 
-@app.post("/cluster/{cluster_id}/add-entities", response_model=ClusterOut)
-async def add_entities_to_cluster(cluster_id: str, payload: ClusterAddEntityIn, user: dict = Security(auth_required, scopes=[])):
     try:
-        for entity in payload.entity_ids:
-            cluster_repository.add_entity_to_cluster(cluster_id=cluster_id, entity_id=entity)
-    except AlreadyExistsException as e:
-        raise HTTPException(status_code=409, detail=e.message)
-    except AlreadyInClusterException as e:
-        raise HTTPException(status_code=409, detail=e.message)
+        neo4j_batch_writer.write(REMOVE_ENTITIES_FROM_CLUSTERS, removals)
+        neo4j_batch_writer.write(ADD_ENTITIES_TO_CLUSTERS, additions)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        for result in results:
+            if result.status == "ok":
+                result.status, result.detail = "error", str(e)
+    return results
+
+
+@app.post("/cluster/{cluster_id}/add-entities", response_model=ClusterOut, response_model_exclude_unset=True)
+async def add_entities_to_cluster(cluster_id: str, payload: ClusterAddEntityIn, fields: frozenset[str] = Depends(cluster_fields), user: dict = Security(auth_required, scopes=[])):
+    try:
+        cluster_repository.get_cluster_by_id(cluster_id)
+    except NotFoundException as e:
+        raise HTTPException(status_code=404, detail=e.message)
+    results = await repository_pool.run(
+        assign_entities, [(entity_id, cluster_id) for entity_id in payload.entity_ids], move=False)
+    failed = [result for result in results if result.status not in ("ok", "unchanged")]
+    if failed:
+        # The other entities were added anyway
+        status_code = 500 if any(result.status == "error" for result in failed) else 409
+        raise HTTPException(status_code=status_code, detail=[result.dict() for result in failed])
     cluster = cluster_repository.get_cluster_by_id(cluster_id)
-    return _base_cluster_to_clusterOut(cluster)
+    return _base_cluster_to_clusterOut(cluster, fields)
+
 
+@app.post("/assignments", response_model=AssignmentsOut)
+async def assign_entities_to_clusters(payload: AssignmentsIn, user: dict = Security(auth_required, scopes=[])):
+    """
+    Assigns entities to clusters across clusters, moving entities that are
+    already in another cluster; a null cluster_id removes the entity from its
+    cluster. Returns one result per assignment.
+    """
+    results = await repository_pool.run(
+        assign_entities, [(assignment.entity_id, assignment.cluster_id) for assignment in payload.assignments])
+    return AssignmentsOut(results=results)
 
-@app.post("/cluster/{cluster_id}/remove-entity", response_model=ClusterOut)
-async def remove_entity_from_cluster(cluster_id: str, entity_id: str, user: dict = Security(auth_required, scopes=[])):
+
+@app.post("/cluster/{cluster_id}/remove-entity", response_model=ClusterOut, response_model_exclude_unset=True)
+async def remove_entity_from_cluster(cluster_id: str, entity_id: str, fields: frozenset[str] = Depends(cluster_fields), user: dict = Security(auth_required, scopes=[])):
+    try:
+        entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+    except NotFoundException as e:
+        raise HTTPException(status_code=404, detail=e.message)
+    # The repository removes the entity from whatever cluster it is in, the
+    # journal has to name that cluster.
+    if not entity.has_cluster or entity.cluster_id != cluster_id:
+        raise HTTPException(status_code=409, detail=f"Entity {entity_id} is not in cluster {cluster_id}")
     try:
         cluster_repository.remove_entity_from_cluster(entity_id=entity_id)
     except NotFoundException as e:
         raise HTTPException(status_code=404, detail=e.message)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("remove_entity_from_cluster", cluster_id=cluster_id, entity_id=entity_id)
     cluster = cluster_repository.get_cluster_by_id(cluster_id)
-    return _base_cluster_to_clusterOut(cluster)
-
-
-@app.get("/export/csv", response_class=FileResponse)
-async def export_clusters_csv(user: dict = Security(auth_required, scopes=["editor"])):
-    _all_clusters: list[ClusterModel] = cluster_repository.get_all_clusters()
-    pd.DataFrame([
-        {
-            'cluster_id': cluster.cluster_id,
-            'cluster_name': cluster.cluster_name,
-            'entity_ids': [entity.entity_id for entity in cluster.entities],
-            'cluster_vector': cluster.cluster_vector.tolist()
-        }
-        for cluster in _all_clusters
-    ]).to_csv(
-        DATA_PATH / 'clusters.csv',
-        index=False
-    )
-    return FileResponse(DATA_PATH / 'clusters.csv',
-                        filename='clusters.csv',
-                        media_type='text/csv')
+    return _base_cluster_to_clusterOut(cluster, fields)
+
+
+def _cluster_to_export_row(cluster: ClusterModel) -> dict:
+    return {
+        'cluster_id': cluster.cluster_id,
+        'cluster_name': cluster.cluster_name,
+        'entity_ids': [entity.entity_id for entity in cluster.entities],
+        # Streamed after the file locks were released, a recompute here could
+        # race a change, so it is not kept.
+        'cluster_vector': get_cluster_vector(cluster, store=False)
+    }
+
+
+def _export_response(chunks, filename: str, media_type: str, compress: bool = False) -> StreamingResponse:
+    if compress:
+        chunks = gzipped(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        chunks, media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+# Exports are encoded chunk by chunk while being sent. The file locks are
+# released once streaming starts, so each export works on its own list of the
+# clusters.
+@app.get("/export/csv")
+async def export_clusters_csv(gzip: bool = False, user: dict = Security(auth_required, scopes=["editor"])):
+    _all_clusters: list[ClusterModel] = await repository_pool.run(_list_clusters)
+    rows = (_cluster_to_export_row(cluster) for cluster in _all_clusters)
+    return _export_response(
+        stream_csv(rows, list(CLUSTER_EXPORT_COLUMNS)), "clusters.csv", "text/csv", gzip)
+
+
+@app.get("/export/parquet")
+async def export_clusters_parquet(user: dict = Security(auth_required, scopes=["editor"])):
+    _all_clusters: list[ClusterModel] = await repository_pool.run(_list_clusters)
+    rows = (_cluster_to_export_row(cluster) for cluster in _all_clusters)
+    schema = arrow_schema(CLUSTER_EXPORT_COLUMNS, get_word2vec_model().vector_size)
+    return _export_response(
+        stream_parquet(rows, schema), "clusters.parquet", "application/vnd.apache.parquet")
+
+
+@app.get("/export/arrow")
+async def export_clusters_arrow(gzip: bool = False, user: dict = Security(auth_required, scopes=["editor"])):
+    _all_clusters: list[ClusterModel] = await repository_pool.run(_list_clusters)
+    rows = (_cluster_to_export_row(cluster) for cluster in _all_clusters)
+    schema = arrow_schema(CLUSTER_EXPORT_COLUMNS, get_word2vec_model().vector_size)
+    return _export_response(
+        stream_arrow(rows, schema), "clusters.arrows", "application/vnd.apache.arrow.stream", gzip)
+
+
+@app.get("/centroids/verify")
+async def verify_cluster_centroids(fix: bool = False, user: dict = Security(auth_required, scopes=["admin"])):
+    """
+    Compares the incrementally maintained cluster vectors with a full
+    recompute from the member mention vectors, `fix` recomputes the clusters
+    that drifted.
+    """
+    if centroid_tracker is None:
+        raise HTTPException(status_code=404, detail="Centroids are only tracked in base mode")
+    try:
+        return await repository_pool.run(
+            centroid_tracker.verify,
+            ((cluster.cluster_id, _member_vectors(cluster)) for cluster in cluster_repository.get_all_clusters()),
+            fix=fix)
+    except PoolFullException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Optional
 
 
 class ClusterIn(BaseModel):
@@ -11,11 +12,34 @@ class ClusterAddEntityIn(BaseModel):
 
 
 class ClusterOut(BaseModel):
+    # Only cluster_id is always set, the endpoints return the projected fields
     cluster_id: str
-    cluster_name: str
-    entity_ids: list[str]
-    cluster_vector: list[float]
+    cluster_name: Optional[str] = None
+    entity_ids: Optional[list[str]] = None
+    entity_count: Optional[int] = None
+    cluster_vector: Optional[list[float]] = None
 
 
 class DeleteClustersIn(BaseModel):
     cluster_ids: list[str]
+
+
+class AssignmentIn(BaseModel):
+    entity_id: str
+    # None removes the entity from its cluster
+    cluster_id: Optional[str] = None
+
+
+class AssignmentsIn(BaseModel):
+    assignments: list[AssignmentIn]
+
+
+class AssignmentResult(BaseModel):
+    entity_id: str
+    cluster_id: Optional[str]
+    status: str
+    detail: Optional[str] = None
+
+
+class AssignmentsOut(BaseModel):
+    results: list[AssignmentResult]
@@ -1,43 +1,133 @@
-from models import DeleteEntitiesIn, EntityIn, EntityOut
+from models import DeleteEntitiesIn, EntityIn, EntityOut, EntityPageOut, SourceLookupIn, SourceLookupOut
 
-from fastapi import FastAPI, Depends, HTTPException, status, Request, Security
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Security, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, SecurityScopes
-from fastapi.responses import FileResponse
-from file_locker_middleware import FileLockerMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from file_locker_middleware import FileLockerMiddleware, ReadWriteFileLock
+from auth_client import AuthClient, LocalAuthClient, check_scopes
+from vector_store import VectorStore, MentionVectorCache, CachedKeyedVectors
+from snapshot_codec import get_codec, read_snapshot, write_snapshot
+from repository_journal import RepositoryJournal
+from shared_repository import SharedTable, LoaderLock
+from worker_pool import WorkerPool, PoolFullException
+from unlabeled_index import UnlabeledIndex, changed_entity_ids
+from source_index import SourceIndex, changed_source_entity_ids
+from shared_entities import SharedEntityRepository, publish_entities
+from neo4j_batch import (Neo4JBatchWriter, create_driver, create_indexes, CREATE_ENTITIES,
+                         DELETE_UNLABELED_ENTITIES, ENTITY_INDEXES, ENTITIES_BY_SOURCE_IDS)
+from export_stream import arrow_schema, gzipped, stream_arrow, stream_csv, stream_parquet
 from eec.core.abstract.entity_repository import IEntityRepository
 from eec import BaseEntityRepository, Neo4JEntityRepository, Neo4JHelper, EntityModel, NotFoundException, AlreadyExistsException
 from dotenv import load_dotenv
 from pathlib import Path
+from typing import Optional
+from bisect import bisect_right
+import numpy as np
+import threading
+import asyncio
 import os
 import json
 import logging
-from gensim.models import KeyedVectors
-import pandas as pd
-import httpx
 
 load_dotenv()
 
 DATA_PATH = Path(os.getenv("DATA_PATH") or "data")
 LOGGER_PATH = Path(os.getenv("LOGGER_PATH") or "logs")
 SYSTEM_TYPE = os.getenv("SYSTEM_TYPE") or "base"
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC") or "auto"
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT") or "json"
 WORD2VEC_FILE = Path(os.getenv("WORD2VEC_FILE") or "/data/word2vec.model")
+MENTION_VECTOR_CACHE_PATH = Path(os.getenv("MENTION_VECTOR_CACHE_PATH") or DATA_PATH / "mention_vector_cache")
 
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL") or "http://eec.localhost/api/v1/auth"
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE") or 1024)
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL") or 60)
+AUTH_MODE = os.getenv("AUTH_MODE") or "remote"
+AUTH_USERS_REFRESH = float(os.getenv("AUTH_USERS_REFRESH") or 30)
+SECRET_KEY = os.getenv("SECRET_KEY")
+JOURNAL_COMPACT_AFTER = int(os.getenv("JOURNAL_COMPACT_AFTER") or 1000)
+NEO4J_BATCH_SIZE = int(os.getenv("NEO4J_BATCH_SIZE") or 0)
+NEO4J_POOL_SIZE = int(os.getenv("NEO4J_POOL_SIZE") or 100)
+NEO4J_ACQUIRE_TIMEOUT = float(os.getenv("NEO4J_ACQUIRE_TIMEOUT") or 60)
+REPOSITORY_POOL_SIZE = int(os.getenv("REPOSITORY_POOL_SIZE") or 8)
+POOL_QUEUE_SIZE = int(os.getenv("POOL_QUEUE_SIZE") or 256)
+REPOSITORY_MODE = os.getenv("REPOSITORY_MODE") or "local"
+SHARED_REPOSITORY_PATH = Path(os.getenv("SHARED_REPOSITORY_PATH") or "/dev/shm/eec/entity_service")
+SHARED_REPOSITORY_INTERVAL = float(os.getenv("SHARED_REPOSITORY_INTERVAL") or 0.05)
+SHARED_REPOSITORY_TIMEOUT = float(os.getenv("SHARED_REPOSITORY_TIMEOUT") or 5)
+RESPONSE_ENCODER = os.getenv("RESPONSE_ENCODER") or "pydantic"
+
+# Fields an EntityOut can be projected to, all but the vector by default
+ENTITY_FIELDS = ("mention", "entity_source", "entity_source_id", "has_cluster",
+                 "cluster_id", "has_mention_vector", "mention_vector")
+DEFAULT_ENTITY_FIELDS = frozenset(ENTITY_FIELDS) - {"mention_vector"}
+
+# Journal operations that change clusters, the entity service cannot compact
+# the journal on its own while any of them is pending.
+CLUSTER_JOURNAL_OPS = {"add_cluster", "delete_clusters",
+                       "add_entity_to_cluster", "remove_entity_from_cluster"}
+
+ENTITY_EXPORT_COLUMNS = {
+    'entity_id': 'string',
+    'mention': 'string',
+    'entity_source': 'string',
+    'entity_source_id': 'string',
+    'in_cluster': 'bool',
+    'cluster_id': 'string',
+    'has_mention_vector': 'bool',
+    'mention_vector': 'vector'
+}
 
 entity_repository: IEntityRepository = None
-last_entity_repository_update: float = None
+repository_journal: RepositoryJournal = None
+mention_vector_cache: MentionVectorCache = None
+unlabeled_index: UnlabeledIndex = None
+# Built on the first source lookup after the repository was (re)loaded
+source_index: SourceIndex = None
+source_index_lock = threading.Lock()
+neo4j_batch_writer: Neo4JBatchWriter = None
+# Incremented on every change of the in-memory repository
+entity_repository_version: int = 0
+# (version, sorted entity ids, entities in the same order) used for paging
+entity_listing: tuple[int, list[str], list[EntityModel]] = None
+# Shared mode: every worker reads `shared_entities` and appends its changes
+# through `shared_journal`, only the worker holding `loader_lock` keeps
+# `entity_repository` and publishes it.
+shared_entities: SharedEntityRepository = None
+shared_journal: RepositoryJournal = None
+loader_lock: LoaderLock = None
+repository_locks: list[ReadWriteFileLock] = []
+published_version: int = None
+snapshot_codec = get_codec(SNAPSHOT_CODEC)
+# Scans over the whole repository and the file lock hooks run here instead of
+# on the event loop, lookups of single entities stay on the loop.
+repository_pool = WorkerPool("repository", REPOSITORY_POOL_SIZE, POOL_QUEUE_SIZE)
 o_auth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/api/v1/auth/login",
     scopes={"admin": "Admin access", "editor": "Editor access", "export": "Export access"})
 
+if AUTH_MODE == "local":
+    auth_client = LocalAuthClient(AUTH_SERVICE_URL, secret_key=SECRET_KEY,
+                                  refresh_interval=AUTH_USERS_REFRESH)
+else:
+    auth_client = AuthClient(AUTH_SERVICE_URL, cache_size=AUTH_CACHE_SIZE, cache_ttl=AUTH_CACHE_TTL)
+
 
 def get_word2vec_model():
     global WORD2VEC_FILE
-    return KeyedVectors.load(str(WORD2VEC_FILE))
+    return VectorStore.get(WORD2VEC_FILE)
+
+
+def get_mention_vectors() -> CachedKeyedVectors:
+    global mention_vector_cache
+    if mention_vector_cache is None:
+        mention_vector_cache = MentionVectorCache(
+            MENTION_VECTOR_CACHE_PATH, VectorStore.fingerprint(WORD2VEC_FILE), get_word2vec_model().vector_size)
+    return CachedKeyedVectors(get_word2vec_model(), mention_vector_cache)
 
 
 def neo4j_entity_repository():
-    global entity_repository
+    global entity_repository, neo4j_batch_writer
 
     NEO4J_URI = os.getenv("NEO4J_URI")
     NEO4J_USER = os.getenv("NEO4J_USER")
@@ -52,36 +142,338 @@ def neo4j_entity_repository():
     entity_repository = Neo4JEntityRepository(
         keyed_vectors=get_word2vec_model()
     )
+    driver = create_driver(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD,
+                           max_connection_pool_size=NEO4J_POOL_SIZE,
+                           connection_acquisition_timeout=NEO4J_ACQUIRE_TIMEOUT)
+    create_indexes(driver, ENTITY_INDEXES)
+    if NEO4J_BATCH_SIZE > 0:
+        neo4j_batch_writer = Neo4JBatchWriter(driver, batch_size=NEO4J_BATCH_SIZE)
+    else:
+        driver.close()
 
 
 def read_base_entity_repository():
-    global entity_repository, last_entity_repository_update, DATA_PATH
+    global entity_repository, DATA_PATH
     ENTITY_DATA_PATH = DATA_PATH / "entity_repository.json"
 
-    if entity_repository is None or last_entity_repository_update is None or last_entity_repository_update < ENTITY_DATA_PATH.stat().st_mtime:
-        if not ENTITY_DATA_PATH.exists():
-            print("Entity repository not found. Creating new one.")
-            entity_repository = BaseEntityRepository(
-                entities=[],
-                last_id=0,
-                keyed_vectors=get_word2vec_model()
-            )
-            return
-        with open(ENTITY_DATA_PATH, "r") as f:
-            entity_repository = BaseEntityRepository.decode(
-                json.load(f), keyed_vectors=get_word2vec_model())
-        last_entity_repository_update = ENTITY_DATA_PATH.stat().st_mtime
+    if not ENTITY_DATA_PATH.exists():
+        print("Entity repository not found. Creating new one.")
+        entity_repository = BaseEntityRepository(
+            entities=[],
+            last_id=0,
+            keyed_vectors=get_mention_vectors()
+        )
+        return
+    entity_repository = BaseEntityRepository.decode(
+        read_snapshot(ENTITY_DATA_PATH, snapshot_codec), keyed_vectors=get_mention_vectors())
 
 
 def write_base_entity_repository():
-    global entity_repository, last_entity_repository_update, DATA_PATH
+    global entity_repository, DATA_PATH
     ENTITY_DATA_PATH = DATA_PATH / "entity_repository.json"
 
-    temp_path = ENTITY_DATA_PATH.parent / (ENTITY_DATA_PATH.name + ".tmp")
-    with open(temp_path, "w") as f:
-        json.dump(entity_repository.encode(), f)
-    os.replace(temp_path, ENTITY_DATA_PATH)
-    last_entity_repository_update = ENTITY_DATA_PATH.stat().st_mtime
+    write_snapshot(ENTITY_DATA_PATH, entity_repository.encode(), snapshot_codec, layout=SNAPSHOT_FORMAT)
+
+
+def sync_base_entity_repository():
+    global entity_repository_version, unlabeled_index, source_index
+    reset, entries = repository_journal.read()
+    if reset:
+        read_base_entity_repository()
+        source_index = None
+        unlabeled_index = UnlabeledIndex(
+            entity.entity_id for entity in entity_repository.get_all_entities() if not entity.has_cluster)
+    for entry in entries:
+        apply_journal_entry(entry)
+    if reset or entries:
+        entity_repository_version += 1
+    mention_vector_cache.save()
+
+
+def compact_base_entity_repository():
+    # The cluster snapshot stays valid only as long as no cluster was changed
+    # in this generation, otherwise compaction is left to the cluster service.
+    if repository_journal.should_compact() and not repository_journal.ops & CLUSTER_JOURNAL_OPS:
+        repository_journal.compact(write_base_entity_repository)
+    mention_vector_cache.save()
+
+
+def base_entity_repository_dirty() -> bool:
+    return repository_journal.dirty
+
+
+def journal_change(op: str, **data):
+    global entity_repository_version
+    entity_repository_version += 1
+    track_unlabeled_change(op, data)
+    track_source_change(op, data)
+    if repository_journal is not None:
+        repository_journal.append(op, **data)
+
+
+def track_unlabeled_change(op: str, data: dict):
+    if unlabeled_index is None:
+        return
+    for entity_id in changed_entity_ids(op, data):
+        try:
+            entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+        except NotFoundException:
+            unlabeled_index.discard(entity_id)
+            continue
+        unlabeled_index.set(entity_id, not entity.has_cluster)
+
+
+def sample_unlabeled_entities(repository: IEntityRepository, num: int) -> list[EntityModel]:
+    """
+    Samples from the unlabeled index in base mode, the Neo4J repository and
+    the shared copy sample on their own.
+    """
+    if unlabeled_index is None or repository is not entity_repository:
+        return repository.get_random_unlabeled_entities(num)
+    return [entity_repository.get_entity_by_id(entity_id) for entity_id in unlabeled_index.sample(num)]
+
+
+def get_source_index() -> SourceIndex:
+    global source_index
+    with source_index_lock:
+        if source_index is None:
+            source_index = SourceIndex(entity_repository.get_all_entities())
+        return source_index
+
+
+def track_source_change(op: str, data: dict):
+    # Not built yet, the build will see the change
+    if source_index is None:
+        return
+    with source_index_lock:
+        for entity_id in changed_source_entity_ids(op, data):
+            try:
+                entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+            except NotFoundException:
+                source_index.discard(entity_id)
+                continue
+            source_index.set(entity_id, entity.entity_source, entity.entity_source_id)
+
+
+def uses_source_index(repository: IEntityRepository) -> bool:
+    return SYSTEM_TYPE == "base" and repository is entity_repository
+
+
+def find_entities_by_source(repository: IEntityRepository, entity_source: str) -> list[EntityModel]:
+    if not uses_source_index(repository):
+        return repository.get_entities_by_source(entity_source)
+    return [entity_repository.get_entity_by_id(entity_id)
+            for entity_id in get_source_index().ids_by_source(entity_source)]
+
+
+def find_entity_by_source_id(repository: IEntityRepository, entity_source: str,
+                             entity_source_id: str) -> Optional[EntityModel]:
+    if not uses_source_index(repository):
+        try:
+            return repository.get_entity_by_source_id(entity_source, entity_source_id)
+        except NotFoundException:
+            return None
+    entity_id = get_source_index().find(entity_source, entity_source_id)
+    return entity_repository.get_entity_by_id(entity_id) if entity_id is not None else None
+
+
+def find_entities_by_source_ids(repository: IEntityRepository,
+                                keys: list[tuple[str, str]]) -> list[Optional[EntityModel]]:
+    """
+    The entity of every (entity_source, entity_source_id) pair or None, in the
+    order of `keys`. Neo4J resolves all pairs in one batched read when the
+    batch writer is configured, the shared copy in one scan.
+    """
+    if repository is shared_entities:
+        return shared_entities.get_entities_by_source_ids(keys)
+    if repository is entity_repository and neo4j_batch_writer is not None:
+        records = neo4j_batch_writer.read(ENTITIES_BY_SOURCE_IDS, [
+            {"entity_source": entity_source, "entity_source_id": entity_source_id}
+            for entity_source, entity_source_id in dict.fromkeys(keys)
+        ])
+        entity_ids = {}
+        for record in records:
+            entity_ids.setdefault((record["entity_source"], record["entity_source_id"]), record["entity_id"])
+        found = {entity_id: entity_repository.get_entity_by_id(entity_id)
+                 for entity_id in set(entity_ids.values())}
+        return [found[entity_ids[key]] if key in entity_ids else None for key in keys]
+    return [find_entity_by_source_id(repository, *key) for key in keys]
+
+
+def get_entity_repository() -> IEntityRepository:
+    # Workers of the shared mode read the copy the loader published
+    if shared_entities is None:
+        return entity_repository
+    if not shared_entities.refresh():
+        raise HTTPException(status_code=503, detail="The shared repository is not published yet")
+    return shared_entities
+
+
+def _acquire_repository_locks(shared: bool) -> list[int]:
+    return [lock.acquire(shared) for lock in repository_locks]
+
+
+def _release_repository_locks(fds: list[int]):
+    for fd in fds:
+        ReadWriteFileLock.release(fd)
+
+
+def load_shared_repository():
+    """
+    One round of the loader: applies what was journaled since the last round
+    and publishes the repository for the workers if it changed.
+    """
+    global published_version
+    fds = _acquire_repository_locks(shared=True)
+    try:
+        sync_base_entity_repository()
+        if published_version == entity_repository_version:
+            return
+        version = entity_repository_version
+        entities = list(entity_repository.get_all_entities())
+        seq = repository_journal.last_seq
+    finally:
+        _release_repository_locks(fds)
+    # Only this thread changes the repository, the entities can be published
+    # without holding the locks.
+    publish_entities(shared_entities.table, entities, seq=seq)
+    published_version = version
+
+    if repository_journal.should_compact():
+        fds = _acquire_repository_locks(shared=False)
+        try:
+            sync_base_entity_repository()
+            compact_base_entity_repository()
+        finally:
+            _release_repository_locks(fds)
+
+
+async def run_shared_loader():
+    # Every worker tries to become the loader, so another one takes over when
+    # the loader exits.
+    while not loader_lock.try_acquire():
+        await asyncio.sleep(1)
+    logging.info(f"Worker {os.getpid()} loads the shared repository")
+    while True:
+        try:
+            await asyncio.to_thread(load_shared_repository)
+        except Exception as e:
+            logging.error(f"Could not publish the shared repository: {e}")
+        await asyncio.sleep(SHARED_REPOSITORY_INTERVAL)
+
+
+def _append_shared_changes(changes: list[tuple[str, dict]]) -> int:
+    fds = _acquire_repository_locks(shared=False)
+    try:
+        # Catches up with the sequence numbers other writers used
+        shared_journal.read()
+        shared_journal.append_many(changes)
+        return shared_journal.last_seq
+    finally:
+        _release_repository_locks(fds)
+
+
+async def journal_shared_changes(changes: list[tuple[str, dict]]):
+    """
+    Hands changes to the loader through the journal and waits until it
+    published a version containing them, so the worker reads its own writes.
+    """
+    seq = await asyncio.to_thread(_append_shared_changes, changes)
+    if not await shared_entities.table.wait("seq", seq, SHARED_REPOSITORY_TIMEOUT):
+        raise HTTPException(status_code=503, detail="The shared repository loader did not apply the change in time")
+    shared_entities.refresh()
+
+
+async def create_shared_entities(entities_in: list[EntityIn]) -> list[EntityModel]:
+    repository = get_entity_repository()
+    new_entities = {}
+    for entity_in in entities_in:
+        if entity_in.entity_id not in new_entities and repository.find(entity_in.entity_id) is None:
+            new_entities[entity_in.entity_id] = _entity_to_dict(entity_in)
+    if not new_entities:
+        return []
+    await journal_shared_changes([("add_entities", {"entities": list(new_entities.values())})])
+    # The loader skips entities another worker created in the meantime
+    created = []
+    for entity_id, entity_dict in new_entities.items():
+        row = shared_entities.find(entity_id)
+        if row is not None and _entity_to_dict(shared_entities.entity(row)) == entity_dict:
+            created.append(shared_entities.entity(row))
+    return created
+
+
+def get_sorted_entities() -> tuple[list[str], list[EntityModel]]:
+    """
+    Returns all entities ordered by entity_id together with their ids for
+    bisecting. The order is cached until the repository changes; in neo4j mode
+    changes are not visible to the service, so it is rebuilt on every call.
+    """
+    global entity_listing
+    if shared_entities is not None:
+        return get_entity_repository().get_sorted_entities()
+    if SYSTEM_TYPE == "base" and entity_listing is not None and entity_listing[0] == entity_repository_version:
+        return entity_listing[1], entity_listing[2]
+    entities = sorted(entity_repository.get_all_entities(), key=lambda entity: entity.entity_id)
+    ids = [entity.entity_id for entity in entities]
+    entity_listing = (entity_repository_version, ids, entities)
+    return ids, entities
+
+
+def _entity_matches(entity: EntityModel, has_cluster: Optional[bool], entity_source: Optional[str]) -> bool:
+    if has_cluster is not None and entity.has_cluster != has_cluster:
+        return False
+    if entity_source is not None and entity.entity_source != entity_source:
+        return False
+    return True
+
+
+def _set_entity_cluster(entity_id: str, cluster_id: str):
+    entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+    entity.cluster_id = cluster_id
+
+
+def apply_journal_entry(entry: dict):
+    op, data = entry["op"], entry["data"]
+    try:
+        if op == "add_entities":
+            entity_repository.add_entities(
+                [_dict_to_entity(entity) for entity in data["entities"]],
+                suppress_exceptions=True)
+        elif op == "update_entity":
+            entity_repository.update_entity(_dict_to_entity(data["entity"]))
+        elif op == "delete_entities":
+            entity_repository.delete_entities(data["entity_ids"], suppress_exceptions=True)
+        elif op == "add_entity_to_cluster":
+            _set_entity_cluster(data["entity_id"], data["cluster_id"])
+        elif op == "remove_entity_from_cluster":
+            _set_entity_cluster(data["entity_id"], None)
+        elif op == "delete_clusters":
+            for entity_id in data["entity_ids"]:
+                _set_entity_cluster(entity_id, None)
+    # Entries may already be part of the snapshot if a compaction was
+    # interrupted, those are skipped.
+    except (NotFoundException, AlreadyExistsException) as e:
+        logging.warning(f"Skipping journal entry {entry['seq']} ({op}): {e}")
+    track_unlabeled_change(op, data)
+    track_source_change(op, data)
+
+
+def _dict_to_entity(entity_dict: dict) -> EntityModel:
+    return EntityModel(
+        entity_id=entity_dict["entity_id"],
+        mention=entity_dict["mention"],
+        entity_source=entity_dict["entity_source"],
+        entity_source_id=entity_dict["entity_source_id"]
+    )
+
+
+def _entity_to_dict(entity: EntityModel) -> dict:
+    return {
+        "entity_id": entity.entity_id,
+        "mention": entity.mention,
+        "entity_source": entity.entity_source,
+        "entity_source_id": entity.entity_source_id
+    }
 
 
 def _entityIn_to_entity(entity_in: EntityIn) -> EntityModel:
@@ -93,16 +485,75 @@ def _entityIn_to_entity(entity_in: EntityIn) -> EntityModel:
     )
 
 
-def _entity_to_entityOut(entity: EntityModel) -> EntityOut:
-    return EntityOut(
-        entity_id=entity.entity_id,
-        mention=entity.mention,
-        entity_source=entity.entity_source,
-        entity_source_id=entity.entity_source_id,
-        has_cluster=entity.has_cluster,
-        cluster_id=entity.cluster_id if entity.has_cluster else '',
-        has_mention_vector=entity.has_mention_vector,
-    )
+def entity_fields(
+    fields: Optional[str] = Query(
+        default=None, description="Comma separated EntityOut fields, entity_id is always returned"),
+    include_vector: bool = False
+) -> frozenset[str]:
+    """
+    Fields of the returned entities. The mention vector is only returned
+    with `include_vector=true`.
+    """
+    if fields is None:
+        projection = DEFAULT_ENTITY_FIELDS
+    else:
+        projection = frozenset(field.strip() for field in fields.split(",") if field.strip())
+        unknown = projection - set(ENTITY_FIELDS) - {"entity_id"}
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown fields {sorted(unknown)}, expected any of {list(ENTITY_FIELDS)}")
+    if include_vector:
+        projection |= {"mention_vector"}
+    return projection
+
+
+def _mention_vector_list(entity: EntityModel) -> Optional[list[float]]:
+    return np.asarray(entity.mention_vector).tolist() if entity.has_mention_vector else None
+
+
+def _mention_vector_array(entity: EntityModel) -> Optional[np.ndarray]:
+    # float64, orjson then writes the same digits as the float list would
+    return np.asarray(entity.mention_vector, dtype=np.float64) if entity.has_mention_vector else None
+
+
+_ENTITY_VALUES = {
+    "mention": lambda entity: entity.mention,
+    "entity_source": lambda entity: entity.entity_source,
+    "entity_source_id": lambda entity: entity.entity_source_id,
+    "has_cluster": lambda entity: entity.has_cluster,
+    "cluster_id": lambda entity: entity.cluster_id if entity.has_cluster else '',
+    "has_mention_vector": lambda entity: entity.has_mention_vector,
+}
+
+
+def _entity_values(entity: EntityModel, fields: frozenset[str], vector) -> dict:
+    values = {"entity_id": entity.entity_id}
+    for field, value in _ENTITY_VALUES.items():
+        if field in fields:
+            values[field] = value(entity)
+    if "mention_vector" in fields:
+        values["mention_vector"] = vector(entity)
+    return values
+
+
+def _entity_to_entityOut(entity: EntityModel, fields: frozenset[str] = None) -> EntityOut:
+    return EntityOut(**_entity_values(entity, fields or DEFAULT_ENTITY_FIELDS, _mention_vector_list))
+
+
+def _entity_to_entityOut_dict(entity: EntityModel, fields: frozenset[str] = None) -> dict:
+    return _entity_values(entity, fields or DEFAULT_ENTITY_FIELDS, _mention_vector_list)
+
+
+def _entities_response(entities: list[EntityModel], fields: frozenset[str] = None):
+    # The orjson encoder writes the dicts straight to the response body, the
+    # pydantic one builds EntityOut models that FastAPI validates again.
+    if RESPONSE_ENCODER == "orjson":
+        return ORJSONResponse([
+            _entity_values(entity, fields or DEFAULT_ENTITY_FIELDS, _mention_vector_array)
+            for entity in entities
+        ])
+    return [_entity_to_entityOut(entity, fields) for entity in entities]
 
 
 app = FastAPI(
@@ -114,9 +565,28 @@ app = FastAPI(
 )
 
 if SYSTEM_TYPE == "base":
+    repository_journal = RepositoryJournal(
+        DATA_PATH / "repository_journal.jsonl", compact_after=JOURNAL_COMPACT_AFTER)
+
+if SYSTEM_TYPE == "base" and REPOSITORY_MODE == "shared":
+    # Requests never touch `entity_repository`, the file locks are only taken
+    # by the loader and around appending to the journal.
+    shared_entities = SharedEntityRepository(SharedTable(SHARED_REPOSITORY_PATH))
+    shared_journal = RepositoryJournal(DATA_PATH / "repository_journal.jsonl")
+    loader_lock = LoaderLock(SHARED_REPOSITORY_PATH / "loader.lock")
+    repository_locks = [ReadWriteFileLock(f"{file}.lock")
+                        for file in [DATA_PATH / "entity_repository.json", DATA_PATH / "repository_journal.jsonl"]]
+elif SYSTEM_TYPE == "base":
     app.add_middleware(FileLockerMiddleware,
-                       files_to_lock=[DATA_PATH / "entity_repository.json"],
-                       before=read_base_entity_repository, after=write_base_entity_repository)
+                       files_to_lock=[DATA_PATH / "entity_repository.json",
+                                      DATA_PATH / "repository_journal.jsonl"],
+                       before=sync_base_entity_repository, after=compact_base_entity_repository,
+                       is_dirty=base_entity_repository_dirty, pool=repository_pool)
+
+
+@app.exception_handler(PoolFullException)
+async def pool_full_handler(request: Request, exc: PoolFullException):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
 
 @app.on_event("startup")
@@ -124,102 +594,200 @@ async def startup_event():
     if SYSTEM_TYPE == "neo4j":
         neo4j_entity_repository()
 
+    elif SYSTEM_TYPE == "base" and REPOSITORY_MODE == "shared":
+        asyncio.create_task(run_shared_loader())
+
     elif SYSTEM_TYPE == "base":
-        read_base_entity_repository()
+        sync_base_entity_repository()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if neo4j_batch_writer is not None:
+        neo4j_batch_writer.close()
+    repository_pool.shutdown()
+    await auth_client.close()
 
 
 async def auth_required(security_scopes: SecurityScopes, token: dict = Depends(o_auth2_scheme)):
-    response = httpx.get(
-        f'{AUTH_SERVICE_URL}/verify',
-        headers={'Authorization': f"Bearer {token}"}
-    )
-    if response.status_code != 200:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    user = await auth_client.verify(token)
+    check_scopes(user, security_scopes.scopes)
+    return user
 
-    if 'admin' in response.json()["scopes"]:
-        return response.json()
 
-    if 'admin' in security_scopes.scopes:
-        if 'admin' not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
+@app.get("/metrics")
+async def get_metrics(user: dict = Security(auth_required, scopes=["admin"])):
+    return {
+        "repository_writes": FileLockerMiddleware.write_stats,
+        "pools": WorkerPool.all_stats()
+    }
 
-    for scope in security_scopes.scopes:
-        if scope != "admin" and scope not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
 
-    return response.json()
+def _list_entities() -> list[EntityModel]:
+    return list(get_entity_repository().get_all_entities())
 
 
-@app.get("/", response_model=list[EntityOut])
+# EntityOut fields that were not asked for are left unset and not returned
+@app.get("/", response_model=list[EntityOut], response_model_exclude_unset=True)
 async def get_entities(
+    fields: frozenset[str] = Depends(entity_fields),
     user: dict = Security(auth_required, scopes=[])
 ):
-    _all_entites: list[EntityModel] = entity_repository.get_all_entities()
-    return [_entity_to_entityOut(entity) for entity in _all_entites]
+    _all_entites: list[EntityModel] = await repository_pool.run(_list_entities)
+    return _entities_response(_all_entites, fields)
 
 
-@app.get("/entity/{entity_id}", response_model=EntityOut)
-async def get_entity(entity_id: str, user: dict = Security(auth_required, scopes=[])):
+@app.get("/page", response_model=EntityPageOut, response_model_exclude_unset=True)
+async def get_entities_page(
+    limit: int = Query(default=100, gt=0, le=10000),
+    after: Optional[str] = None,
+    has_cluster: Optional[bool] = None,
+    entity_source: Optional[str] = None,
+    fields: frozenset[str] = Depends(entity_fields),
+    user: dict = Security(auth_required, scopes=[])
+):
+    ids, entities = await repository_pool.run(get_sorted_entities)
+    start = bisect_right(ids, after) if after is not None else 0
+    page: list[EntityModel] = []
+    next_after = None
+    for index in range(start, len(entities)):
+        entity = entities[index]
+        if not _entity_matches(entity, has_cluster, entity_source):
+            continue
+        if len(page) == limit:
+            next_after = page[-1].entity_id
+            break
+        page.append(entity)
+    if RESPONSE_ENCODER == "orjson":
+        return ORJSONResponse({
+            "entities": [_entity_values(entity, fields, _mention_vector_array) for entity in page],
+            "next_after": next_after
+        })
+    return EntityPageOut(
+        entities=[_entity_to_entityOut(entity, fields) for entity in page],
+        next_after=next_after
+    )
+
+
+@app.get("/stream")
+async def stream_entities(
+    has_cluster: Optional[bool] = None,
+    entity_source: Optional[str] = None,
+    chunk_size: int = Query(default=1000, gt=0),
+    fields: frozenset[str] = Depends(entity_fields),
+    user: dict = Security(auth_required, scopes=[])
+):
+    # The file locks are released once streaming starts, so the generator
+    # works on its own list of the entities.
+    _all_entites: list[EntityModel] = await repository_pool.run(_list_entities)
+
+    def encode():
+        lines = []
+        for entity in _all_entites:
+            if not _entity_matches(entity, has_cluster, entity_source):
+                continue
+            lines.append(json.dumps(_entity_to_entityOut_dict(entity, fields)))
+            if len(lines) == chunk_size:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return StreamingResponse(encode(), media_type="application/x-ndjson")
+
+
+@app.get("/entity/{entity_id}", response_model=EntityOut, response_model_exclude_unset=True)
+async def get_entity(entity_id: str, fields: frozenset[str] = Depends(entity_fields),
+                     user: dict = Security(auth_required, scopes=[])):
+    repository = get_entity_repository()
     try:
-        entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+        entity: EntityModel = repository.get_entity_by_id(entity_id)
     except NotFoundException as e:
         raise HTTPException(status_code=404, detail=e.message)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return _entity_to_entityOut(entity)
+    return _entity_to_entityOut(entity, fields)
 
 
-@app.get("/entity/source/{entity_source}", response_model=list[EntityOut])
-async def get_entities_by_source(entity_source: str, user: dict = Security(auth_required, scopes=[])):
+@app.get("/entity/source/{entity_source}", response_model=list[EntityOut], response_model_exclude_unset=True)
+async def get_entities_by_source(entity_source: str, fields: frozenset[str] = Depends(entity_fields),
+                                 user: dict = Security(auth_required, scopes=[])):
+    repository = get_entity_repository()
     try:
-        entities: list[EntityModel] = entity_repository.get_entities_by_source(entity_source)
+        entities: list[EntityModel] = await repository_pool.run(find_entities_by_source, repository, entity_source)
+    except PoolFullException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return [
-        _entity_to_entityOut(entity)
-        for entity in entities
-    ]
+    return _entities_response(entities, fields)
 
 
-@app.get("/entity/source/{entity_source}/{entity_source_id}", response_model=EntityOut)
-async def get_entity_by_source_id(entity_source: str, entity_source_id: str, user: dict = Security(auth_required, scopes=[])):
+@app.get("/entity/source/{entity_source}/{entity_source_id}", response_model=EntityOut, response_model_exclude_unset=True)
+async def get_entity_by_source_id(entity_source: str, entity_source_id: str,
+                                  fields: frozenset[str] = Depends(entity_fields),
+                                  user: dict = Security(auth_required, scopes=[])):
+    repository = get_entity_repository()
     try:
-        entity: EntityModel = entity_repository.get_entity_by_source_id(
-            entity_source, entity_source_id)
-    except NotFoundException as e:
-        raise HTTPException(status_code=404, detail=e.message)
+        entity: Optional[EntityModel] = find_entity_by_source_id(repository, entity_source, entity_source_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return _entity_to_entityOut(entity)
-
-
-@app.get("/next-entity", response_model=EntityOut)
-async def get_next_entity(user: dict = Security(auth_required, scopes=[])):
+    if entity is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Entity with source {entity_source} and source id {entity_source_id} not found")
+    return _entity_to_entityOut(entity, fields)
+
+
+@app.post("/entity/source/lookup", response_model=list[SourceLookupOut], response_model_exclude_unset=True)
+async def lookup_entities_by_source_ids(lookup: SourceLookupIn, fields: frozenset[str] = Depends(entity_fields),
+                                        user: dict = Security(auth_required, scopes=[])):
+    repository = get_entity_repository()
+    keys = [(key.entity_source, key.entity_source_id) for key in lookup.keys]
     try:
-        entity: EntityModel = entity_repository.get_random_unlabeled_entity()
-    except NotFoundException as e:
-        raise HTTPException(status_code=404, detail=e.message)
+        entities: list[Optional[EntityModel]] = await repository_pool.run(
+            find_entities_by_source_ids, repository, keys)
+    except PoolFullException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return _entity_to_entityOut(entity)
+    return [
+        SourceLookupOut(
+            entity_source=key.entity_source,
+            entity_source_id=key.entity_source_id,
+            found=entity is not None,
+            entity=_entity_to_entityOut(entity, fields) if entity is not None else None)
+        for key, entity in zip(lookup.keys, entities)
+    ]
 
 
-@app.get("/next-entity", response_model=EntityOut)
-async def get_next_entity(num: int = 1, user: dict = Security(auth_required, scopes=[])):
+@app.get("/next-entity", response_model=list[EntityOut], response_model_exclude_unset=True)
+async def get_next_entities(
+    num: int = Query(default=1, gt=0, le=1000),
+    fields: frozenset[str] = Depends(entity_fields),
+    user: dict = Security(auth_required, scopes=[])
+):
+    """
+    Returns up to `num` distinct random entities that are not in a cluster.
+    """
+    repository = get_entity_repository()
     try:
-        entities: list[EntityModel] = entity_repository.get_random_unlabeled_entities(num)
+        entities: list[EntityModel] = sample_unlabeled_entities(repository, num)
     except NotFoundException as e:
         raise HTTPException(status_code=404, detail=e.message)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return [
-        _entity_to_entityOut(entity)
-        for entity in entities
-    ]
+    if not entities:
+        raise HTTPException(status_code=404, detail="No unlabeled entities found")
+    return _entities_response(entities, fields)
 
 
-@app.post("/entity/create", response_model=EntityOut, status_code=201)
+@app.post("/entity/create", response_model=EntityOut, response_model_exclude_unset=True, status_code=201)
 async def create_entity(entity_in: EntityIn, user: dict = Security(auth_required, scopes=["editor"])):
+    if shared_entities is not None:
+        created = await create_shared_entities([entity_in])
+        if not created:
+            raise HTTPException(status_code=409, detail=f"Entity with id {entity_in.entity_id} already exists")
+        return _entity_to_entityOut(created[0])
     entity: EntityModel = _entityIn_to_entity(entity_in)
     try:
         entity = entity_repository.add_entity(entity)
@@ -227,30 +795,55 @@ async def create_entity(entity_in: EntityIn, user: dict = Security(auth_required
         raise HTTPException(status_code=409, detail=e.message)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("add_entities", entities=[_entity_to_dict(entity)])
     return _entity_to_entityOut(entity)
 
 
-@app.post("/create", response_model=list[EntityOut], status_code=201)
+def create_entities_batched(entities: list[EntityModel]) -> list[EntityModel]:
+    """
+    Neo4J version of `add_entities(..., suppress_exceptions=True)`: the
+    entities are created with batched statements instead of one transaction
+    per entity, existing ids are skipped. The nodes get the fields the journal
+    records for an entity.
+    """
+    new_entities = {}
+    for entity in entities:
+        new_entities.setdefault(entity.entity_id, entity)
+    records = neo4j_batch_writer.write(
+        CREATE_ENTITIES, [_entity_to_dict(entity) for entity in new_entities.values()])
+    return [new_entities[record["entity_id"]] for record in records]
+
+
+@app.post("/create", response_model=list[EntityOut], response_model_exclude_unset=True, status_code=201)
 async def create_entities(entities_in: list[EntityIn], user: dict = Security(auth_required, scopes=["editor"])):
+    if shared_entities is not None:
+        return [_entity_to_entityOut(entity) for entity in await create_shared_entities(entities_in)]
     entities: list[EntityModel] = [
         _entityIn_to_entity(entity)
         for entity in entities_in
     ]
     try:
-        entities = entity_repository.add_entities(entities, suppress_exceptions=True)
+        if neo4j_batch_writer is not None:
+            entities = await repository_pool.run(create_entities_batched, entities)
+        else:
+            entities = await repository_pool.run(entity_repository.add_entities, entities, suppress_exceptions=True)
+    except PoolFullException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("add_entities", entities=[_entity_to_dict(entity) for entity in entities])
     return [
         _entity_to_entityOut(entity)
         for entity in entities
     ]
 
 
-@app.post("/entity/{entity_id}/update", response_model=EntityOut, status_code=200)
+@app.post("/entity/{entity_id}/update", response_model=EntityOut, response_model_exclude_unset=True, status_code=200)
 async def update_entity(entity_id: str, entity_in: EntityIn, user: dict = Security(auth_required, scopes=["editor"])):
     entity: EntityModel = _entityIn_to_entity(entity_in)
+    repository = get_entity_repository()
     try:
-        org_entity = entity_repository.get_entity_by_id(entity_id)
+        org_entity = repository.get_entity_by_id(entity_id)
     except NotFoundException as e:
         raise HTTPException(status_code=404, detail=e.message)
     except Exception as e:
@@ -260,17 +853,23 @@ async def update_entity(entity_id: str, entity_in: EntityIn, user: dict = Securi
         # TODO: adapt update to cluster
         raise HTTPException(status_code=409, detail="Entity is in cluster and cannot be updated")
 
+    if shared_entities is not None:
+        await journal_shared_changes([("update_entity", {"entity": _entity_to_dict(entity)})])
+        return _entity_to_entityOut(get_entity_repository().get_entity_by_id(entity.entity_id))
+
     try:
         entity = entity_repository.update_entity(entity)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("update_entity", entity=_entity_to_dict(entity))
     return _entity_to_entityOut(entity)
 
 
 @app.delete("/entity/{entity_id}/delete", status_code=204)
 async def delete_entity(entity_id: str, user: dict = Security(auth_required, scopes=["editor"])):
+    repository = get_entity_repository()
     try:
-        entity = entity_repository.get_entity_by_id(entity_id)
+        entity = repository.get_entity_by_id(entity_id)
     except NotFoundException as e:
         raise HTTPException(status_code=404, detail=e.message)
     except Exception as e:
@@ -279,44 +878,84 @@ async def delete_entity(entity_id: str, user: dict = Security(auth_required, sco
     if entity.has_cluster:
         raise HTTPException(status_code=409, detail="Entity is in a cluster and cannot be deleted")
 
+    if shared_entities is not None:
+        await journal_shared_changes([("delete_entities", {"entity_ids": [entity_id]})])
+        return
+
     try:
         entity_repository.delete_entity(entity_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    journal_change("delete_entities", entity_ids=[entity_id])
 
 
 @app.delete("/delete", status_code=204)
 async def delete_entities(payload: DeleteEntitiesIn, user: dict = Security(auth_required, scopes=["editor"])):
+    if shared_entities is not None:
+        await journal_shared_changes([("delete_entities", {"entity_ids": payload.entity_ids})])
+        return
     try:
-        entity_repository.delete_entities(payload.entity_ids, suppress_exceptions=True)
+        if neo4j_batch_writer is not None:
+            await repository_pool.run(neo4j_batch_writer.write, DELETE_UNLABELED_ENTITIES, payload.entity_ids)
+        else:
+            await repository_pool.run(entity_repository.delete_entities, payload.entity_ids, suppress_exceptions=True)
+    except PoolFullException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-
-
-@app.get("/export/csv", response_class=FileResponse)
-async def export_entities_csv(user: dict = Security(auth_required, scopes=["editor"])):
-    _all_entites: list[EntityModel] = entity_repository.get_all_entities()
-    pd.DataFrame([
-        {
-            'entity_id': entity.entity_id,
-            'mention': entity.mention,
-            'entity_source': entity.entity_source,
-            'entity_source_id': entity.entity_source_id,
-            'in_cluster': entity.has_cluster,
-            'cluster_id': entity.cluster_id if entity.has_cluster else '',
-            'has_mention_vector': entity.has_mention_vector,
-            'mention_vector': entity.mention_vector if entity.has_mention_vector else ''
-        }
-        for entity in _all_entites
-    ]).to_csv(
-        DATA_PATH / 'entities.csv',
-    )
-
-    return FileResponse(
-        path=DATA_PATH / 'entities.csv',
-        filename="entities.csv",
-        media_type="text/csv"
-    )
+    journal_change("delete_entities", entity_ids=payload.entity_ids)
+
+
+def _entity_to_export_row(entity: EntityModel) -> dict:
+    return {
+        'entity_id': entity.entity_id,
+        'mention': entity.mention,
+        'entity_source': entity.entity_source,
+        'entity_source_id': entity.entity_source_id,
+        'in_cluster': entity.has_cluster,
+        'cluster_id': entity.cluster_id if entity.has_cluster else '',
+        'has_mention_vector': entity.has_mention_vector,
+        'mention_vector': entity.mention_vector if entity.has_mention_vector else None
+    }
+
+
+def _export_response(chunks, filename: str, media_type: str, compress: bool = False) -> StreamingResponse:
+    if compress:
+        chunks = gzipped(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        chunks, media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+# Exports are encoded chunk by chunk while being sent. The file locks are
+# released once streaming starts, so each export works on its own list of the
+# entities.
+@app.get("/export/csv")
+async def export_entities_csv(gzip: bool = False, user: dict = Security(auth_required, scopes=["editor"])):
+    _all_entites: list[EntityModel] = await repository_pool.run(_list_entities)
+    rows = (_entity_to_export_row(entity) for entity in _all_entites)
+    return _export_response(
+        stream_csv(rows, list(ENTITY_EXPORT_COLUMNS)), "entities.csv", "text/csv", gzip)
+
+
+@app.get("/export/parquet")
+async def export_entities_parquet(user: dict = Security(auth_required, scopes=["editor"])):
+    _all_entites: list[EntityModel] = await repository_pool.run(_list_entities)
+    rows = (_entity_to_export_row(entity) for entity in _all_entites)
+    schema = arrow_schema(ENTITY_EXPORT_COLUMNS, get_word2vec_model().vector_size)
+    return _export_response(
+        stream_parquet(rows, schema), "entities.parquet", "application/vnd.apache.parquet")
+
+
+@app.get("/export/arrow")
+async def export_entities_arrow(gzip: bool = False, user: dict = Security(auth_required, scopes=["editor"])):
+    _all_entites: list[EntityModel] = await repository_pool.run(_list_entities)
+    rows = (_entity_to_export_row(entity) for entity in _all_entites)
+    schema = arrow_schema(ENTITY_EXPORT_COLUMNS, get_word2vec_model().vector_size)
+    return _export_response(
+        stream_arrow(rows, schema), "entities.arrows", "application/vnd.apache.arrow.stream", gzip)
 
 
 if __name__ == "__main__":
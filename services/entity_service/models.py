@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Optional
 
 
 class EntityIn(BaseModel):
@@ -9,14 +10,37 @@ class EntityIn(BaseModel):
 
 
 class EntityOut(BaseModel):
+    # Only entity_id is always set, the endpoints return the projected fields
     entity_id: str
-    mention: str
-    entity_source: str
-    entity_source_id: str
-    has_cluster: bool
-    cluster_id: str
-    has_mention_vector: bool
+    mention: Optional[str] = None
+    entity_source: Optional[str] = None
+    entity_source_id: Optional[str] = None
+    has_cluster: Optional[bool] = None
+    cluster_id: Optional[str] = None
+    has_mention_vector: Optional[bool] = None
+    mention_vector: Optional[list[float]] = None
 
 
 class DeleteEntitiesIn(BaseModel):
     entity_ids: list[str]
+
+
+class EntityPageOut(BaseModel):
+    entities: list[EntityOut]
+    next_after: Optional[str] = None
+
+
+class SourceKeyIn(BaseModel):
+    entity_source: str
+    entity_source_id: str
+
+
+class SourceLookupIn(BaseModel):
+    keys: list[SourceKeyIn]
+
+
+class SourceLookupOut(BaseModel):
+    entity_source: str
+    entity_source_id: str
+    found: bool
+    entity: Optional[EntityOut] = None
@@ -0,0 +1,208 @@
+from shared_repository import SharedTable
+from eec import EntityModel, NotFoundException
+from typing import Iterable, Optional, Sequence
+from bisect import bisect_left
+import pyarrow.compute as pc
+import pyarrow as pa
+import numpy as np
+import random
+
+
+ENTITY_SCHEMA = pa.schema([
+    ("entity_id", pa.string()),
+    ("mention", pa.string()),
+    ("entity_source", pa.string()),
+    ("entity_source_id", pa.string()),
+    ("cluster_id", pa.string()),
+    # Row of the mention vector in the vector matrix, -1 without one
+    ("vector_row", pa.int64()),
+])
+
+
+class SharedEntity:
+    """
+    Read-only stand-in for an EntityModel read from a published SharedTable,
+    with the attributes the endpoints use.
+    """
+    __slots__ = ("entity_id", "mention", "entity_source", "entity_source_id", "cluster_id", "mention_vector")
+
+    def __init__(self, entity_id: str, mention: str, entity_source: str, entity_source_id: str,
+                 cluster_id: Optional[str], mention_vector: Optional[np.ndarray]):
+        self.entity_id = entity_id
+        self.mention = mention
+        self.entity_source = entity_source
+        self.entity_source_id = entity_source_id
+        self.cluster_id = cluster_id
+        self.mention_vector = mention_vector
+
+    @property
+    def has_cluster(self) -> bool:
+        return self.cluster_id is not None
+
+    @property
+    def has_mention_vector(self) -> bool:
+        return self.mention_vector is not None
+
+
+class SharedNotFoundException(NotFoundException):
+    # Raised like the repository's own exception, so the endpoints handle both
+    # the same way.
+    def __init__(self, message: str):
+        Exception.__init__(self, message)
+        self.message = message
+
+
+class _Column(Sequence):
+    # Lets bisect search a sorted Arrow column without converting it.
+    def __init__(self, array: pa.Array):
+        self.array = array
+
+    def __len__(self) -> int:
+        return len(self.array)
+
+    def __getitem__(self, index: int):
+        return self.array[index].as_py()
+
+
+class _Entities(Sequence):
+    def __init__(self, repository: "SharedEntityRepository"):
+        self.repository = repository
+
+    def __len__(self) -> int:
+        return len(self.repository.entity_ids)
+
+    def __getitem__(self, row: int) -> SharedEntity:
+        return self.repository.entity(row)
+
+
+def publish_entities(table: SharedTable, entities: Iterable[EntityModel], **meta):
+    """
+    Publishes the entities ordered by entity_id, the order the readers bisect.
+    """
+    entities = sorted(entities, key=lambda entity: entity.entity_id)
+    vectors = [entity.mention_vector for entity in entities if entity.has_mention_vector]
+    # Only entities with a mention vector get a row in the vector matrix
+    vector_rows = np.full(len(entities), -1, dtype=np.int64)
+    has_vector = np.array([entity.has_mention_vector for entity in entities], dtype=bool)
+    vector_rows[has_vector] = np.arange(int(has_vector.sum()))
+    table.publish({
+        "entity_id": [entity.entity_id for entity in entities],
+        "mention": [entity.mention for entity in entities],
+        "entity_source": [entity.entity_source for entity in entities],
+        "entity_source_id": [entity.entity_source_id for entity in entities],
+        "cluster_id": [entity.cluster_id if entity.has_cluster else None for entity in entities],
+        "vector_row": vector_rows,
+    }, np.stack(vectors) if vectors else None, schema=ENTITY_SCHEMA, **meta)
+
+
+class SharedEntityRepository:
+    """
+    Serves the read methods of the entity repository from the copy the loader
+    published, so the worker does not hold a repository of its own.
+    """
+
+    def __init__(self, table: SharedTable):
+        self.table = table
+        self.manifest: dict = None
+        self.entity_ids: _Column = None
+        self.unlabeled_rows: np.ndarray = None
+
+    @property
+    def seq(self) -> int:
+        return self.table.meta["seq"]
+
+    def refresh(self) -> bool:
+        if not self.table.refresh():
+            return False
+        if self.table.manifest is not self.manifest:
+            self.manifest = self.table.manifest
+            self.entity_ids = _Column(self.table.table.column("entity_id").combine_chunks())
+            self.unlabeled_rows = np.flatnonzero(
+                self.table.table.column("cluster_id").is_null().to_numpy())
+        return True
+
+    def entity(self, row: int) -> SharedEntity:
+        columns = self.table.table
+        vector_row = columns.column("vector_row")[row].as_py()
+        return SharedEntity(
+            entity_id=columns.column("entity_id")[row].as_py(),
+            mention=columns.column("mention")[row].as_py(),
+            entity_source=columns.column("entity_source")[row].as_py(),
+            entity_source_id=columns.column("entity_source_id")[row].as_py(),
+            cluster_id=columns.column("cluster_id")[row].as_py(),
+            mention_vector=self.table.vectors[vector_row] if vector_row >= 0 else None)
+
+    def _entities(self, rows: Iterable[int]) -> list[SharedEntity]:
+        return [self.entity(int(row)) for row in rows]
+
+    def find(self, entity_id: str) -> Optional[int]:
+        row = bisect_left(self.entity_ids, entity_id)
+        if row < len(self.entity_ids) and self.entity_ids[row] == entity_id:
+            return row
+        return None
+
+    def get_all_entities(self) -> list[SharedEntity]:
+        columns = {name: self.table.table.column(name).to_pylist() for name in ENTITY_SCHEMA.names}
+        return [
+            SharedEntity(
+                entity_id=columns["entity_id"][row],
+                mention=columns["mention"][row],
+                entity_source=columns["entity_source"][row],
+                entity_source_id=columns["entity_source_id"][row],
+                cluster_id=columns["cluster_id"][row],
+                mention_vector=self.table.vectors[vector_row] if vector_row >= 0 else None)
+            for row, vector_row in enumerate(columns["vector_row"])
+        ]
+
+    def get_sorted_entities(self) -> tuple[Sequence[str], Sequence[SharedEntity]]:
+        return self.entity_ids, _Entities(self)
+
+    def get_entity_by_id(self, entity_id: str) -> SharedEntity:
+        row = self.find(entity_id)
+        if row is None:
+            raise SharedNotFoundException(f"Entity with id {entity_id} not found")
+        return self.entity(row)
+
+    def _matching_rows(self, **values) -> np.ndarray:
+        mask = None
+        for name, value in values.items():
+            matches = pc.fill_null(pc.equal(self.table.table.column(name), value), False)
+            mask = matches if mask is None else pc.and_(mask, matches)
+        return np.flatnonzero(mask.to_numpy())
+
+    def get_entities_by_source(self, entity_source: str) -> list[SharedEntity]:
+        return self._entities(self._matching_rows(entity_source=entity_source))
+
+    def get_entity_by_source_id(self, entity_source: str, entity_source_id: str) -> SharedEntity:
+        rows = self._matching_rows(entity_source=entity_source, entity_source_id=entity_source_id)
+        if len(rows) == 0:
+            raise SharedNotFoundException(
+                f"Entity with source {entity_source} and source id {entity_source_id} not found")
+        return self.entity(int(rows[0]))
+
+    def get_entities_by_source_ids(self, keys: list[tuple[str, str]]) -> list[Optional[SharedEntity]]:
+        """
+        Resolves all (entity_source, entity_source_id) pairs with a single scan
+        of the source id column, None for the pairs without an entity.
+        """
+        if not keys:
+            return []
+        columns = self.table.table
+        rows = np.flatnonzero(pc.fill_null(pc.is_in(
+            columns.column("entity_source_id"),
+            value_set=pa.array({source_id for _, source_id in keys}, pa.string())), False).to_numpy())
+        sources = columns.column("entity_source").take(rows).to_pylist()
+        source_ids = columns.column("entity_source_id").take(rows).to_pylist()
+        found: dict[tuple[str, str], int] = {}
+        for row, key in zip(rows, zip(sources, source_ids)):
+            found.setdefault(key, int(row))
+        return [self.entity(found[key]) if key in found else None for key in keys]
+
+    def get_random_unlabeled_entities(self, num: int) -> list[SharedEntity]:
+        if len(self.unlabeled_rows) == 0:
+            raise SharedNotFoundException("No unlabeled entity found")
+        rows = random.sample(range(len(self.unlabeled_rows)), min(num, len(self.unlabeled_rows)))
+        return self._entities(self.unlabeled_rows[rows])
+
+    def get_random_unlabeled_entity(self) -> SharedEntity:
+        return self.get_random_unlabeled_entities(1)[0]
@@ -0,0 +1,68 @@
+from typing import Iterable, Optional
+from eec import EntityModel
+
+
+class SourceIndex:
+    """
+    Secondary indexes of the in-memory repository for the dedupe lookups of
+    the ingestion pipeline: entity_source -> entity_source_id -> entity ids,
+    plus the key of every entity so changes can move or drop it. Both
+    lookups are dict accesses instead of scans over all entities.
+    """
+
+    def __init__(self, entities: Iterable[EntityModel] = ()):
+        self.by_source: dict[str, dict[str, list[str]]] = {}
+        self.keys: dict[str, tuple[str, str]] = {}
+        for entity in entities:
+            self.set(entity.entity_id, entity.entity_source, entity.entity_source_id)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def set(self, entity_id: str, entity_source: str, entity_source_id: str):
+        key = (entity_source, entity_source_id)
+        if self.keys.get(entity_id) == key:
+            return
+        self.discard(entity_id)
+        self.keys[entity_id] = key
+        self.by_source.setdefault(entity_source, {}).setdefault(entity_source_id, []).append(entity_id)
+
+    def discard(self, entity_id: str):
+        key = self.keys.pop(entity_id, None)
+        if key is None:
+            return
+        entity_source, entity_source_id = key
+        source_ids = self.by_source[entity_source]
+        entity_ids = source_ids[entity_source_id]
+        entity_ids.remove(entity_id)
+        if not entity_ids:
+            del source_ids[entity_source_id]
+            if not source_ids:
+                del self.by_source[entity_source]
+
+    def ids_by_source(self, entity_source: str) -> list[str]:
+        return [
+            entity_id
+            for entity_ids in self.by_source.get(entity_source, {}).values()
+            for entity_id in entity_ids
+        ]
+
+    def find(self, entity_source: str, entity_source_id: str) -> Optional[str]:
+        """
+        The first entity added with the key if several share it.
+        """
+        entity_ids = self.by_source.get(entity_source, {}).get(entity_source_id)
+        return entity_ids[0] if entity_ids else None
+
+
+def changed_source_entity_ids(op: str, data: dict) -> list[str]:
+    """
+    Entities whose source key a journal operation may have changed.
+    """
+    if op == "add_entities":
+        return [entity["entity_id"] for entity in data["entities"]]
+    if op == "update_entity":
+        return [data["entity"]["entity_id"]]
+    if op == "delete_entities":
+        return data["entity_ids"]
+    return []
@@ -0,0 +1,513 @@
+from pathlib import Path
+from typing import Iterable
+import numpy as np
+import threading
+import logging
+import json
+import time
+import os
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+class ClusterVectorIndex:
+    """
+    Holds the vectors of all clusters as one contiguous, L2 normalized float32
+    matrix, so the clusters closest to a mention (by cosine similarity) are
+    found with a single matrix-vector product and an argpartition. Rows are
+    updated in place when a cluster changes; removed clusters are replaced by
+    the last row. Clusters without a usable vector (e.g. empty clusters) are
+    kept in the index but never suggested.
+
+    Queries run on pool threads while changes are applied on the event loop.
+    Every change and every query (per chunk of a batch) holds `lock`, so a
+    query never reads a half applied swap-remove or grow. `version` counts
+    the changes, so results computed over several chunks can be checked
+    against changes that happened in between.
+    """
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.cluster_ids: list[str] = []
+        self.positions: dict[str, int] = {}
+        self.lock = threading.RLock()
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self.cluster_ids)
+
+    def __contains__(self, cluster_id: str) -> bool:
+        return cluster_id in self.positions
+
+    def normalize(self, vector) -> tuple[np.ndarray, bool]:
+        if vector is None:
+            return np.zeros(self.dim, dtype=np.float32), False
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if vector.shape != (self.dim,) or not np.isfinite(norm) or norm == 0:
+            return np.zeros(self.dim, dtype=np.float32), False
+        return vector / norm, True
+
+    def _grow(self):
+        capacity = max(1, len(self.matrix)) * 2
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[:len(self)] = self.matrix[:len(self)]
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:len(self)] = self.valid[:len(self)]
+        self.matrix, self.valid = matrix, valid
+
+    def build(self, clusters: Iterable[tuple[str, np.ndarray]]):
+        with self.lock:
+            self.cluster_ids = []
+            self.positions = {}
+            self.valid[:] = False
+            self.version += 1
+            for cluster_id, vector in clusters:
+                self.upsert(cluster_id, vector)
+
+    def upsert(self, cluster_id: str, vector) -> np.ndarray:
+        """
+        Sets the vector of a cluster and returns its previous normalized
+        vector (None for new clusters).
+        """
+        normalized, valid = self.normalize(vector)
+        with self.lock:
+            position = self.positions.get(cluster_id)
+            previous = None
+            if position is None:
+                if len(self) == len(self.matrix):
+                    self._grow()
+                position = len(self)
+                self.cluster_ids.append(cluster_id)
+                self.positions[cluster_id] = position
+            elif self.valid[position]:
+                previous = self.matrix[position].copy()
+            self.matrix[position] = normalized
+            self.valid[position] = valid
+            self.version += 1
+        return previous
+
+    def remove(self, cluster_id: str):
+        with self.lock:
+            position = self.positions.pop(cluster_id, None)
+            if position is None:
+                return
+            last = len(self) - 1
+            last_id = self.cluster_ids.pop()
+            if position != last:
+                self.matrix[position] = self.matrix[last]
+                self.valid[position] = self.valid[last]
+                self.cluster_ids[position] = last_id
+                self.positions[last_id] = position
+            self.matrix[last] = 0
+            self.valid[last] = False
+            self.version += 1
+
+    def _select(self, scores: np.ndarray, n: int) -> list[tuple[str, float]]:
+        n = min(n, len(scores))
+        if n <= 0:
+            return []
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        return [(self.cluster_ids[i], float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def top_n(self, vector, n: int) -> list[tuple[str, float]]:
+        """
+        Returns up to n (cluster_id, cosine similarity) pairs, most similar
+        first.
+        """
+        query, valid = self.normalize(vector)
+        if not valid:
+            return []
+        with self.lock:
+            size = len(self)
+            if size == 0:
+                return []
+            scores = self.matrix[:size] @ query
+            scores[~self.valid[:size]] = -np.inf
+            return self._select(scores, n)
+
+    def top_n_batch(self, vectors: list, n: int, chunk_size: int = 64) -> list[list[tuple[str, float]]]:
+        """
+        Same as `top_n` for many vectors at once, scored with one matrix
+        product per `chunk_size` vectors. Vectors that are not usable get no
+        suggestions.
+        """
+        if len(vectors) == 0:
+            return []
+        results = []
+        for start in range(0, len(vectors), chunk_size):
+            queries, valid = zip(*(self.normalize(vector) for vector in vectors[start:start + chunk_size]))
+            # Locked per chunk, so changes are not held up by a whole batch
+            with self.lock:
+                size = len(self)
+                if size == 0:
+                    results.extend([] for _ in queries)
+                    continue
+                scores = np.stack(queries) @ self.matrix[:size].T
+                scores[:, ~self.valid[:size]] = -np.inf
+                results.extend(self._select(row, n) if is_valid else []
+                               for row, is_valid in zip(scores, valid))
+        return results
+
+    def save(self):
+        """
+        Persists the index files of backends that keep any, the exact index is
+        rebuilt from the repository.
+        """
+
+
+class IVFClusterIndex(ClusterVectorIndex):
+    """
+    Inverted file index on top of the exact index: clusters are assigned to
+    the nearest of `n_lists` centroids found with spherical k-means, and a
+    query only scores the clusters of its `n_probe` closest lists.
+
+    Centroids are retrained in a background thread once more than
+    `rebuild_fraction` of the clusters changed since the last training, and
+    are persisted to `index_file` so a restart does not have to retrain. Until
+    the first training finished (or with fewer than `min_train_size`
+    clusters) queries are answered exactly.
+
+    A finished training is applied by whichever caller gets to it first,
+    which may be a scoring thread, under `lock` like every other change.
+    """
+
+    def __init__(
+            self, dim: int, n_lists: int = 0, n_probe: int = 8, rebuild_fraction: float = 0.2,
+            min_train_size: int = 1000, index_file: Path = None, capacity: int = 1024
+    ):
+        super().__init__(dim, capacity)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.rebuild_fraction = rebuild_fraction
+        self.min_train_size = min_train_size
+        self.index_file = index_file
+        self.assignments = np.full(capacity, -1, dtype=np.int32)
+        self.centroids: np.ndarray = None
+        self.trained_centroids: np.ndarray = None
+        self.training: threading.Thread = None
+        self.changes = 0
+
+    def _grow(self):
+        super()._grow()
+        assignments = np.full(len(self.matrix), -1, dtype=np.int32)
+        assignments[:len(self)] = self.assignments[:len(self)]
+        self.assignments = assignments
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray = None) -> np.ndarray:
+        centroids = self.centroids if centroids is None else centroids
+        return np.argmax(vectors @ centroids.T, axis=-1).astype(np.int32)
+
+    def build(self, clusters: Iterable[tuple[str, np.ndarray]]):
+        with self.lock:
+            self.assignments[:] = -1
+            super().build(clusters)
+            self.changes = 0
+            if self.centroids is None and self.index_file is not None and self.index_file.exists():
+                centroids = np.load(self.index_file)
+                if centroids.ndim == 2 and centroids.shape[1] == self.dim:
+                    self.centroids = centroids
+                    self.assignments[:len(self)] = self._assign(self.matrix[:len(self)])
+            self._maybe_train()
+
+    def upsert(self, cluster_id: str, vector) -> np.ndarray:
+        with self.lock:
+            previous = super().upsert(cluster_id, vector)
+            if self.centroids is not None:
+                position = self.positions[cluster_id]
+                self.assignments[position] = self._assign(self.matrix[position])
+            self.changes += 1
+            self._maybe_train()
+        return previous
+
+    def remove(self, cluster_id: str):
+        with self.lock:
+            position = self.positions.get(cluster_id)
+            if position is None:
+                return
+            last = len(self) - 1
+            self.assignments[position] = self.assignments[last]
+            self.assignments[last] = -1
+            super().remove(cluster_id)
+            self.changes += 1
+            self._maybe_train()
+
+    def _maybe_train(self):
+        if self.training is not None and self.training.is_alive():
+            return
+        size = len(self)
+        if size < self.min_train_size:
+            return
+        if self.centroids is not None and self.changes <= self.rebuild_fraction * size:
+            return
+        vectors = self.matrix[:size][self.valid[:size]].copy()
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(vectors))))
+        self.changes = 0
+        self.training = threading.Thread(
+            target=self._train, args=(vectors, n_lists), daemon=True)
+        self.training.start()
+
+    def _train(self, vectors: np.ndarray, n_lists: int, iterations: int = 10):
+        rng = np.random.default_rng()
+        n_lists = min(n_lists, len(vectors))
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Lists that lost all of their vectors keep their old centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        self.trained_centroids = centroids.astype(np.float32)
+
+    def _apply_training(self):
+        if self.trained_centroids is None:
+            return
+        with self.lock:
+            centroids = self.trained_centroids
+            if centroids is None:
+                return
+            self.trained_centroids = None
+            self.centroids = centroids
+            self.assignments[:len(self)] = self._assign(self.matrix[:len(self)])
+            if self.index_file is not None:
+                temp_path = self.index_file.parent / (self.index_file.name + ".tmp")
+                with open(temp_path, "wb") as f:
+                    np.save(f, centroids)
+                os.replace(temp_path, self.index_file)
+        logging.info(f"IVF cluster index trained with {len(centroids)} lists")
+
+    def top_n(self, vector, n: int) -> list[tuple[str, float]]:
+        self._apply_training()
+        query, valid = self.normalize(vector)
+        if not valid:
+            return []
+        with self.lock:
+            if self.centroids is None:
+                return super().top_n(vector, n)
+            size = len(self)
+            if size == 0:
+                return []
+            n_probe = min(self.n_probe, len(self.centroids))
+            probes = np.zeros(len(self.centroids), dtype=bool)
+            probes[np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]] = True
+            candidates = np.flatnonzero(probes[self.assignments[:size]] & self.valid[:size])
+            if len(candidates) == 0:
+                return []
+            scores = self.matrix[candidates] @ query
+            top = np.argpartition(-scores, min(n, len(scores)) - 1)[:n]
+            top = top[np.argsort(-scores[top])]
+            return [(self.cluster_ids[candidates[i]], float(scores[i])) for i in top]
+
+    def top_n_batch(self, vectors: list, n: int, chunk_size: int = 64) -> list[list[tuple[str, float]]]:
+        self._apply_training()
+        if self.centroids is None:
+            return super().top_n_batch(vectors, n, chunk_size)
+        return [self.top_n(vector, n) for vector in vectors]
+
+
+class HNSWClusterIndex(ClusterVectorIndex):
+    """
+    Keeps an hnswlib graph next to the exact matrix. The graph is updated in
+    place on every change (deleted slots are reused) and saved to `index_file`
+    with its label mapping, so on restart only clusters whose vectors differ
+    from the saved graph have to be inserted again. Needs the optional
+    `hnswlib` package.
+    """
+
+    def __init__(
+            self, dim: int, index_file: Path = None, ef: int = 64, m: int = 16,
+            capacity: int = 1024
+    ):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the hnsw cluster index backend")
+        super().__init__(dim, capacity)
+        self.index_file = index_file
+        self.ef = ef
+        self.m = m
+        self.labels: dict[str, int] = {}
+        self.label_ids: dict[int, str] = {}
+        self.next_label = 0
+        self.graph = self._new_graph(capacity)
+
+    def _new_graph(self, capacity: int):
+        graph = hnswlib.Index(space="ip", dim=self.dim)
+        graph.init_index(max_elements=capacity, M=self.m, ef_construction=200,
+                         allow_replace_deleted=True)
+        graph.set_ef(self.ef)
+        return graph
+
+    def _load(self) -> bool:
+        labels_file = Path(f"{self.index_file}.labels.json")
+        if not self.index_file.exists() or not labels_file.exists():
+            return False
+        with open(labels_file, "r") as f:
+            labels = json.load(f)
+        graph = hnswlib.Index(space="ip", dim=self.dim)
+        graph.load_index(str(self.index_file), allow_replace_deleted=True)
+        graph.set_ef(self.ef)
+        self.graph = graph
+        self.labels = labels
+        self.label_ids = {label: cluster_id for cluster_id, label in labels.items()}
+        self.next_label = max(labels.values(), default=-1) + 1
+        return True
+
+    def save(self):
+        if self.index_file is None:
+            return
+        with self.lock:
+            temp_path = self.index_file.parent / (self.index_file.name + ".tmp")
+            self.graph.save_index(str(temp_path))
+            os.replace(temp_path, self.index_file)
+            labels_file = Path(f"{self.index_file}.labels.json")
+            with open(f"{labels_file}.tmp", "w") as f:
+                json.dump(self.labels, f)
+            os.replace(f"{labels_file}.tmp", labels_file)
+
+    def build(self, clusters: Iterable[tuple[str, np.ndarray]]):
+        with self.lock:
+            self._build(clusters)
+
+    def _build(self, clusters: Iterable[tuple[str, np.ndarray]]):
+        super().build(clusters)
+        if self.index_file is None or not self._load():
+            self.graph = self._new_graph(max(len(self.matrix), 1))
+            self.labels, self.label_ids, self.next_label = {}, {}, 0
+
+        # Reconcile the saved graph with the current clusters
+        for cluster_id in list(self.labels):
+            position = self.positions.get(cluster_id)
+            if position is None or not self.valid[position]:
+                self._delete(cluster_id)
+        changed = []
+        for cluster_id, position in self.positions.items():
+            if not self.valid[position]:
+                continue
+            label = self.labels.get(cluster_id)
+            if label is None or not np.allclose(
+                    self.graph.get_items([label])[0], self.matrix[position], atol=1e-5):
+                changed.append(cluster_id)
+        for cluster_id in changed:
+            self._insert(cluster_id)
+        self.save()
+
+    def _insert(self, cluster_id: str):
+        position = self.positions[cluster_id]
+        label = self.labels.get(cluster_id)
+        if label is None:
+            label = self.next_label
+            self.next_label += 1
+            self.labels[cluster_id] = label
+            self.label_ids[label] = cluster_id
+        if self.graph.get_current_count() >= self.graph.get_max_elements():
+            self.graph.resize_index(self.graph.get_max_elements() * 2)
+        self.graph.add_items(self.matrix[position][None, :], [label], replace_deleted=True)
+
+    def _delete(self, cluster_id: str):
+        label = self.labels.pop(cluster_id, None)
+        if label is None:
+            return
+        del self.label_ids[label]
+        self.graph.mark_deleted(label)
+
+    def upsert(self, cluster_id: str, vector) -> np.ndarray:
+        with self.lock:
+            previous = super().upsert(cluster_id, vector)
+            if self.valid[self.positions[cluster_id]]:
+                if cluster_id in self.labels:
+                    # Updated vectors are re-inserted under a new label
+                    self._delete(cluster_id)
+                self._insert(cluster_id)
+            else:
+                self._delete(cluster_id)
+        return previous
+
+    def remove(self, cluster_id: str):
+        with self.lock:
+            super().remove(cluster_id)
+            self._delete(cluster_id)
+
+    def _knn(self, queries: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+        # `labels` only holds live elements. After deletions the graph may
+        # still not reach k of them, hnswlib then raises and k is lowered.
+        k = min(n, len(self.labels))
+        while k > 0:
+            try:
+                return self.graph.knn_query(queries, k=k)
+            except RuntimeError:
+                k -= 1
+        return None, None
+
+    def _results(self, labels: np.ndarray, distances: np.ndarray) -> list[tuple[str, float]]:
+        # hnswlib reports 1 - inner product as distance for the ip space
+        return [(self.label_ids[label], float(1 - distance)) for label, distance in zip(labels, distances)]
+
+    def top_n(self, vector, n: int) -> list[tuple[str, float]]:
+        query, valid = self.normalize(vector)
+        if not valid:
+            return []
+        with self.lock:
+            labels, distances = self._knn(query[None, :], n)
+            if labels is None:
+                return []
+            return self._results(labels[0], distances[0])
+
+    def top_n_batch(self, vectors: list, n: int, chunk_size: int = 64) -> list[list[tuple[str, float]]]:
+        if len(vectors) == 0:
+            return []
+        queries, valid = zip(*(self.normalize(vector) for vector in vectors))
+        with self.lock:
+            labels, distances = self._knn(np.stack(queries), n)
+            if labels is None:
+                return [[] for _ in vectors]
+            return [
+                self._results(row_labels, row_distances) if is_valid else []
+                for row_labels, row_distances, is_valid in zip(labels, distances, valid)
+            ]
+
+
+def _percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+
+def evaluate_index(index: ClusterVectorIndex, queries: list, n: int) -> dict:
+    """
+    Compares the results of an index against exact scoring over the same
+    vectors, reporting recall@n and the latency of both in milliseconds.
+    """
+    approximate_times, exact_times = [], []
+    hits = total = 0
+    for query in queries:
+        start = time.perf_counter()
+        approximate = index.top_n(query, n)
+        approximate_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        exact = ClusterVectorIndex.top_n(index, query, n)
+        exact_times.append(time.perf_counter() - start)
+
+        hits += len({cluster_id for cluster_id, _ in approximate} & {cluster_id for cluster_id, _ in exact})
+        total += len(exact)
+    return {
+        "backend": type(index).__name__,
+        "clusters": len(index),
+        "queries": len(queries),
+        "recall": hits / total if total else 1.0,
+        "latency_ms": {
+            "approximate": _percentiles(approximate_times),
+            "exact": _percentiles(exact_times),
+        }
+    }
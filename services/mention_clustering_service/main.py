@@ -1,11 +1,21 @@
 from models import MentionOut
+from cluster_index import ClusterVectorIndex, IVFClusterIndex, HNSWClusterIndex,\
+    evaluate_index
+from suggestion_queue import SuggestionQueue
 
 from fastapi import FastAPI, Depends, HTTPException,\
-    status, Request, Security
+    status, Request, Security, Query
 from fastapi.security import OAuth2PasswordBearer,\
     OAuth2PasswordRequestForm, SecurityScopes
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from file_locker_middleware import FileLockerMiddleware
+from worker_pool import WorkerPool, PoolFullException
+from unlabeled_index import UnlabeledIndex, changed_entity_ids
+from auth_client import AuthClient, LocalAuthClient, check_scopes
+from vector_store import VectorStore, MentionVectorCache, CachedKeyedVectors
+from snapshot_codec import get_codec, read_snapshot, write_snapshot
+from repository_journal import RepositoryJournal
+from centroid_tracker import CentroidTracker, TrackedClusterRepository
 from eec.core.abstract.entity_repository import IEntityRepository
 from eec.core.abstract.cluster_repository import IClusterRepository
 from eec.core.abstract.mention_clustering_method import IMentionClusteringMethod
@@ -15,36 +25,80 @@ from eec import BaseEntityRepository, Neo4JEntityRepository,\
     AlreadyExistsException, AlreadyInClusterException, Neo4JMentionClusteringMethod, BaseMentionClusteringMethod
 from dotenv import load_dotenv
 from pathlib import Path
+from typing import Optional
 import os
-import json
 import logging
-from gensim.models import KeyedVectors
+import asyncio
 import pandas as pd
-import httpx
 
 load_dotenv()
 
 DATA_PATH = Path(os.getenv("DATA_PATH") or "data")
 LOGGER_PATH = Path(os.getenv("LOGGER_PATH") or "logs")
 SYSTEM_TYPE = os.getenv("SYSTEM_TYPE") or "base"
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC") or "auto"
+SNAPSHOT_FORMAT = os.getenv("SNAPSHOT_FORMAT") or "json"
 WORD2VEC_FILE = Path(os.getenv("WORD2VEC_FILE") or "/data/word2vec.model")
+MENTION_VECTOR_CACHE_PATH = Path(os.getenv("MENTION_VECTOR_CACHE_PATH") or DATA_PATH / "mention_vector_cache")
 
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL") or "http://eec.localhost/api/v1/auth"
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE") or 1024)
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL") or 60)
+AUTH_MODE = os.getenv("AUTH_MODE") or "remote"
+AUTH_USERS_REFRESH = float(os.getenv("AUTH_USERS_REFRESH") or 30)
+SECRET_KEY = os.getenv("SECRET_KEY")
+JOURNAL_COMPACT_AFTER = int(os.getenv("JOURNAL_COMPACT_AFTER") or 1000)
+CENTROID_RECOMPUTE_AFTER = int(os.getenv("CENTROID_RECOMPUTE_AFTER") or 1000)
+MENTION_TOP_N = int(os.getenv("MENTION_TOP_N") or 10)
+CLUSTER_INDEX_BACKEND = os.getenv("CLUSTER_INDEX_BACKEND") or "exact"
+CLUSTER_INDEX_LISTS = int(os.getenv("CLUSTER_INDEX_LISTS") or 0)
+CLUSTER_INDEX_PROBES = int(os.getenv("CLUSTER_INDEX_PROBES") or 8)
+CLUSTER_INDEX_REBUILD_FRACTION = float(os.getenv("CLUSTER_INDEX_REBUILD_FRACTION") or 0.2)
+CLUSTER_INDEX_REFRESH = float(os.getenv("CLUSTER_INDEX_REFRESH") or 0)
+SUGGESTION_QUEUE_SIZE = int(os.getenv("SUGGESTION_QUEUE_SIZE") or 256)
+SUGGESTION_QUEUE_THRESHOLD = float(os.getenv("SUGGESTION_QUEUE_THRESHOLD") or 0.05)
+SUGGESTION_QUEUE_INTERVAL = float(os.getenv("SUGGESTION_QUEUE_INTERVAL") or 1)
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE") or os.cpu_count() or 4)
+POOL_QUEUE_SIZE = int(os.getenv("POOL_QUEUE_SIZE") or 256)
 
 
 entity_repository: IEntityRepository = None
 cluster_repository: IClusterRepository = None
 mention_clustering_method: IMentionClusteringMethod = None
-last_entity_repository_update: float = None
-last_cluster_repository_update: float = None
+repository_journal: RepositoryJournal = None
+mention_vector_cache: MentionVectorCache = None
+centroid_tracker: CentroidTracker = None
+cluster_index: ClusterVectorIndex = None
+unlabeled_index: UnlabeledIndex = None
+suggestion_queue = SuggestionQueue(top_n=MENTION_TOP_N, threshold=SUGGESTION_QUEUE_THRESHOLD)
+snapshot_codec = get_codec(SNAPSHOT_CODEC)
+# Cluster scoring runs here, NumPy releases the GIL for the matrix products.
+# The file lock hooks stay on the event loop, where syncs update the cluster
+# index and the suggestion queue. Scoring overlaps with them, the index locks
+# itself and queue refills are dropped when the index changed meanwhile.
+cpu_pool = WorkerPool("cpu", CPU_POOL_SIZE, POOL_QUEUE_SIZE)
 o_auth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/api/v1/auth/login",
     scopes={"admin": "Admin access", "editor": "Editor access", "export": "Export access"})
 
+if AUTH_MODE == "local":
+    auth_client = LocalAuthClient(AUTH_SERVICE_URL, secret_key=SECRET_KEY,
+                                  refresh_interval=AUTH_USERS_REFRESH)
+else:
+    auth_client = AuthClient(AUTH_SERVICE_URL, cache_size=AUTH_CACHE_SIZE, cache_ttl=AUTH_CACHE_TTL)
+
 
 def get_word2vec_model():
     global WORD2VEC_FILE
-    return KeyedVectors.load(str(WORD2VEC_FILE))
+    return VectorStore.get(WORD2VEC_FILE)
+
+
+def get_mention_vectors() -> CachedKeyedVectors:
+    global mention_vector_cache
+    if mention_vector_cache is None:
+        mention_vector_cache = MentionVectorCache(
+            MENTION_VECTOR_CACHE_PATH, VectorStore.fingerprint(WORD2VEC_FILE), get_word2vec_model().vector_size)
+    return CachedKeyedVectors(get_word2vec_model(), mention_vector_cache)
 
 
 def neo4j_repositories():
@@ -70,70 +124,56 @@ def neo4j_repositories():
         entity_repository=entity_repository,
         cluster_repository=cluster_repository,
         name="Neo4J Mention Clustering Method",
-        top_n=10
+        top_n=MENTION_TOP_N
     )
 
 
 def read_base_entity_repository():
-    global entity_repository, last_entity_repository_update, DATA_PATH
+    global entity_repository, DATA_PATH
     ENTITY_DATA_PATH = DATA_PATH / "entity_repository.json"
 
-    if entity_repository is None or last_entity_repository_update is None or last_entity_repository_update < ENTITY_DATA_PATH.stat().st_mtime:
-        if not ENTITY_DATA_PATH.exists():
-            print("Entity repository not found. Creating new one.")
-            entity_repository = BaseEntityRepository(
-                entities=[],
-                last_id=0,
-                keyed_vectors=get_word2vec_model()
-            )
-            return
-        with open(ENTITY_DATA_PATH, "r") as f:
-            entity_repository = BaseEntityRepository.decode(
-                json.load(f), keyed_vectors=get_word2vec_model())
-        last_entity_repository_update = ENTITY_DATA_PATH.stat().st_mtime
+    if not ENTITY_DATA_PATH.exists():
+        print("Entity repository not found. Creating new one.")
+        entity_repository = BaseEntityRepository(
+            entities=[],
+            last_id=0,
+            keyed_vectors=get_mention_vectors()
+        )
+        return
+    entity_repository = BaseEntityRepository.decode(
+        read_snapshot(ENTITY_DATA_PATH, snapshot_codec), keyed_vectors=get_mention_vectors())
 
 
 def write_base_entity_repository():
-    global entity_repository, last_entity_repository_update, DATA_PATH
+    global entity_repository, DATA_PATH
     ENTITY_DATA_PATH = DATA_PATH / "entity_repository.json"
 
-    temp_path = ENTITY_DATA_PATH.parent / (ENTITY_DATA_PATH.name + ".tmp")
-    with open(temp_path, "w") as f:
-        json.dump(entity_repository.encode(), f)
-    os.replace(temp_path, ENTITY_DATA_PATH)
-    last_entity_repository_update = ENTITY_DATA_PATH.stat().st_mtime
+    write_snapshot(ENTITY_DATA_PATH, entity_repository.encode(), snapshot_codec, layout=SNAPSHOT_FORMAT)
 
 
 def read_base_cluster_repository():
-    global cluster_repository, entity_repository, last_cluster_repository_update, DATA_PATH
+    global cluster_repository, entity_repository, DATA_PATH
     CLUSTER_DATA_PATH = DATA_PATH / "cluster_repository.json"
 
-    if cluster_repository is None or last_cluster_repository_update is None or last_cluster_repository_update < CLUSTER_DATA_PATH.stat().st_mtime:
-        if not CLUSTER_DATA_PATH.exists():
-            print("Cluster repository not found. Creating new one.")
-            cluster_repository = BaseClusterRepository(
-                entity_repository=entity_repository,
-                clusters=[],
-                last_cluster_id=0
-            )
-            return
-        with open(CLUSTER_DATA_PATH, "r") as f:
-            cluster_repository = BaseClusterRepository.decode(
-                entity_repository=entity_repository,
-                cluster_repository_dict=json.load(f)
-            )
-        last_cluster_repository_update = CLUSTER_DATA_PATH.stat().st_mtime
+    if not CLUSTER_DATA_PATH.exists():
+        print("Cluster repository not found. Creating new one.")
+        cluster_repository = BaseClusterRepository(
+            entity_repository=entity_repository,
+            clusters=[],
+            last_cluster_id=0
+        )
+        return
+    cluster_repository = BaseClusterRepository.decode(
+        entity_repository=entity_repository,
+        cluster_repository_dict=read_snapshot(CLUSTER_DATA_PATH, snapshot_codec)
+    )
 
 
 def write_base_cluster_repository():
-    global cluster_repository, last_cluster_repository_update, DATA_PATH
+    global cluster_repository, DATA_PATH
     CLUSTER_DATA_PATH = DATA_PATH / "cluster_repository.json"
 
-    temp_path = CLUSTER_DATA_PATH.parent / (CLUSTER_DATA_PATH.name + ".tmp")
-    with open(temp_path, "w") as f:
-        json.dump(cluster_repository.encode(), f)
-    os.replace(temp_path, CLUSTER_DATA_PATH)
-    last_cluster_repository_update = CLUSTER_DATA_PATH.stat().st_mtime
+    write_snapshot(CLUSTER_DATA_PATH, cluster_repository.encode(), snapshot_codec, layout=SNAPSHOT_FORMAT)
 
 
 def read_base_repositories():
@@ -146,6 +186,302 @@ def write_base_repositories():
     write_base_cluster_repository()
 
 
+def sync_base_repositories():
+    global cluster_repository, mention_clustering_method, centroid_tracker, unlabeled_index
+    reset, entries = repository_journal.read()
+    if reset:
+        read_base_repositories()
+        unlabeled_index = UnlabeledIndex(
+            entity.entity_id for entity in entity_repository.get_all_entities() if not entity.has_cluster)
+        centroid_tracker = CentroidTracker(
+            dim=get_word2vec_model().vector_size, recompute_after=CENTROID_RECOMPUTE_AFTER)
+        cluster_repository = TrackedClusterRepository(cluster_repository, entity_repository, centroid_tracker)
+        mention_clustering_method = BaseMentionClusteringMethod(
+            entity_repository=entity_repository,
+            cluster_repository=cluster_repository,
+            name="Base Mention Clustering Method",
+            top_n=MENTION_TOP_N
+        )
+    changed_cluster_ids = set()
+    for entry in entries:
+        changed_cluster_ids.update(apply_journal_entry(entry))
+        changed_cluster_ids.update(_journal_entry_cluster_ids(entry))
+        for entity_id in _journal_entry_labeled_entity_ids(entry):
+            suggestion_queue.discard(entity_id)
+    if reset:
+        build_cluster_index()
+    else:
+        update_cluster_index(changed_cluster_ids)
+    mention_vector_cache.save()
+
+
+def create_cluster_index() -> ClusterVectorIndex:
+    dim = get_word2vec_model().vector_size
+    if CLUSTER_INDEX_BACKEND == "ivf":
+        return IVFClusterIndex(
+            dim=dim,
+            n_lists=CLUSTER_INDEX_LISTS,
+            n_probe=CLUSTER_INDEX_PROBES,
+            rebuild_fraction=CLUSTER_INDEX_REBUILD_FRACTION,
+            index_file=DATA_PATH / "cluster_index.ivf.npy")
+    if CLUSTER_INDEX_BACKEND == "hnsw":
+        return HNSWClusterIndex(dim=dim, index_file=DATA_PATH / "cluster_index.hnsw")
+    if CLUSTER_INDEX_BACKEND != "exact":
+        raise ValueError(f"Unknown cluster index backend: {CLUSTER_INDEX_BACKEND}")
+    return ClusterVectorIndex(dim=dim)
+
+
+def build_cluster_index():
+    global cluster_index
+    index = create_cluster_index()
+    index.build(
+        (cluster.cluster_id, get_cluster_vector(cluster))
+        for cluster in cluster_repository.get_all_clusters()
+    )
+    cluster_index = index
+    suggestion_queue.clear()
+
+
+async def refresh_cluster_index():
+    # Neo4J mode does not see cluster changes of other services, the index is
+    # rebuilt periodically instead.
+    while True:
+        try:
+            await asyncio.to_thread(build_cluster_index)
+        except Exception as e:
+            logging.error(f"Could not refresh the cluster index: {e}")
+        await asyncio.sleep(CLUSTER_INDEX_REFRESH)
+
+
+def update_cluster_index(cluster_ids: set[str]):
+    for cluster_id in cluster_ids:
+        try:
+            cluster: ClusterModel = cluster_repository.get_cluster_by_id(cluster_id)
+        except NotFoundException:
+            cluster_index.remove(cluster_id)
+            suggestion_queue.cluster_changed(cluster_id, None, None)
+            continue
+        cluster_vector = get_cluster_vector(cluster)
+        previous = cluster_index.upsert(cluster_id, cluster_vector)
+        current, valid = cluster_index.normalize(cluster_vector)
+        suggestion_queue.cluster_changed(cluster_id, previous, current if valid else None)
+
+
+def _journal_entry_cluster_ids(entry: dict) -> list[str]:
+    data = entry["data"]
+    if entry["op"] == "delete_clusters":
+        return data["cluster_ids"]
+    if entry["op"] in ("add_cluster", "add_entity_to_cluster", "remove_entity_from_cluster"):
+        return [data["cluster_id"]]
+    return []
+
+
+def _journal_entry_labeled_entity_ids(entry: dict) -> list[str]:
+    # Entities that were labeled or changed must not be suggested from the
+    # queue anymore.
+    data = entry["data"]
+    if entry["op"] == "add_entity_to_cluster":
+        return [data["entity_id"]]
+    if entry["op"] == "update_entity":
+        return [data["entity"]["entity_id"]]
+    if entry["op"] == "delete_entities":
+        return data["entity_ids"]
+    return []
+
+
+def score_suggestions(index: ClusterVectorIndex, entities: list[EntityModel]) -> list[tuple]:
+    vectors = [entity.mention_vector for entity in entities]
+    scored = []
+    for entity, suggestions in zip(entities, index.top_n_batch(vectors, MENTION_TOP_N)):
+        vector, valid = index.normalize(entity.mention_vector)
+        if valid:
+            scored.append((entity.entity_id, vector, suggestions))
+    return scored
+
+
+async def refill_suggestion_queue():
+    missing = SUGGESTION_QUEUE_SIZE - len(suggestion_queue)
+    if cluster_index is None or missing <= 0:
+        return
+    index = cluster_index
+    version = index.version
+    entities = [
+        entity for entity in sample_unlabeled_entities(missing)
+        if entity.has_mention_vector and entity.entity_id not in suggestion_queue
+    ]
+    # Scored on the cpu pool so requests are not stalled by a refill, the
+    # results are pushed back on the event loop.
+    scored = await cpu_pool.run(score_suggestions, index, entities)
+    if index is not cluster_index or index.version != version:
+        # A sync changed clusters while scoring and already checked the queue
+        # against them, these suggestions may be stale. The next interval
+        # tries again.
+        return
+    for entity_id, vector, suggestions in scored:
+        if entity_id not in suggestion_queue:
+            suggestion_queue.push(entity_id, vector, suggestions)
+
+
+async def fill_suggestion_queue():
+    while True:
+        if len(suggestion_queue) <= SUGGESTION_QUEUE_SIZE // 2:
+            try:
+                await refill_suggestion_queue()
+            except (NotFoundException, PoolFullException):
+                # Nothing to suggest, or the pool is busy with requests
+                pass
+            except Exception as e:
+                logging.error(f"Could not refill the suggestion queue: {e}")
+        await asyncio.sleep(SUGGESTION_QUEUE_INTERVAL)
+
+
+def pop_suggestion() -> tuple[EntityModel, list[ClusterModel]]:
+    # The queue may have been filled before other services labeled some of its
+    # entities, those are skipped.
+    while True:
+        item = suggestion_queue.pop()
+        if item is None:
+            return None
+        entity_id, suggestions = item
+        try:
+            entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+            if entity.has_cluster:
+                continue
+            return entity, [
+                cluster_repository.get_cluster_by_id(cluster_id) for cluster_id, _ in suggestions]
+        except NotFoundException:
+            continue
+
+
+def compact_base_repositories():
+    if repository_journal.should_compact():
+        repository_journal.compact(write_base_repositories)
+
+
+def base_repositories_dirty() -> bool:
+    return repository_journal.dirty
+
+
+def track_centroid_change(op: str, data: dict):
+    # Called after the change was applied to the repositories. Members are
+    # added and removed through the TrackedClusterRepository, which already
+    # moved the running sums.
+    if op == "add_cluster":
+        centroid_tracker.set(data["cluster_id"], [])
+    elif op == "delete_clusters":
+        for cluster_id in data["cluster_ids"]:
+            centroid_tracker.drop(cluster_id)
+
+
+def invalidate_entity_centroids(entity_ids: list[str]) -> list[str]:
+    # Updated or deleted members change their cluster in an unknown way, the
+    # cluster is recomputed on its next read.
+    cluster_ids = []
+    for entity_id in entity_ids:
+        try:
+            entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+        except NotFoundException:
+            continue
+        if entity.has_cluster:
+            centroid_tracker.invalidate(entity.cluster_id)
+            cluster_ids.append(entity.cluster_id)
+    return cluster_ids
+
+
+def get_cluster_vector(cluster: ClusterModel):
+    if centroid_tracker is None:
+        return cluster.cluster_vector
+    return centroid_tracker.current(
+        cluster.cluster_id,
+        lambda: [entity.mention_vector for entity in cluster.entities if entity.has_mention_vector])
+
+
+def _current_cluster_id(entity_id: str) -> Optional[str]:
+    # Entries written before remove-entity checked its path may name another
+    # cluster than the one the entity is removed from.
+    try:
+        entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+    except NotFoundException:
+        return None
+    return entity.cluster_id if entity.has_cluster else None
+
+
+def apply_journal_entry(entry: dict) -> list[str]:
+    """
+    Applies an entry and returns the clusters whose members changed in a way
+    the entry itself does not name.
+    """
+    op, data = entry["op"], entry["data"]
+    invalidated = []
+    if op == "update_entity":
+        invalidated = invalidate_entity_centroids([data["entity"]["entity_id"]])
+    elif op == "delete_entities":
+        invalidated = invalidate_entity_centroids(data["entity_ids"])
+    try:
+        if op == "add_entities":
+            entity_repository.add_entities(
+                [_dict_to_entity(entity) for entity in data["entities"]],
+                suppress_exceptions=True)
+        elif op == "update_entity":
+            entity_repository.update_entity(_dict_to_entity(data["entity"]))
+        elif op == "delete_entities":
+            entity_repository.delete_entities(data["entity_ids"], suppress_exceptions=True)
+        elif op == "add_cluster":
+            cluster_repository.add_cluster(ClusterModel(
+                cluster_id=data["cluster_id"],
+                cluster_name=data["cluster_name"],
+                entities=[]
+            ))
+        elif op == "delete_clusters":
+            cluster_repository.delete_clusters(data["cluster_ids"])
+        elif op == "add_entity_to_cluster":
+            cluster_repository.add_entity_to_cluster(
+                cluster_id=data["cluster_id"], entity_id=data["entity_id"])
+        elif op == "remove_entity_from_cluster":
+            cluster_id = _current_cluster_id(data["entity_id"])
+            if cluster_id is not None and cluster_id != data["cluster_id"]:
+                invalidated.append(cluster_id)
+            cluster_repository.remove_entity_from_cluster(entity_id=data["entity_id"])
+        track_centroid_change(op, data)
+    # Entries may already be part of the snapshots if a compaction was
+    # interrupted, those are skipped.
+    except (NotFoundException, AlreadyExistsException, AlreadyInClusterException) as e:
+        logging.warning(f"Skipping journal entry {entry['seq']} ({op}): {e}")
+    track_unlabeled_change(op, data)
+    return invalidated
+
+
+def track_unlabeled_change(op: str, data: dict):
+    if unlabeled_index is None:
+        return
+    for entity_id in changed_entity_ids(op, data):
+        try:
+            entity: EntityModel = entity_repository.get_entity_by_id(entity_id)
+        except NotFoundException:
+            unlabeled_index.discard(entity_id)
+            continue
+        unlabeled_index.set(entity_id, not entity.has_cluster)
+
+
+def sample_unlabeled_entities(num: int) -> list[EntityModel]:
+    """
+    Samples from the unlabeled index in base mode, the Neo4J repository
+    samples on its own and raises NotFoundException when none are left.
+    """
+    if unlabeled_index is None:
+        return entity_repository.get_random_unlabeled_entities(num)
+    return [entity_repository.get_entity_by_id(entity_id) for entity_id in unlabeled_index.sample(num)]
+
+
+def _dict_to_entity(entity_dict: dict) -> EntityModel:
+    return EntityModel(
+        entity_id=entity_dict["entity_id"],
+        mention=entity_dict["mention"],
+        entity_source=entity_dict["entity_source"],
+        entity_source_id=entity_dict["entity_source_id"]
+    )
+
+
 app = FastAPI(
     title="Mention Clustering Service",
     description="A service for reccomending clusters for mentions",
@@ -155,10 +491,19 @@ app = FastAPI(
 )
 
 if SYSTEM_TYPE == "base":
+    repository_journal = RepositoryJournal(
+        DATA_PATH / "repository_journal.jsonl", compact_after=JOURNAL_COMPACT_AFTER)
     app.add_middleware(
         FileLockerMiddleware,
-        files_to_lock=[DATA_PATH / "entity_repository.json", DATA_PATH / "cluster_repository.json"],
-        before=read_base_repositories, after=write_base_repositories)
+        files_to_lock=[DATA_PATH / "entity_repository.json", DATA_PATH / "cluster_repository.json",
+                       DATA_PATH / "repository_journal.jsonl"],
+        before=sync_base_repositories, after=compact_base_repositories,
+        is_dirty=base_repositories_dirty)
+
+
+@app.exception_handler(PoolFullException)
+async def pool_full_handler(request: Request, exc: PoolFullException):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
 
 @app.on_event("startup")
@@ -170,61 +515,153 @@ async def startup_event():
             entity_repository=entity_repository,
             cluster_repository=cluster_repository,
             name="Neo4J Mention Clustering Method",
-            top_n=10
+            top_n=MENTION_TOP_N
         )
+        if CLUSTER_INDEX_REFRESH > 0:
+            asyncio.create_task(refresh_cluster_index())
 
     elif SYSTEM_TYPE == "base":
-        read_base_repositories()
-        mention_clustering_method = BaseMentionClusteringMethod(
-            entity_repository=entity_repository,
-            cluster_repository=cluster_repository,
-            name="Base Mention Clustering Method",
-            top_n=10
-        )
+        sync_base_repositories()
 
+    if SUGGESTION_QUEUE_SIZE > 0:
+        asyncio.create_task(fill_suggestion_queue())
 
-async def auth_required(security_scopes: SecurityScopes, token: dict = Depends(o_auth2_scheme)):
-    response = httpx.get(
-        f'{AUTH_SERVICE_URL}/verify',
-        headers={'Authorization': f"Bearer {token}"}
-    )
-    if response.status_code != 200:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    if 'admin' in response.json()["scopes"]:
-        return response.json()
 
-    if 'admin' in security_scopes.scopes:
-        if 'admin' not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
+@app.on_event("shutdown")
+async def shutdown_event():
+    if cluster_index is not None:
+        cluster_index.save()
+    cpu_pool.shutdown()
+    await auth_client.close()
 
-    for scope in security_scopes.scopes:
-        if scope != "admin" and scope not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
 
-    return response.json()
+async def auth_required(security_scopes: SecurityScopes, token: dict = Depends(o_auth2_scheme)):
+    user = await auth_client.verify(token)
+    check_scopes(user, security_scopes.scopes)
+    return user
+
+
+def get_possible_clusters(entity: EntityModel) -> list[ClusterModel]:
+    # In Neo4J mode the index only exists when CLUSTER_INDEX_REFRESH is set.
+    if cluster_index is None or not entity.has_mention_vector:
+        return mention_clustering_method.getPossibleClusters(entity)
+    return [
+        cluster_repository.get_cluster_by_id(cluster_id)
+        for cluster_id, _ in cluster_index.top_n(entity.mention_vector, MENTION_TOP_N)
+    ]
+
+
+def get_possible_clusters_batch(entities: list[EntityModel]) -> list[list[ClusterModel]]:
+    if cluster_index is None:
+        return [mention_clustering_method.getPossibleClusters(entity) for entity in entities]
+    indexed = [entity for entity in entities if entity.has_mention_vector]
+    suggestions = dict(zip(
+        (entity.entity_id for entity in indexed),
+        cluster_index.top_n_batch([entity.mention_vector for entity in indexed], MENTION_TOP_N)
+    ))
+    return [
+        [cluster_repository.get_cluster_by_id(cluster_id) for cluster_id, _ in suggestions[entity.entity_id]]
+        if entity.entity_id in suggestions
+        else mention_clustering_method.getPossibleClusters(entity)
+        for entity in entities
+    ]
+
+
+def _mention_out(entity: EntityModel, possible_clusters: list[ClusterModel]) -> MentionOut:
+    return MentionOut(
+        entity_id=entity.entity_id,
+        mention=entity.mention,
+        entity_source=entity.entity_source,
+        entity_source_id=entity.entity_source_id,
+        possible_cluster_ids=[cluster.cluster_id for cluster in possible_clusters],
+        possible_cluster_names=[cluster.cluster_name for cluster in possible_clusters]
+    )
 
 
 @app.get("/", response_model=MentionOut)
 async def get_prediction_for_next_mention(user: dict = Security(auth_required, scopes=[])):
 
     try:
-        entity: EntityModel = entity_repository.get_random_unlabeled_entity()
+        suggestion = pop_suggestion()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if suggestion is not None:
+        return _mention_out(*suggestion)
+
+    try:
+        entities: list[EntityModel] = sample_unlabeled_entities(1)
     except NotFoundException:
         raise HTTPException(status_code=404, detail="No unlabeled entities found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not entities:
+        raise HTTPException(status_code=404, detail="No unlabeled entities found")
+    entity = entities[0]
 
     try:
-        possible_clusters = mention_clustering_method.getPossibleClusters(entity)
+        possible_clusters = await cpu_pool.run(get_possible_clusters, entity)
+    except PoolFullException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    return MentionOut(
-        entity_id=entity.entity_id,
-        mention=entity.mention,
-        entity_source=entity.entity_source,
-        entity_source_id=entity.entity_source_id,
-        possible_cluster_ids=[cluster.cluster_id for cluster in possible_clusters],
-        possible_cluster_names=[cluster.cluster_name for cluster in possible_clusters]
-    )
+    return _mention_out(entity, possible_clusters)
+
+
+@app.get("/batch", response_model=list[MentionOut])
+async def get_predictions_for_mentions(
+        num: int = Query(default=10, gt=0, le=1000),
+        entity_ids: list[str] = Query(default=None),
+        user: dict = Security(auth_required, scopes=[])):
+    """
+    Returns `num` random unlabeled entities, or the entities in `entity_ids`,
+    with their suggested clusters.
+    """
+    try:
+        if entity_ids:
+            entities: list[EntityModel] = [
+                entity_repository.get_entity_by_id(entity_id) for entity_id in entity_ids]
+        else:
+            entities: list[EntityModel] = sample_unlabeled_entities(num)
+    except NotFoundException as e:
+        raise HTTPException(status_code=404, detail=e.message)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not entities:
+        raise HTTPException(status_code=404, detail="No unlabeled entities found")
+
+    try:
+        possible_clusters = await cpu_pool.run(get_possible_clusters_batch, entities)
+    except PoolFullException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return [_mention_out(entity, clusters) for entity, clusters in zip(entities, possible_clusters)]
+
+
+@app.get("/index/report")
+async def get_cluster_index_report(
+        samples: int = Query(default=100, gt=0, le=10000),
+        user: dict = Security(auth_required, scopes=["admin"])):
+    if cluster_index is None:
+        raise HTTPException(status_code=404, detail="Cluster index is not enabled")
+    try:
+        entities = sample_unlabeled_entities(samples)
+    except NotFoundException:
+        raise HTTPException(status_code=404, detail="No unlabeled entities found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not entities:
+        raise HTTPException(status_code=404, detail="No unlabeled entities found")
+
+    queries = [entity.mention_vector for entity in entities if entity.has_mention_vector]
+    return await cpu_pool.run(evaluate_index, cluster_index, queries, MENTION_TOP_N)
+
+
+@app.get("/metrics")
+async def get_metrics(user: dict = Security(auth_required, scopes=["admin"])):
+    return {
+        "repository_writes": FileLockerMiddleware.write_stats,
+        "pools": WorkerPool.all_stats()
+    }
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import numpy as np
+
+
+class SuggestionQueue:
+    """
+    FIFO of unlabeled entities with precomputed cluster suggestions, so a
+    suggestion is served with a pop instead of scoring all clusters on the
+    request path.
+
+    Suggestions only go stale when a cluster changes: a queued entity is
+    dropped when one of its suggested clusters was removed or moved by more
+    than `threshold` (cosine distance), or when a changed cluster now scores
+    higher than the worst of its suggestions. Smaller moves are ignored.
+    """
+
+    def __init__(self, top_n: int, threshold: float = 0.05):
+        self.top_n = top_n
+        self.threshold = threshold
+        self.items: OrderedDict[str, tuple[list[tuple[str, float]], np.ndarray]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self.items
+
+    def push(self, entity_id: str, vector: np.ndarray, suggestions: list[tuple[str, float]]):
+        """
+        `vector` must be the normalized mention vector the suggestions were
+        computed for.
+        """
+        self.items[entity_id] = (suggestions, vector)
+
+    def pop(self) -> tuple[str, list[tuple[str, float]]]:
+        if not self.items:
+            return None
+        entity_id, (suggestions, _) = self.items.popitem(last=False)
+        return entity_id, suggestions
+
+    def discard(self, entity_id: str):
+        self.items.pop(entity_id, None)
+
+    def clear(self):
+        self.items.clear()
+
+    def cluster_changed(self, cluster_id: str, previous: np.ndarray, current: np.ndarray):
+        """
+        `previous` and `current` are the normalized vectors of the cluster
+        before and after the change, None for a new, removed or empty cluster.
+        """
+        if previous is not None and current is not None \
+                and 1 - float(previous @ current) <= self.threshold:
+            return
+        stale = []
+        for entity_id, (suggestions, vector) in self.items.items():
+            if any(suggested_id == cluster_id for suggested_id, _ in suggestions):
+                stale.append(entity_id)
+            elif current is not None and (
+                    len(suggestions) < self.top_n or float(vector @ current) > suggestions[-1][1]):
+                stale.append(entity_id)
+        for entity_id in stale:
+            del self.items[entity_id]
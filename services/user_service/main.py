@@ -2,36 +2,58 @@ from models import UserOut, PasswordUpdateIn, ScopeUpdateIn, UserCreateIn, Usern
 
 
 from fastapi import FastAPI, Depends, HTTPException, status, Request, Security
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, SecurityScopes
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from file_locker_middleware import FileLockerMiddleware
+from worker_pool import WorkerPool, PoolFullException
+from snapshot_codec import get_codec, read_snapshot, write_snapshot
+from auth_client import AuthClient, LocalAuthClient, check_scopes
 from eec.core.abstract.user_repository import IUserRepository
 from eec import BaseUserRepository, Neo4JHelper, Neo4JUserRepository, UserModel, NotFoundException, AlreadyExistsException
 from dotenv import load_dotenv
 from pathlib import Path
 import os
-import json
 import logging
-import httpx
 
 load_dotenv()
 
 DATA_PATH = Path(os.getenv("DATA_PATH") or "data")
 LOGGER_PATH = Path(os.getenv("LOGGER_PATH") or "logs")
 SYSTEM_TYPE = os.getenv("SYSTEM_TYPE") or "base"
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC") or "auto"
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL") or "http://eec.localhost/api/v1/auth"
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE") or 1024)
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL") or 60)
+AUTH_MODE = os.getenv("AUTH_MODE") or "remote"
+AUTH_USERS_REFRESH = float(os.getenv("AUTH_USERS_REFRESH") or 30)
+SECRET_KEY = os.getenv("SECRET_KEY")
+REPOSITORY_POOL_SIZE = int(os.getenv("REPOSITORY_POOL_SIZE") or 8)
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE") or os.cpu_count() or 4)
+POOL_QUEUE_SIZE = int(os.getenv("POOL_QUEUE_SIZE") or 256)
 
 user_repository: IUserRepository = None
+user_repository_dirty: bool = False
 last_user_repository_update: float = None
 
+snapshot_codec = get_codec(SNAPSHOT_CODEC)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt releases the GIL, so hashes on the cpu pool run in parallel
+repository_pool = WorkerPool("repository", REPOSITORY_POOL_SIZE, POOL_QUEUE_SIZE)
+cpu_pool = WorkerPool("cpu", CPU_POOL_SIZE, POOL_QUEUE_SIZE)
 
 o_auth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/api/v1/auth/login",
     scopes={"admin": "Admin access", "editor": "Editor access", "export": "Export access"})
 
+if AUTH_MODE == "local":
+    auth_client = LocalAuthClient(AUTH_SERVICE_URL, secret_key=SECRET_KEY,
+                                  refresh_interval=AUTH_USERS_REFRESH)
+else:
+    auth_client = AuthClient(AUTH_SERVICE_URL, cache_size=AUTH_CACHE_SIZE, cache_ttl=AUTH_CACHE_TTL)
+
 
 def neo4j_user_repository():
     global user_repository
@@ -50,50 +72,42 @@ def neo4j_user_repository():
 
 
 def read_base_user_repository():
-    global user_repository, last_user_repository_update, DATA_PATH
+    global user_repository, user_repository_dirty, last_user_repository_update, DATA_PATH
     USER_DATA_PATH = DATA_PATH / "user_repository.json"
 
     if user_repository is None or last_user_repository_update is None or last_user_repository_update < USER_DATA_PATH.stat().st_mtime:
+        # Changes of the replaced repository are gone with it
+        user_repository_dirty = False
         if not USER_DATA_PATH.exists():
             print("User repository not found. Creating new one.")
             user_repository = BaseUserRepository()
             return
-        with open(USER_DATA_PATH, "r") as f:
-            user_repository = BaseUserRepository.decode(json.load(f))
+        user_repository = BaseUserRepository.decode(read_snapshot(USER_DATA_PATH, snapshot_codec))
         last_user_repository_update = USER_DATA_PATH.stat().st_mtime
 
 
 def write_base_user_repository():
-    global user_repository, last_user_repository_update, DATA_PATH
+    global user_repository, user_repository_dirty, last_user_repository_update, DATA_PATH
     USER_DATA_PATH = DATA_PATH / "user_repository.json"
 
-    temp_path = USER_DATA_PATH.parent / (USER_DATA_PATH.name + ".tmp")
-    with open(temp_path, "w") as f:
-        json.dump(user_repository.encode(), f)
-    os.replace(temp_path, USER_DATA_PATH)
+    write_snapshot(USER_DATA_PATH, user_repository.encode(), snapshot_codec)
     last_user_repository_update = USER_DATA_PATH.stat().st_mtime
+    user_repository_dirty = False
 
 
-async def auth_required(security_scopes: SecurityScopes, token: dict = Depends(o_auth2_scheme)):
-    response = httpx.get(
-        f'{AUTH_SERVICE_URL}/verify',
-        headers={'Authorization': f"Bearer {token}"}
-    )
-    if response.status_code != 200:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+def mark_user_repository_dirty():
+    global user_repository_dirty
+    user_repository_dirty = True
 
-    if 'admin' in response.json()["scopes"]:
-        return response.json()
 
-    if 'admin' in security_scopes.scopes:
-        if 'admin' not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
+def base_user_repository_dirty() -> bool:
+    return user_repository_dirty
 
-    for scope in security_scopes.scopes:
-        if scope != "admin" and scope not in response.json()["scopes"]:
-            raise HTTPException(status_code=401, detail="Unauthorized")
 
-    return response.json()
+async def auth_required(security_scopes: SecurityScopes, token: dict = Depends(o_auth2_scheme)):
+    user = await auth_client.verify(token)
+    check_scopes(user, security_scopes.scopes)
+    return user
 
 
 app = FastAPI(
@@ -104,7 +118,13 @@ app = FastAPI(
 if SYSTEM_TYPE == "base":
     app.add_middleware(FileLockerMiddleware,
                        files_to_lock=[DATA_PATH / "user_repository.json"],
-                       before=read_base_user_repository, after=write_base_user_repository)
+                       before=read_base_user_repository, after=write_base_user_repository,
+                       is_dirty=base_user_repository_dirty, pool=repository_pool)
+
+
+@app.exception_handler(PoolFullException)
+async def pool_full_handler(request: Request, exc: PoolFullException):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
 
 @app.on_event("startup")
@@ -116,9 +136,24 @@ async def startup_event():
         read_base_user_repository()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    repository_pool.shutdown()
+    cpu_pool.shutdown()
+    await auth_client.close()
+
+
+@app.get("/metrics")
+async def get_metrics(user: dict = Security(auth_required, scopes=["admin"])):
+    return {
+        "repository_writes": FileLockerMiddleware.write_stats,
+        "pools": WorkerPool.all_stats()
+    }
+
+
 @app.get("/", response_model=list[UserOut])
 async def get_all_users(user: dict = Security(auth_required, scopes=[])):
-    _all_users = user_repository.get_all_users()
+    _all_users = await repository_pool.run(user_repository.get_all_users)
     return [UserOut(
         user_id=user.user_id,
         username=user.username,
@@ -164,12 +199,13 @@ async def get_user_by_username(username: str, auth_user: dict = Security(auth_re
 @app.post("/user/create", response_model=UserOut)
 async def create_user(user: UserCreateIn, auth_user: dict = Security(auth_required, scopes=['admin'])):
     try:
-        hashed_password = pwd_context.hash(user.password)
+        hashed_password = await cpu_pool.run(pwd_context.hash, user.password)
         data = user_repository.add_user(
             username=user.username,
             hashed_password=hashed_password,
             scopes=user.scopes,
         )
+        mark_user_repository_dirty()
         return UserOut(
             user_id=data.user_id,
             username=data.username,
@@ -189,8 +225,8 @@ async def update_user_username(id: str, user: UsernameUpdateIn, auth_user: dict
     except NotFoundException:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if not pwd_context.verify(
-            user.password, db_user.hashed_password) and auth_user["role"] != "admin":
+    if not await cpu_pool.run(pwd_context.verify, user.password, db_user.hashed_password) \
+            and auth_user["role"] != "admin":
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     try:
@@ -198,6 +234,7 @@ async def update_user_username(id: str, user: UsernameUpdateIn, auth_user: dict
             user_id=id,
             username=user.username,
         )
+        mark_user_repository_dirty()
         return UserOut(
             user_id=data.user_id,
             username=data.username,
@@ -217,14 +254,16 @@ async def update_user_password(id: str, user: PasswordUpdateIn, auth_user: dict
     except NotFoundException:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if not pwd_context.verify(user.old_password, db_user.hashed_password):
+    if not await cpu_pool.run(pwd_context.verify, user.old_password, db_user.hashed_password):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
+    hashed_password = await cpu_pool.run(pwd_context.hash, user.password)
     try:
         data = user_repository.change_password(
             user_id=id,
-            hashed_password=pwd_context.hash(user.password),
+            hashed_password=hashed_password,
         )
+        mark_user_repository_dirty()
         return UserOut(
             user_id=data.user_id,
             username=data.username,
@@ -241,6 +280,7 @@ async def update_user_role(id: str, user: ScopeUpdateIn, auth_user: dict = Secur
             user_id=id,
             scopes=user.scopes,
         )
+        mark_user_repository_dirty()
         return UserOut(
             user_id=data.user_id,
             username=data.username,
@@ -254,5 +294,6 @@ async def update_user_role(id: str, user: ScopeUpdateIn, auth_user: dict = Secur
 async def delete_user(id: str, auth_user: dict = Security(auth_required, scopes=['admin'])):
     try:
         user_repository.delete_user(id)
+        mark_user_repository_dirty()
     except NotFoundException:
         raise HTTPException(status_code=404, detail="User not found")